@@ -2,13 +2,11 @@
 import logging
 import time
 import uuid
-from typing import Dict, List, Optional, Any, Union, Callable
-import json
+from typing import AsyncIterator, Dict, List, Optional, Any, Tuple, Union, Callable
 from pydantic import BaseModel, Field
 
 from langchain.agents import AgentExecutor, AgentType
 from langchain.memory import ConversationBufferMemory
-from langchain.chains.conversation.memory import ConversationBufferWindowMemory
 from langchain.callbacks.manager import CallbackManager
 from langchain.schema import AgentAction, AgentFinish
 from langchain_core.tools import BaseTool
@@ -16,6 +14,21 @@
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import SystemMessage, HumanMessage
 
+from app import fastjson, metrics
+from app.agent.registry import CANCELLED, COMPLETED, ERROR, RequestRegistry, default_registry
+from app.agent.run_loop import (
+    STOP_ANSWERED,
+    STOP_DEADLINE,
+    STOP_ERROR,
+    STOP_MAX_STEPS,
+    STOP_TOKEN_BUDGET,
+    STOP_TOOL_ERRORS,
+    AgentRun,
+    RunLimits,
+)
+from app.agent.session_memory import SessionStore, default_store
+from app.agent.token_budget import TokenBudget
+from app.agent.tool_cache import ToolResultCache, cache_policy, default_tool_cache
 from app.agent.tools import AVAILABLE_TOOLS
 from app.deepseek.wrapper import DeepSeekWrapper
 
@@ -23,8 +36,20 @@
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('agent')
 
-# Dictionary to store active requests
-ACTIVE_REQUESTS = {}
+# Seconds a single tool call may take (less when the run's deadline is closer)
+TOOL_TIMEOUT = 20
+
+# Why an answer is partial, by stop reason
+PARTIAL_ANSWER_NOTES = {
+    STOP_MAX_STEPS: "I reached the maximum number of steps for one request before finishing",
+    STOP_DEADLINE: "I ran out of time for this request before finishing",
+    STOP_TOKEN_BUDGET: "I reached the token limit for this request before finishing",
+    STOP_ERROR: "I encountered an error while processing the tool result",
+}
+
+# Function schemas per tool set, built once per process. DeepSeek caches prompt
+# prefixes, so every request with the same tools must send the same schemas.
+_TOOL_DESCRIPTIONS: Dict[tuple, List[Dict[str, Any]]] = {}
 
 
 class AgentResponse(BaseModel):
@@ -35,6 +60,9 @@ class AgentResponse(BaseModel):
     tool_calls: List[Dict[str, Any]] = Field(default_factory=list, description="List of tools called during processing")
     thoughts: Optional[str] = Field(None, description="The agent's reasoning process (if available)")
     request_id: Optional[str] = Field(None, description="Request ID for tracking and cancellation")
+    steps: List[Dict[str, Any]] = Field(default_factory=list, description="Timing and token usage of each model call and its tool calls")
+    stop_reason: Optional[str] = Field(None, description="Why the agent stopped (answered, tool_errors, max_steps, deadline, token_budget, error)")
+    similarity: Optional[Dict[str, Any]] = Field(None, description="Entry ID and score if the first model call was answered by the similarity cache")
 
 
 class DeepSeekAgent:
@@ -103,6 +131,12 @@ def __init__(
         tools: Optional[List[BaseTool]] = None,
         system_prompt: Optional[str] = None,
         memory_window_size: int = 5,
+        token_budget: Optional[TokenBudget] = None,
+        request_registry: Optional[RequestRegistry] = None,
+        session_store: Optional[SessionStore] = None,
+        max_parallel_tools: int = 4,
+        run_limits: Optional[RunLimits] = None,
+        tool_cache: Optional[ToolResultCache] = None,
     ):
         """
         Initialize the DeepSeek agent.
@@ -111,27 +145,57 @@ def __init__(
             deepseek_wrapper: DeepSeek API wrapper
             tools: List of tools available to the agent
             system_prompt: Custom system prompt for the agent
-            memory_window_size: Number of recent messages to keep in memory
+            memory_window_size: Number of recent exchanges (user message and answer) sent as history
+            token_budget: Prompt size policy applied to every request
+            request_registry: Registry for request status and cancellation (shared across workers with Redis)
+            session_store: Conversation history per session (shared across workers with Redis)
+            max_parallel_tools: Tool calls of one model turn that run at the same time
+            run_limits: Step, time and token limits of answering one query
+            tool_cache: Results of tools that opt in to caching (shared across workers with Redis)
         """
         self.deepseek_wrapper = deepseek_wrapper
         self.tools = tools or list(AVAILABLE_TOOLS.values())
         self.system_prompt = system_prompt or self.DEFAULT_SYSTEM_PROMPT
         
-        # Set up memory for conversation history
-        self.memory = ConversationBufferWindowMemory(
-            k=memory_window_size,
-            memory_key="chat_history",
-            return_messages=True
-        )
+        # History is shared by every request and worker, so it lives in a shared store
+        self.session_store = session_store or default_store
+        self.memory_window_size = memory_window_size
+        
+        # Keeps long histories and tool results from blowing up the prompt
+        self.token_budget = token_budget or TokenBudget()
+        
+        # Any worker may be asked for a request's status or to cancel it, so both live in a shared registry
+        self.request_registry = request_registry or default_registry
+        
+        # Tool calls the model makes in one turn run concurrently, up to this many at once
+        self.max_parallel_tools = max(1, max_parallel_tools)
+        
+        # Bounds the model and tool calls made for one query
+        self.run_limits = run_limits or RunLimits()
+        
+        # Deterministic tools (see ``app.agent.tool_cache``) are answered from here when possible
+        self.tool_cache = tool_cache or default_tool_cache
         
         # Prepare tool descriptions for the model
         self.tool_descriptions = self._prepare_tool_descriptions()
     
     def _prepare_tool_descriptions(self) -> List[Dict[str, Any]]:
-        """Prepare tool descriptions in the format DeepSeek API expects."""
+        """
+        Prepare tool descriptions in the format DeepSeek API expects.
+        
+        Tools are ordered by name and the schemas of a tool set are shared by
+        all agents, so the functions part of the prompt is byte-identical
+        however the tool list was assembled.
+        """
+        tools = sorted(self.tools, key=lambda tool: tool.name)
+        key = tuple((tool.name, tool.description) for tool in tools)
+        cached = _TOOL_DESCRIPTIONS.get(key)
+        if cached is not None:
+            return cached
+        
         tool_descriptions = []
         
-        for tool in self.tools:
+        for tool in tools:
             tool_desc = {
                 "name": tool.name,
                 "description": tool.description,
@@ -158,39 +222,59 @@ def _prepare_tool_descriptions(self) -> List[Dict[str, Any]]:
             
             tool_descriptions.append(tool_desc)
         
+        _TOOL_DESCRIPTIONS[key] = tool_descriptions
         return tool_descriptions
     
-    async def _run_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> str:
-        """Run a tool by name with arguments."""
+    async def _run_tool(self, tool_name: str, tool_args: Dict[str, Any], timeout: float = TOOL_TIMEOUT) -> str:
+        """Run a tool by name with arguments, giving up after ``timeout`` seconds."""
         try:
-            logger.info(f"Running tool '{tool_name}' with args: {json.dumps(tool_args)}")
+            logger.info(f"Running tool '{tool_name}' with args: {fastjson.dumps(tool_args)}")
             
             tool_found = False
             for tool in self.tools:
                 if tool.name == tool_name:
                     tool_found = True
+                    
+                    # Tools that declare a TTL and data version are memoized
+                    policy = cache_policy(tool, tool_args)
+                    if policy:
+                        lookup_started = time.time()
+                        cache_ttl, data_version = policy
+                        cache_key = self.tool_cache.key(tool_name, data_version, tool_args)
+                        cached = await self.tool_cache.get(tool_name, cache_key, cache_ttl)
+                        if cached is not None:
+                            logger.info(f"Tool '{tool_name}' answered from cache")
+                            metrics.TOOL_LATENCY.observe(time.time() - lookup_started, tool=tool_name, outcome="cached")
+                            return cached
+                    
                     try:
                         start_time = time.time()
                         
                         # Add timeout to avoid hanging
                         try:
                             result = await asyncio.wait_for(
-                                tool.arun(**tool_args), 
-                                timeout=20  # 20 second timeout for tools
+                                tool.arun(tool_args), 
+                                timeout=timeout
                             )
                             
                             duration = time.time() - start_time
                             logger.info(f"Tool '{tool_name}' completed in {duration:.2f}s")
+                            metrics.TOOL_LATENCY.observe(duration, tool=tool_name, outcome="ok")
+                            
+                            if policy and isinstance(result, str) and not result.startswith("Error:"):
+                                await self.tool_cache.set(tool_name, cache_key, result, cache_ttl)
                             
                             return result
                         except asyncio.TimeoutError:
-                            logger.error(f"Tool '{tool_name}' timed out after 20s")
+                            logger.error(f"Tool '{tool_name}' timed out after {timeout:.0f}s")
+                            metrics.TOOL_LATENCY.observe(time.time() - start_time, tool=tool_name, outcome="timeout")
                             return f"Error: Tool '{tool_name}' timed out. The agent will try to continue without using this tool."
                             
                     except Exception as e:
                         import traceback
                         error_message = f"Error executing tool '{tool_name}': {str(e)}\n{traceback.format_exc()}"
                         logger.error(error_message)
+                        metrics.TOOL_LATENCY.observe(time.time() - start_time, tool=tool_name, outcome="error")
                         return f"Error: Tool '{tool_name}' failed with error: {str(e)}. The agent will continue processing your request."
             
             if not tool_found:
@@ -203,125 +287,314 @@ async def _run_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> str:
             logger.error(error_message)
             return f"An unexpected error occurred when trying to run the tool: {str(e)}. The agent will continue processing your request."
     
-    async def _process_function_calls(self, response: Dict[str, Any], request_id: str) -> Dict[str, Any]:
-        """Process function calls from DeepSeek API response."""
+    @staticmethod
+    def _tool_call_args(call: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """Return the tool name and parsed arguments of a tool call."""
+        function = call.get("function") or {}
+        tool_name = function.get("name", "")
         try:
-            function_call = self.deepseek_wrapper.extract_function_call(response)
-            tool_calls = []
+            arguments = fastjson.loads(function.get("arguments") or "{}")
+        except fastjson.JSONDecodeError as e:
+            logger.error(f"Error parsing arguments JSON for tool '{tool_name}': {str(e)}")
+            arguments = {}
+        if not isinstance(arguments, dict):
+            arguments = {}
+        return tool_name, arguments
+    
+    @staticmethod
+    def _tool_failed(tool_call: Dict[str, Any]) -> bool:
+        result = tool_call.get("result")
+        return not result or str(result).startswith("Error:")
+    
+    async def _run_tool_calls(
+        self,
+        calls: List[Dict[str, Any]],
+        request_id: str,
+        timeout: float = TOOL_TIMEOUT,
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the tool calls of one model turn concurrently.
+        
+        At most ``max_parallel_tools`` run at a time. A failing tool only
+        fails its own call: its result is an error message and the other
+        calls carry on.
+        
+        Args:
+            calls: Tool calls from ``extract_tool_calls``
+            request_id: Request ID for logging
+            timeout: Seconds each tool call may take
             
-            if function_call:
-                try:
-                    tool_name = function_call.get("name", "")
-                    arguments_str = function_call.get("arguments", "{}")
-                    
-                    logger.info(f"Request {request_id}: Tool call '{tool_name}'")
-                    
-                    # Handle potential JSON parsing errors
-                    try:
-                        arguments = json.loads(arguments_str)
-                    except json.JSONDecodeError as e:
-                        error_msg = f"Error parsing arguments JSON for tool '{tool_name}': {str(e)}"
-                        logger.error(error_msg)
-                        arguments = {}
-                    
-                    # Run the tool
-                    tool_result = await self._run_tool(tool_name, arguments)
-                    
-                    # Record the tool call
-                    tool_calls.append({
-                        "tool": tool_name,
-                        "args": arguments,
-                        "result": tool_result
-                    })
+        Returns:
+            One record (tool, args, result) per call, in the order of ``calls``
+        """
+        semaphore = asyncio.Semaphore(self.max_parallel_tools)
+        
+        async def run(call: Dict[str, Any]) -> Dict[str, Any]:
+            tool_name, arguments = self._tool_call_args(call)
+            async with semaphore:
+                logger.info(f"Request {request_id}: Tool call '{tool_name}'")
+                result = await self._run_tool(tool_name, arguments, timeout)
+            return {"tool": tool_name, "args": arguments, "result": result}
+        
+        if len(calls) > 1:
+            logger.info(f"Request {request_id}: Running {len(calls)} tool calls, up to {self.max_parallel_tools} at a time")
+        outcomes = await asyncio.gather(*(run(call) for call in calls), return_exceptions=True)
+        
+        records = []
+        for call, outcome in zip(calls, outcomes):
+            if isinstance(outcome, Exception):
+                tool_name, arguments = self._tool_call_args(call)
+                logger.error(f"Request {request_id}: Tool call '{tool_name}' failed: {str(outcome)}")
+                outcome = {
+                    "tool": tool_name,
+                    "args": arguments,
+                    "result": f"Error: Tool '{tool_name}' failed with error: {str(outcome)}. The agent will continue processing your request.",
+                }
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            records.append(outcome)
+        return records
+    
+    @staticmethod
+    def _tool_messages(
+        content: Optional[str],
+        calls: List[Dict[str, Any]],
+        tool_calls: List[Dict[str, Any]],
+    ) -> List[Dict[str, Any]]:
+        """Build the assistant tool-call message and one tool result message per call."""
+        messages = [{
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {
+                        "name": record["tool"],
+                        "arguments": (call.get("function") or {}).get("arguments") or "{}",
+                    },
+                }
+                for call, record in zip(calls, tool_calls)
+            ],
+        }]
+        for call, record in zip(calls, tool_calls):
+            messages.append({"role": "tool", "tool_call_id": call["id"], "content": str(record["result"] or "")})
+        return messages
+    
+    @staticmethod
+    def _partial_answer(text: str, tool_calls: List[Dict[str, Any]], reason: str) -> str:
+        """Build the best answer available when a run stops early: the model's last text and the latest tool results."""
+        note = f"{PARTIAL_ANSWER_NOTES[reason]}."
+        if tool_calls:
+            results = "\n\n".join(str(call["result"]) for call in tool_calls)
+            note = f"{PARTIAL_ANSWER_NOTES[reason]}. Here's what I found: {results}"
+        return f"{text}\n\n{note}" if text else note
+    
+    async def _run_steps(
+        self,
+        messages: List[Dict[str, Any]],
+        run: AgentRun,
+        request_id: str,
+        stream: bool = False,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Answer a query step by step: call the model, run the tools it asks for, repeat.
+        
+        The loop ends when the model answers without calling a tool, when
+        every tool of a turn fails, or when a limit of ``run`` is reached, in
+        which case the answer is the model's last text plus the latest tool
+        results. Errors of the first model call are raised; a failed follow-up
+        call also ends the run with that partial answer.
+        
+        Args:
+            messages: Prompt messages of the first model call
+            run: Step, time and token accounting of this run (``steps`` and
+                ``stop_reason`` are filled in)
+            request_id: Request ID for logging
+            stream: Stream the model's answers, yielding their tokens
+            
+        Yields:
+            ``token`` (streamed text), ``tool_call`` and ``tool_result`` events,
+            then an ``answer`` event with the final ``response``, ``tool_calls``
+            and, on a similarity cache hit, ``similarity``
+        """
+        estimator = self.token_budget.estimator
+        tool_calls: List[Dict[str, Any]] = []
+        # The last text and successful tool results, answered with if the run stops early
+        partial_text = ""
+        partial_results: List[Dict[str, Any]] = []
+        similarity = None
+        
+        while True:
+            prompt_estimate = estimator.count_messages(messages, self.tool_descriptions)
+            reason = run.check(prompt_estimate)
+            if reason:
+                logger.warning(f"Request {request_id}: Stopping after {len(run.steps)} steps ({reason})")
+                run.stop_reason = reason
+                response_text = self._partial_answer(partial_text, partial_results, reason)
+                if stream:
+                    yield {"type": "token", "content": response_text[len(partial_text):]}
+                break
+            
+            first_step = not run.steps
+            step_started = time.monotonic()
+            max_tokens = run.completion_tokens(1024, prompt_estimate)
+            # The initial request gets more time than follow-ups, both within the deadline
+            timeout = run.timeout(120 if first_step else 90)
+            usage: Dict[str, Any] = {}
+            try:
+                if stream:
+                    content_parts = []
+                    # Tool calls arrive in fragments, keyed by their index in the turn
+                    call_parts: Dict[int, Dict[str, Any]] = {}
                     
-                    # Check if we should continue with the tool result
-                    if tool_result and not tool_result.startswith("Error:"):
-                        # Add the tool result to messages and get a new response
-                        tool_messages = [
-                            {"role": "function", "name": tool_name, "content": tool_result}
-                        ]
+                    async for chunk in self.deepseek_wrapper.stream_completion(
+                        messages=messages,
+                        functions=self.tool_descriptions,
+                        temperature=0.7,
+                        max_tokens=max_tokens,
+                        request_id=request_id,
+                        timeout=timeout,
+                    ):
+                        usage = chunk.get("usage") or usage
+                        choices = chunk.get("choices") or [{}]
+                        delta = choices[0].get("delta") or {}
                         
-                        # Get all the previous messages
-                        previous_messages = response.get("choices", [{}])[0].get("message", {}).get("previous_messages", [])
+                        if delta.get("content"):
+                            content_parts.append(delta["content"])
+                            yield {"type": "token", "content": delta["content"]}
                         
-                        # Combine previous messages with function call result
-                        new_messages = previous_messages + tool_messages
-                        
-                        # Get a new response from DeepSeek with function result included
-                        try:
-                            logger.info(f"Request {request_id}: Getting new response after tool call")
-                            new_response = await self.deepseek_wrapper.generate_completion(
-                                messages=new_messages,
-                                functions=self.tool_descriptions,
-                                use_cache=False,  # Don't cache agent responses with tool calls
-                                request_id=request_id,
-                                timeout=90,  # 90 second timeout for follow-up requests
-                            )
-                            
-                            # Process any additional function calls recursively
-                            result = await self._process_function_calls(new_response, request_id)
-                            
-                            # Combine tool calls
-                            result["tool_calls"] = tool_calls + result.get("tool_calls", [])
-                            
-                            return result
-                        except Exception as api_error:
-                            logger.error(f"API error after tool call in request {request_id}: {str(api_error)}", exc_info=True)
-                            # Return a response with just the tool result
-                            text_response = self.deepseek_wrapper.extract_text_from_response(response)
-                            return {
-                                "response": f"{text_response}\n\nI encountered an error while processing the tool result. Here's what I found: {tool_result}",
-                                "tool_calls": tool_calls
-                            }
-                    else:
-                        # If there was an error with the tool, just continue with the original response
-                        text_response = self.deepseek_wrapper.extract_text_from_response(response)
-                        return {
-                            "response": f"{text_response}\n\n{tool_result}",
-                            "tool_calls": tool_calls
-                        }
+                        # A legacy function call streams like a single tool call
+                        tool_deltas = delta.get("tool_calls") or []
+                        if delta.get("function_call"):
+                            tool_deltas = [{"index": 0, "function": delta["function_call"]}]
+                        for tool_delta in tool_deltas:
+                            part = call_parts.setdefault(tool_delta.get("index", 0), {"id": None, "name": "", "arguments": []})
+                            if tool_delta.get("id"):
+                                part["id"] = tool_delta["id"]
+                            function_delta = tool_delta.get("function") or {}
+                            part["name"] += function_delta.get("name") or ""
+                            part["arguments"].append(function_delta.get("arguments") or "")
                     
-                except Exception as e:
-                    import traceback
-                    error_msg = f"Error processing function call: {str(e)}\n{traceback.format_exc()}"
-                    logger.error(error_msg)
-                    
-                    # If there's an error processing the function call, return the original response
-                    # with the error message
-                    text_response = self.deepseek_wrapper.extract_text_from_response(response)
-                    return {
-                        "response": f"{text_response}\n\nAn error occurred while processing a tool: {str(e)}. Let me continue without using the tool.",
-                        "tool_calls": tool_calls
-                    }
+                    text = "".join(content_parts)
+                    calls = [
+                        {
+                            "id": part["id"] or f"call_{uuid.uuid4().hex[:24]}",
+                            "type": "function",
+                            "function": {"name": part["name"], "arguments": "".join(part["arguments"]) or "{}"},
+                        }
+                        for _, part in sorted(call_parts.items())
+                        if part["name"]
+                    ]
+                else:
+                    response = await self.deepseek_wrapper.generate_completion(
+                        messages=messages,
+                        functions=self.tool_descriptions,
+                        temperature=0.7,
+                        max_tokens=max_tokens,
+                        use_cache=first_step,  # Don't cache agent responses with tool calls
+                        request_id=request_id,
+                        timeout=timeout,
+                    )
+                    usage = response.get("usage") or {}
+                    similarity = similarity or response.get("similarity")
+                    text = self.deepseek_wrapper.extract_text_from_response(response) or ""
+                    calls = self.deepseek_wrapper.extract_tool_calls(response)
+            except Exception as api_error:
+                if first_step:
+                    raise
+                logger.error(f"API error after tool call in request {request_id}: {str(api_error)}", exc_info=True)
+                run.stop_reason = STOP_ERROR
+                response_text = self._partial_answer(partial_text, partial_results, STOP_ERROR)
+                if stream:
+                    yield {"type": "token", "content": response_text[len(partial_text):]}
+                break
             
-            # If no function call, just extract the text response
-            text_response = self.deepseek_wrapper.extract_text_from_response(response)
-            return {
-                "response": text_response,
-                "tool_calls": tool_calls
-            }
-        except Exception as e:
-            import traceback
-            error_msg = f"Unexpected error in _process_function_calls: {str(e)}\n{traceback.format_exc()}"
-            logger.error(error_msg)
+            model_seconds = time.monotonic() - step_started
+            prompt_tokens = usage.get("prompt_tokens") or prompt_estimate
+            completion_tokens = usage.get("completion_tokens") or (
+                estimator.count(text) + (estimator.count(fastjson.dumps(calls)) if calls else 0)
+            )
             
-            # Return a fallback response in case of any unexpected exceptions
-            try:
-                # Try to extract at least the text response
-                text_response = self.deepseek_wrapper.extract_text_from_response(response)
-                return {
-                    "response": f"{text_response}\n\nI encountered an unexpected error while processing your request. Let me try to continue our conversation without using additional tools.",
-                    "tool_calls": []
-                }
-            except:
-                # If even that fails, return a generic response
-                return {
-                    "response": "I encountered an unexpected error while processing your request. Please try again with a simpler query.",
-                    "tool_calls": []
-                }
+            if not calls:
+                run.record_step(model_seconds, 0.0, prompt_tokens, completion_tokens, [])
+                run.stop_reason = STOP_ANSWERED
+                response_text = text
+                break
+            
+            for call in calls:
+                tool_name, arguments = self._tool_call_args(call)
+                yield {"type": "tool_call", "tool": tool_name, "args": arguments}
+            
+            tools_started = time.monotonic()
+            turn_calls = await self._run_tool_calls(calls, request_id, timeout=run.timeout(TOOL_TIMEOUT))
+            run.record_step(
+                model_seconds,
+                time.monotonic() - tools_started,
+                prompt_tokens,
+                completion_tokens,
+                [call["tool"] for call in turn_calls],
+            )
+            tool_calls.extend(turn_calls)
+            for call in turn_calls:
+                yield {"type": "tool_result", "tool": call["tool"], "result": call["result"]}
+            
+            if all(self._tool_failed(call) for call in turn_calls):
+                # Nothing to continue with: surface the errors and stop
+                run.stop_reason = STOP_TOOL_ERRORS
+                suffix = "\n\n" + "\n\n".join(str(call["result"]) for call in turn_calls)
+                response_text = text + suffix
+                if stream:
+                    yield {"type": "token", "content": suffix}
+                break
+            
+            partial_text = text
+            partial_results = [call for call in turn_calls if not self._tool_failed(call)]
+            
+            # Continue with all the tool results of the turn; the prompt extends the
+            # previous one so it shares its cached prefix
+            messages = self.token_budget.apply(
+                messages + self._tool_messages(text, calls, turn_calls),
+                self.tool_descriptions,
+                request_id,
+            )
+        
+        yield {"type": "answer", "response": response_text, "tool_calls": tool_calls, "similarity": similarity}
+    
+    @staticmethod
+    def _record_run(run: AgentRun, request_id: str, stream: str) -> None:
+        logger.info(
+            f"Request {request_id} completed in {run.elapsed():.2f}s "
+            f"({len(run.steps)} steps, {run.tokens_used} tokens, {run.stop_reason})"
+        )
+        metrics.AGENT_ITERATIONS.observe(len(run.steps), stream=stream)
+        metrics.AGENT_STOPS.inc(reason=run.stop_reason, stream=stream)
+    
+    def _build_messages(
+        self,
+        query: str,
+        history: List[Dict[str, str]],
+        request_id: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Build the API message list from the system prompt, history and query, within the token budget.
+        
+        The order runs from the most to the least stable part (system prompt,
+        then history oldest first, then the query), so consecutive requests of
+        a session share the longest possible prompt prefix with DeepSeek's cache.
+        """
+        messages = [{"role": "system", "content": self.system_prompt}]
+        
+        # Add chat history
+        messages.extend(history)
+        
+        # Add current query
+        messages.append({"role": "user", "content": query})
+        
+        return self.token_budget.apply(messages, self.tool_descriptions, request_id)
     
     async def process_query(
-        self, query: str, session_id: str
+        self, query: str, session_id: str, request_id: Optional[str] = None
     ) -> AgentResponse:
         """
         Process a user query with the agent.
@@ -329,84 +602,58 @@ async def process_query(
         Args:
             query: User's query
             session_id: Session identifier
+            request_id: Request ID chosen by the client (generated if not provided)
             
         Returns:
             Structured agent response
         """
         # Generate a unique request ID for tracking
-        request_id = f"req_{uuid.uuid4().hex[:10]}"
+        request_id = request_id or f"req_{uuid.uuid4().hex[:10]}"
         logger.info(f"Processing query for session {session_id}, request {request_id}")
+        final_status, final_error = COMPLETED, None
         
         try:
-            # Register this request as active
-            ACTIVE_REQUESTS[request_id] = {
-                "session_id": session_id,
-                "start_time": time.time(),
-                "status": "processing",
-                "agent": self,
-            }
+            # Register this request as active; cancelling it cancels this task
+            await self.request_registry.register(request_id, session_id)
             
-            # Get conversation history
-            chat_history = self.memory.load_memory_variables({}).get("chat_history", [])
+            # Prepare messages with conversation history
+            history = await self.session_store.load(session_id, max_messages=self.memory_window_size * 2)
+            messages = self._build_messages(query, history, request_id)
             
-            # Prepare messages
-            messages = [{"role": "system", "content": self.system_prompt}]
-            
-            # Add chat history
-            for message in chat_history:
-                if isinstance(message, HumanMessage):
-                    messages.append({"role": "user", "content": message.content})
-                else:
-                    messages.append({"role": "assistant", "content": message.content})
-            
-            # Add current query
-            messages.append({"role": "user", "content": query})
-            
-            # Start time for metrics
-            start_time = time.time()
+            # Steps, time and tokens of this query, within the run limits
+            run = self.run_limits.start()
             
             logger.info(f"Request {request_id}: Sending to API with {len(messages)} messages")
             
             try:
-                # Make API call with functions
-                response = await self.deepseek_wrapper.generate_completion(
-                    messages=messages,
-                    functions=self.tool_descriptions,
-                    temperature=0.7,
-                    max_tokens=1024,
-                    request_id=request_id,
-                    timeout=120,  # Increased timeout to 120 seconds for initial request
-                )
-                
-                logger.info(f"Request {request_id}: Received API response")
-                
-                # Process any function calls and get the final response
-                processed_response = await self._process_function_calls(response, request_id)
+                # Call the model and the tools it asks for until it answers or a limit is reached
+                answer = {}
+                async for event in self._run_steps(messages, run, request_id):
+                    if event["type"] == "answer":
+                        answer = event
                 
-                # Calculate response time
-                response_time = time.time() - start_time
-                logger.info(f"Request {request_id} completed in {response_time:.2f}s")
+                self._record_run(run, request_id, stream="false")
                 
                 # Update memory
-                self.memory.save_context(
-                    {"input": query},
-                    {"output": processed_response["response"]}
-                )
-                
-                # Update request status
-                if request_id in ACTIVE_REQUESTS:
-                    ACTIVE_REQUESTS[request_id]["status"] = "completed"
+                await self.session_store.append(session_id, [
+                    {"role": "user", "content": query},
+                    {"role": "assistant", "content": answer["response"]},
+                ])
                 
                 # Return structured response
                 return AgentResponse(
-                    response=processed_response["response"],
+                    response=answer["response"],
                     session_id=session_id,
-                    tool_calls=processed_response.get("tool_calls", []),
+                    tool_calls=answer["tool_calls"],
                     thoughts=None,  # DeepSeek doesn't expose reasoning steps
-                    request_id=request_id
+                    request_id=request_id,
+                    steps=run.steps,
+                    stop_reason=run.stop_reason,
+                    similarity=answer["similarity"],
                 )
             except Exception as api_error:
                 logger.error(f"API error in request {request_id}: {str(api_error)}", exc_info=True)
+                final_status, final_error = ERROR, str(api_error)
                 # Try to recover with a simpler response
                 return AgentResponse(
                     response=f"I encountered an error while processing your request: {str(api_error)}. Please try a simpler query or try again later.",
@@ -418,9 +665,14 @@ async def process_query(
             
         except asyncio.CancelledError:
             logger.warning(f"Request {request_id} was cancelled")
-            # Update request status
-            if request_id in ACTIVE_REQUESTS:
-                ACTIVE_REQUESTS[request_id]["status"] = "cancelled"
+            final_status = CANCELLED
+            if not self.request_registry.cancel_requested(request_id):
+                # Shutdown or a client disconnect, not /cancel: let it propagate
+                raise
+            # The cancel is answered here, so the request task carries on normally
+            task = asyncio.current_task()
+            if task is not None and hasattr(task, "uncancel"):
+                task.uncancel()
             return AgentResponse(
                 response="I apologize, but your request was cancelled. Please try again.",
                 session_id=session_id,
@@ -431,10 +683,7 @@ async def process_query(
             
         except Exception as e:
             logger.error(f"Error processing request {request_id}: {str(e)}", exc_info=True)
-            # Update request status
-            if request_id in ACTIVE_REQUESTS:
-                ACTIVE_REQUESTS[request_id]["status"] = "error"
-                ACTIVE_REQUESTS[request_id]["error"] = str(e)
+            final_status, final_error = ERROR, str(e)
             return AgentResponse(
                 response=f"I apologize, but I encountered an error while processing your request. Please try again with a simpler query.",
                 session_id=session_id,
@@ -444,33 +693,83 @@ async def process_query(
             )
             
         finally:
-            # Clean up regardless of outcome
-            if request_id in ACTIVE_REQUESTS:
-                # Keep it for a while for status checks but mark as done
-                if ACTIVE_REQUESTS[request_id].get("status") == "processing":
-                    ACTIVE_REQUESTS[request_id]["status"] = "completed"
-                # Schedule removal after 5 minutes to avoid memory leaks
-                asyncio.create_task(self._delayed_request_cleanup(request_id, 300))
+            # Keep the final status for a while for status checks
+            await self.request_registry.finish(request_id, final_status, final_error)
 
-    async def _delayed_request_cleanup(self, request_id: str, delay_seconds: int):
+    async def process_query_stream(
+        self, query: str, session_id: str, request_id: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
         """
-        Removes request data from memory after a delay.
+        Process a user query with the agent, streaming events as they happen.
         
         Args:
-            request_id: The request ID to clean up
-            delay_seconds: Number of seconds to wait before cleanup
+            query: User's query
+            session_id: Session identifier
+            request_id: Request ID chosen by the client (generated if not provided)
+            
+        Yields:
+            Event dictionaries with a ``type`` of ``start``, ``token``,
+            ``tool_call``, ``tool_result``, ``done`` or ``error``
         """
+        request_id = request_id or f"req_{uuid.uuid4().hex[:10]}"
+        logger.info(f"Streaming query for session {session_id}, request {request_id}")
+        final_status, final_error = COMPLETED, None
+        
+        # The consuming task is the one a cancel cancels
+        await self.request_registry.register(request_id, session_id)
+        
         try:
-            await asyncio.sleep(delay_seconds)
-            if request_id in ACTIVE_REQUESTS:
-                del ACTIVE_REQUESTS[request_id]
-                logger.debug(f"Cleaned up request {request_id} after {delay_seconds}s")
+            yield {"type": "start", "request_id": request_id, "session_id": session_id}
+            
+            history = await self.session_store.load(session_id, max_messages=self.memory_window_size * 2)
+            messages = self._build_messages(query, history, request_id)
+            run = self.run_limits.start()
+            
+            answer = {}
+            async for event in self._run_steps(messages, run, request_id, stream=True):
+                if event["type"] == "answer":
+                    answer = event
+                else:
+                    yield event
+            response_text = answer["response"]
+            
+            self._record_run(run, request_id, stream="true")
+            
+            await self.session_store.append(session_id, [
+                {"role": "user", "content": query},
+                {"role": "assistant", "content": response_text},
+            ])
+            
+            yield {
+                "type": "done",
+                "request_id": request_id,
+                "session_id": session_id,
+                "response": response_text,
+                "tool_calls": answer["tool_calls"],
+                "steps": run.steps,
+                "stop_reason": run.stop_reason,
+            }
+            
+        except asyncio.CancelledError:
+            logger.warning(f"Streaming request {request_id} was cancelled")
+            final_status = CANCELLED
+            raise
+            
         except Exception as e:
-            logger.error(f"Error cleaning up request {request_id}: {str(e)}")
+            logger.error(f"Error streaming request {request_id}: {str(e)}", exc_info=True)
+            final_status, final_error = ERROR, str(e)
+            yield {
+                "type": "error",
+                "request_id": request_id,
+                "message": f"I encountered an error while processing your request: {str(e)}. Please try a simpler query or try again later.",
+            }
             
-    def cancel_request(self, request_id: str) -> bool:
+        finally:
+            await self.request_registry.finish(request_id, final_status, final_error)
+
+    async def cancel_request(self, request_id: str) -> bool:
         """
-        Cancel an ongoing request.
+        Cancel an ongoing request, in whichever worker it runs.
         
         Args:
             request_id: The request ID to cancel
@@ -478,23 +777,28 @@ def cancel_request(self, request_id: str) -> bool:
         Returns:
             True if request was found and cancelled, False otherwise
         """
-        if request_id in ACTIVE_REQUESTS:
-            # Get the agent instance
-            agent_data = ACTIVE_REQUESTS[request_id]
-            if agent_data.get("status") == "processing":
-                # Update status
-                ACTIVE_REQUESTS[request_id]["status"] = "cancelling"
-                
-                # Cancel the request in the DeepSeek wrapper
-                if hasattr(self.deepseek_wrapper, "cancel_request"):
-                    self.deepseek_wrapper.cancel_request(request_id)
-                    logger.info(f"Cancelled request {request_id}")
-                    return True
-                    
-        return False
+        cancelled = await self.request_registry.cancel(request_id)
+        if cancelled:
+            logger.info(f"Cancelled request {request_id}")
+            metrics.CANCELLATIONS.inc()
+        return cancelled
 
-    @staticmethod
-    def get_request_status(request_id: str) -> Optional[Dict[str, Any]]:
+    def report_similarity_false_hit(self, entry_id: str) -> bool:
+        """
+        Report that an answer served from the similarity cache was wrong.
+        
+        Args:
+            entry_id: ``entry_id`` from the ``similarity`` field of the response
+            
+        Returns:
+            True if the entry was found and dropped
+        """
+        reported = self.deepseek_wrapper.report_similarity_false_hit(entry_id)
+        if reported:
+            logger.info(f"Similarity cache entry {entry_id} reported as a false hit")
+        return reported
+
+    async def get_request_status(self, request_id: str) -> Optional[Dict[str, Any]]:
         """
         Get the status of a request.
         
@@ -504,10 +808,4 @@ def get_request_status(request_id: str) -> Optional[Dict[str, Any]]:
         Returns:
             Status information or None if request not found
         """
-        if request_id in ACTIVE_REQUESTS:
-            status_data = ACTIVE_REQUESTS[request_id].copy()
-            # Remove the agent reference to avoid serialization issues
-            if "agent" in status_data:
-                del status_data["agent"]
-            return status_data
-        return None 
\ No newline at end of file
+        return await self.request_registry.get(request_id)
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from app.cache.memory import LRUCache
+from app.cache.pubsub import listen_forever
+from app.cache.redis import RedisClient
+
+logger = logging.getLogger('request_registry')
+
+# Redis hash per request, and the channel cancellations are broadcast on
+REQUEST_KEY_PREFIX = "agent:request:"
+CANCEL_CHANNEL = "agent:request:cancel"
+
+# Request statuses
+PROCESSING = "processing"
+CANCELLING = "cancelling"
+CANCELLED = "cancelled"
+COMPLETED = "completed"
+ERROR = "error"
+
+
+class RequestRegistry:
+    """
+    Status and cancellation of agent requests across uvicorn workers.
+
+    The worker running a request registers the task doing the work. The
+    request's status (session, status, start time, owning worker, error) is
+    kept in a Redis hash that expires ``ttl`` seconds after the last update,
+    so any worker can report it. A cancel for a request owned by another
+    worker is published on a pub/sub channel that every worker listens on;
+    the owner cancels its task, which aborts the upstream call and frees its
+    connection and concurrency slot.
+
+    Without Redis the registry works for the requests of this worker only.
+    """
+
+    def __init__(self, redis_client: Optional[RedisClient] = None, ttl: int = 300):
+        """
+        Initialize the registry.
+
+        Args:
+            redis_client: Shared Redis client (None for a worker-local registry)
+            ttl: Seconds a finished request's status stays available
+        """
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+        # Tasks of the requests running in this worker
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # Status of this worker's requests; kept until their TTL passes
+        self._local = LRUCache(max_entries=10000, max_bytes=None, sizer=lambda value: 0)
+        self._listener_task: Optional[asyncio.Task] = None
+
+        self.stats: Dict[str, int] = {
+            "registered": 0,
+            "cancelled_local": 0,
+            "cancels_published": 0,
+            "cancels_received": 0,
+            "redis_errors": 0,
+        }
+
+    @staticmethod
+    def _key(request_id: str) -> str:
+        return f"{REQUEST_KEY_PREFIX}{request_id}"
+
+    @property
+    def active_count(self) -> int:
+        """Requests of this worker still running."""
+        return sum(1 for task in self._tasks.values() if not task.done())
+
+    async def register(self, request_id: str, session_id: str, task: Optional[asyncio.Task] = None) -> None:
+        """
+        Record a new request and the task that cancelling it should cancel.
+
+        Args:
+            request_id: Request ID
+            session_id: Session the request belongs to
+            task: Task doing the work (defaults to the current task)
+        """
+        task = task or asyncio.current_task()
+        if task is not None:
+            self._tasks[request_id] = task
+        self.stats["registered"] += 1
+        status = {
+            "session_id": session_id,
+            "status": PROCESSING,
+            "start_time": time.time(),
+            "worker": self.worker_id,
+        }
+        # No TTL while running; the TTL starts when the request finishes
+        self._local.set(request_id, status, ttl=None)
+        await self._write(request_id, status)
+
+    async def finish(self, request_id: str, status: str, error: Optional[str] = None) -> None:
+        """
+        Record the final status of a request and forget its task.
+
+        Args:
+            request_id: Request ID
+            status: "completed", "cancelled" or "error"
+            error: Error message, for failed requests
+        """
+        self._tasks.pop(request_id, None)
+        entry = dict(self._local.get(request_id) or {})
+        entry["status"] = status
+        if error:
+            entry["error"] = error
+        self._local.set(request_id, entry, ttl=self.ttl)
+        update = {"status": status}
+        if error:
+            update["error"] = error
+        await self._write(request_id, update)
+
+    async def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the status of a request run by any worker.
+
+        Returns:
+            Status fields (session_id, status, start_time, worker, error), or None if unknown
+        """
+        entry = self._local.get(request_id)
+        if entry is not None:
+            return dict(entry)
+        return await self._read(request_id)
+
+    async def _read(self, request_id: str) -> Optional[Dict[str, Any]]:
+        if not self.redis_client:
+            return None
+        try:
+            data = await self.redis_client.redis.hgetall(self._key(request_id))
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Could not read status of request {request_id}: {str(e)}")
+            return None
+        if not data:
+            return None
+        status = {
+            (k.decode("utf-8") if isinstance(k, bytes) else k): (v.decode("utf-8") if isinstance(v, bytes) else v)
+            for k, v in data.items()
+        }
+        if "start_time" in status:
+            status["start_time"] = float(status["start_time"])
+        return status
+
+    async def cancel(self, request_id: str) -> bool:
+        """
+        Cancel a request, wherever it runs.
+
+        Returns:
+            True if the request was running and the cancel was delivered to its worker
+        """
+        if self._cancel_local(request_id):
+            return True
+
+        status = await self.get(request_id)
+        if not status or status.get("status") != PROCESSING or not self.redis_client:
+            return False
+        try:
+            await self._write(request_id, {"status": CANCELLING})
+            receivers = await self.redis_client.publish(CANCEL_CHANNEL, request_id)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Could not publish cancel for request {request_id}: {str(e)}")
+            return False
+        self.stats["cancels_published"] += 1
+        logger.info(f"Published cancel for request {request_id} (owned by worker {status.get('worker')})")
+        return receivers > 0
+
+    def cancel_requested(self, request_id: str) -> bool:
+        """Whether this registry cancelled the task of a request (as opposed to a shutdown or disconnect)."""
+        entry = self._local.get(request_id)
+        return entry is not None and entry.get("status") == CANCELLING
+
+    def _cancel_local(self, request_id: str) -> bool:
+        task = self._tasks.get(request_id)
+        if task is None or task.done():
+            return False
+        entry = self._local.get(request_id)
+        if entry is not None:
+            entry["status"] = CANCELLING
+        logger.info(f"Cancelling request {request_id}")
+        task.cancel()
+        self.stats["cancelled_local"] += 1
+        return True
+
+    async def _write(self, request_id: str, fields: Dict[str, Any]) -> None:
+        if not self.redis_client:
+            return
+        key = self._key(request_id)
+        try:
+            pipe = self.redis_client.redis.pipeline(transaction=False)
+            pipe.hset(key, mapping={k: str(v) for k, v in fields.items()})
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Could not write status of request {request_id}: {str(e)}")
+
+    async def start(self) -> None:
+        """Start listening for cancels published by other workers."""
+        if self.redis_client and self._listener_task is None:
+            self._listener_task = asyncio.create_task(
+                listen_forever(self.redis_client, CANCEL_CHANNEL, self._receive_cancel, self._resync)
+            )
+
+    async def stop(self) -> None:
+        """Stop the cancel listener."""
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+    def _receive_cancel(self, request_id: str) -> None:
+        if self._cancel_local(request_id):
+            self.stats["cancels_received"] += 1
+
+    async def _resync(self) -> None:
+        # Cancels published while the listener was down are lost, but they
+        # left the request's status at "cancelling" in Redis
+        for request_id, task in list(self._tasks.items()):
+            if task.done():
+                continue
+            status = await self._read(request_id)
+            if status and status.get("status") == CANCELLING:
+                self._receive_cancel(request_id)
+
+
+# Worker-local registry for agents created without a shared one
+default_registry = RequestRegistry()
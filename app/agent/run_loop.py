@@ -0,0 +1,132 @@
+import time
+from typing import Any, Dict, List, Optional
+
+# Why an agent run stopped
+STOP_ANSWERED = "answered"
+STOP_TOOL_ERRORS = "tool_errors"
+STOP_MAX_STEPS = "max_steps"
+STOP_DEADLINE = "deadline"
+STOP_TOKEN_BUDGET = "token_budget"
+STOP_ERROR = "error"
+
+
+class RunLimits:
+    """
+    Limits on one agent run: every model call and tool call made to answer one query.
+
+    A step is one model call plus the tools it asked for. Before each step
+    after the first, the run checks the step count, the time left before its
+    deadline and the tokens it has used (prompt and completion tokens of all
+    earlier steps, plus the estimated prompt of the next one). Once any limit
+    is reached the agent stops calling the model and answers with what it has.
+    Model and tool timeouts are shortened so no step runs past the deadline.
+    """
+
+    def __init__(
+        self,
+        max_steps: int = 5,
+        max_seconds: float = 180.0,
+        max_tokens: Optional[int] = 24000,
+        min_step_seconds: float = 5.0,
+    ):
+        """
+        Initialize the limits.
+
+        Args:
+            max_steps: Model calls allowed per run
+            max_seconds: Wall-clock deadline of a run, all steps included
+            max_tokens: Prompt plus completion tokens allowed per run (None for no cap)
+            min_step_seconds: Don't start another step with less time left than this
+        """
+        self.max_steps = max(1, max_steps)
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.min_step_seconds = min_step_seconds
+
+    def start(self) -> "AgentRun":
+        """Start the clock and the counters of a new run."""
+        return AgentRun(self)
+
+
+class AgentRun:
+    """Steps, time and tokens of one agent run, checked against its ``RunLimits``."""
+
+    def __init__(self, limits: RunLimits):
+        self.limits = limits
+        self.started = time.monotonic()
+        self.tokens_used = 0
+        self.steps: List[Dict[str, Any]] = []
+        self.stop_reason: Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining_time(self) -> float:
+        return max(self.limits.max_seconds - self.elapsed(), 0.0)
+
+    def timeout(self, seconds: float) -> float:
+        """Shorten a model or tool timeout so it ends by the deadline."""
+        return min(seconds, self.remaining_time())
+
+    def check(self, next_prompt_tokens: int = 0) -> Optional[str]:
+        """
+        Decide whether the next step may run.
+
+        The first step always runs; keeping its prompt small is the job of
+        the prompt ``TokenBudget``.
+
+        Args:
+            next_prompt_tokens: Estimated prompt tokens of the next model call
+
+        Returns:
+            The stop reason if a limit is reached, otherwise None
+        """
+        if not self.steps:
+            return None
+        if len(self.steps) >= self.limits.max_steps:
+            return STOP_MAX_STEPS
+        if self.remaining_time() < self.limits.min_step_seconds:
+            return STOP_DEADLINE
+        if self.limits.max_tokens is not None and self.tokens_used + next_prompt_tokens >= self.limits.max_tokens:
+            return STOP_TOKEN_BUDGET
+        return None
+
+    def completion_tokens(self, max_tokens: int, prompt_tokens: int) -> int:
+        """Cap the completion size of the next step by the tokens left in the run."""
+        if self.limits.max_tokens is None:
+            return max_tokens
+        left = self.limits.max_tokens - self.tokens_used - prompt_tokens
+        return max(1, min(max_tokens, left))
+
+    def record_step(
+        self,
+        model_seconds: float,
+        tool_seconds: float,
+        prompt_tokens: int,
+        completion_tokens: int,
+        tools: List[str],
+    ) -> Dict[str, Any]:
+        """
+        Record a finished step.
+
+        Args:
+            model_seconds: Time of the model call
+            tool_seconds: Time of the step's tool calls (run concurrently)
+            prompt_tokens: Prompt tokens of the model call
+            completion_tokens: Completion tokens of the model call
+            tools: Names of the tools the model called
+
+        Returns:
+            The step record (also appended to ``steps``)
+        """
+        self.tokens_used += prompt_tokens + completion_tokens
+        step = {
+            "step": len(self.steps) + 1,
+            "model_seconds": round(model_seconds, 3),
+            "tool_seconds": round(tool_seconds, 3),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tools": tools,
+        }
+        self.steps.append(step)
+        return step
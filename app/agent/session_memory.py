@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, Dict, List, Optional
+
+from app.cache.memory import LRUCache
+from app.cache.pubsub import listen_forever
+from app.cache.redis import RedisClient
+from app.deepseek.tokens import TokenEstimator, default_estimator
+
+logger = logging.getLogger('session_memory')
+
+# Redis list of encoded messages per session, and the channel L1 invalidations go out on
+SESSION_KEY_PREFIX = "session:history:"
+INVALIDATION_CHANNEL = "session:invalidate"
+
+
+class SessionStore:
+    """
+    Conversation history per session, shared by every request and worker.
+
+    Each session is a Redis list with one codec-encoded message per element:
+    a turn appends its messages (RPUSH), trims the list to ``max_messages``
+    (LTRIM) and refreshes the TTL in one pipelined round trip, so the history
+    is never rewritten as a whole. The same round trip reads the list back,
+    so this worker's L1 copy is the list as Redis holds it. Loading is one
+    round trip too (LRANGE plus the TTL refresh), and is skipped entirely
+    when this worker holds the session in its in-process LRU. Appends are
+    announced on a pub/sub channel so other workers drop their L1 copy;
+    since that message can be lost, L1 copies also expire after ``l1_ttl``
+    seconds, which bounds how stale a session read from L1 can be.
+
+    Messages carry their estimated token count, so loads can apply a token
+    cap (oldest messages dropped first) without re-estimating.
+
+    Without Redis the store keeps sessions in this worker only.
+    """
+
+    def __init__(
+        self,
+        redis_client: Optional[RedisClient] = None,
+        max_messages: int = 20,
+        max_tokens: Optional[int] = 4000,
+        ttl: int = 86400,
+        l1_ttl: float = 5.0,
+        l1_max_sessions: int = 1000,
+        l1_max_bytes: int = 16 * 1024 * 1024,
+        estimator: Optional[TokenEstimator] = None,
+    ):
+        """
+        Initialize the store.
+
+        Args:
+            redis_client: Shared Redis client (None for a worker-local store)
+            max_messages: Messages kept per session
+            max_tokens: Largest history returned by ``load`` (None for no cap)
+            ttl: Seconds an idle session is kept
+            l1_ttl: Seconds a session stays in the in-process tier (with Redis only)
+            l1_max_sessions: Sessions held in the in-process tier
+            l1_max_bytes: Size limit of the in-process tier
+            estimator: Token estimator (defaults to the deepseek-chat estimator)
+        """
+        self.redis_client = redis_client
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self.estimator = estimator or default_estimator
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+        # Without Redis the L1 is the only copy, so it keeps the full TTL
+        self._l1 = LRUCache(
+            max_entries=l1_max_sessions,
+            max_bytes=l1_max_bytes,
+            default_ttl=l1_ttl if redis_client else ttl,
+        )
+        self._listener_task: Optional[asyncio.Task] = None
+
+        self.stats: Dict[str, int] = {
+            "loads": 0,
+            "l1_hits": 0,
+            "appends": 0,
+            "invalidations": 0,
+            "redis_errors": 0,
+        }
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"{SESSION_KEY_PREFIX}{session_id}"
+
+    def _apply_caps(self, messages: List[Dict[str, Any]], max_messages: Optional[int]) -> List[Dict[str, Any]]:
+        limit = min(self.max_messages, max_messages) if max_messages is not None else self.max_messages
+        start = max(len(messages) - limit, 0) if limit > 0 else len(messages)
+        if self.max_tokens is not None:
+            total = sum(m.get("tokens", 0) for m in messages[start:])
+            while start < len(messages) and total > self.max_tokens:
+                total -= messages[start].get("tokens", 0)
+                start += 1
+        # Start at a user message, so no answer is sent without its question
+        while start < len(messages) and messages[start]["role"] != "user":
+            start += 1
+        return messages[start:]
+
+    @staticmethod
+    def _public(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+    async def load(self, session_id: str, max_messages: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        Get the recent history of a session, oldest message first.
+
+        Args:
+            session_id: Session identifier
+            max_messages: Return at most this many messages (capped by ``max_messages`` of the store)
+
+        Returns:
+            Messages with ``role`` and ``content``, within the window and token caps
+        """
+        self.stats["loads"] += 1
+        messages = self._l1.get(session_id)
+        if messages is not None:
+            self.stats["l1_hits"] += 1
+        elif self.redis_client:
+            key = self._key(session_id)
+            try:
+                pipe = self.redis_client.redis.pipeline(transaction=False)
+                pipe.lrange(key, -self.max_messages, -1)
+                pipe.expire(key, self.ttl)
+                items, _ = await pipe.execute()
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning(f"Could not load history of session {session_id}: {str(e)}")
+                return []
+            messages = self._decode(session_id, items)
+            if messages is None:
+                return []
+            if messages:
+                self._l1.set(session_id, messages)
+        else:
+            messages = []
+        return self._public(self._apply_caps(messages, max_messages))
+
+    async def append(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        """
+        Add the messages of a finished turn to a session.
+
+        Args:
+            session_id: Session identifier
+            messages: Messages with ``role`` and ``content``, oldest first
+        """
+        if not messages:
+            return
+        self.stats["appends"] += 1
+        entries = [
+            {"role": m["role"], "content": m.get("content") or "", "tokens": self.estimator.count_message(m)}
+            for m in messages
+        ]
+
+        if not self.redis_client:
+            cached = self._l1.get(session_id) or []
+            self._l1.set(session_id, (cached + entries)[-self.max_messages:])
+            return
+
+        key = self._key(session_id)
+        try:
+            pipe = self.redis_client.redis.pipeline(transaction=False)
+            pipe.rpush(key, *[self.redis_client.codec.encode(entry) for entry in entries])
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.ttl)
+            # Read the list back, with the turns other workers appended
+            pipe.lrange(key, -self.max_messages, -1)
+            pipe.publish(INVALIDATION_CHANNEL, f"{self.worker_id}:{session_id}")
+            _, _, _, items, _ = await pipe.execute()
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            # Drop the L1 copy so it cannot hold messages Redis never got
+            self._l1.delete(session_id)
+            logger.warning(f"Could not save history of session {session_id}: {str(e)}")
+            return
+        messages = self._decode(session_id, items)
+        if messages is None:
+            self._l1.delete(session_id)
+        else:
+            self._l1.set(session_id, messages)
+
+    def _decode(self, session_id: str, items: List[bytes]) -> Optional[List[Dict[str, Any]]]:
+        try:
+            return [self.redis_client.codec.decode(item) for item in items]
+        except Exception as e:
+            # Corrupt, or written with a codec this worker lacks: treat as a miss
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Could not decode history of session {session_id}: {str(e)}")
+            return None
+
+    async def clear(self, session_id: str) -> None:
+        """Delete the history of a session in every tier and worker."""
+        self._l1.delete(session_id)
+        if not self.redis_client:
+            return
+        try:
+            pipe = self.redis_client.redis.pipeline(transaction=False)
+            pipe.delete(self._key(session_id))
+            pipe.publish(INVALIDATION_CHANNEL, f"{self.worker_id}:{session_id}")
+            await pipe.execute()
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Could not clear history of session {session_id}: {str(e)}")
+
+    async def start(self) -> None:
+        """Start listening for session updates made by other workers."""
+        if self.redis_client and self._listener_task is None:
+            self._listener_task = asyncio.create_task(
+                listen_forever(self.redis_client, INVALIDATION_CHANNEL, self._invalidate, self._resync)
+            )
+
+    async def stop(self) -> None:
+        """Stop the invalidation listener."""
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+    def _invalidate(self, data: str) -> None:
+        worker_id, _, session_id = data.partition(":")
+        if worker_id != self.worker_id and self._l1.delete(session_id):
+            self.stats["invalidations"] += 1
+
+    async def _resync(self) -> None:
+        # Invalidations published while the listener was down are lost
+        self._l1.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the counters and the size of the in-process tier."""
+        return {
+            **self.stats,
+            "l1_sessions": len(self._l1),
+            "l1_bytes": self._l1.current_bytes,
+        }
+
+
+# Worker-local store for agents created without a shared one
+default_store = SessionStore()
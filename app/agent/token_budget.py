@@ -0,0 +1,141 @@
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from app import metrics
+from app.deepseek.tokens import TokenEstimator, default_estimator
+
+logger = logging.getLogger('token_budget')
+
+TRUNCATION_MARKER = "\n\n[... truncated {tokens} tokens ...]"
+_TRUNCATED = re.compile(r"\n\n\[\.\.\. truncated \d+ tokens \.\.\.\]$")
+
+
+class TokenBudget:
+    """
+    Keep the prompt of each DeepSeek request within a token budget.
+
+    The system prompt and the latest turn (the last user message and anything
+    after it, such as function calls and their results) are always kept.
+    Oversized tool results and oversized older messages are truncated first;
+    if the prompt is still over budget, the oldest history messages are
+    dropped until it fits. Only as a last resort, when the latest user message
+    alone does not fit, is it truncated to the space that is left.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int = 6000,
+        max_tool_result_tokens: int = 1500,
+        max_history_message_tokens: int = 1000,
+        estimator: Optional[TokenEstimator] = None,
+    ):
+        """
+        Initialize the budget.
+
+        Args:
+            max_prompt_tokens: Target size of the whole prompt, function schemas included
+            max_tool_result_tokens: Largest tool (function) result kept verbatim
+            max_history_message_tokens: Largest older message kept verbatim
+            estimator: Token estimator (defaults to the deepseek-chat estimator)
+        """
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_tool_result_tokens = max_tool_result_tokens
+        self.max_history_message_tokens = max_history_message_tokens
+        self.estimator = estimator or default_estimator
+
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "trimmed_requests": 0,
+            "tokens_saved": 0,
+            "messages_dropped": 0,
+            "messages_truncated": 0,
+        }
+
+    def _truncate_message(self, message: Dict[str, Any], max_tokens: int) -> Dict[str, Any]:
+        content = message.get("content")
+        # Already truncated by an earlier step: keep it as sent, so the prompt prefix stays stable
+        if not content or _TRUNCATED.search(content):
+            return message
+        tokens = self.estimator.count(content)
+        if tokens <= max_tokens:
+            return message
+        kept = self.estimator.truncate(content, max_tokens)
+        self.stats["messages_truncated"] += 1
+        return {
+            **message,
+            "content": kept + TRUNCATION_MARKER.format(tokens=tokens - self.estimator.count(kept)),
+        }
+
+    def apply(
+        self,
+        messages: List[Dict[str, Any]],
+        functions: Optional[List[Dict[str, Any]]] = None,
+        request_id: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Trim a message list to the budget.
+
+        Args:
+            messages: Messages about to be sent (not modified)
+            functions: Function schemas sent with them, counted against the budget
+            request_id: Request ID for logging
+
+        Returns:
+            The trimmed message list
+        """
+        self.stats["requests"] += 1
+        before = self.estimator.count_messages(messages, functions)
+
+        # Split into system prompt, older history and the latest turn
+        system = [m for m in messages[:1] if m.get("role") == "system"]
+        rest = messages[len(system):]
+        last_user = max((i for i, m in enumerate(rest) if m.get("role") == "user"), default=0)
+        history, latest = rest[:last_user], rest[last_user:]
+
+        history = [self._truncate_message(m, self.max_history_message_tokens) for m in history]
+        latest = [
+            self._truncate_message(m, self.max_tool_result_tokens) if m.get("role") in ("function", "tool") else m
+            for m in latest
+        ]
+
+        fixed = self.estimator.count_messages(system + latest, functions)
+        history_tokens = [self.estimator.count_message(m) for m in history]
+        dropped = 0
+        while history and fixed + sum(history_tokens) > self.max_prompt_tokens:
+            history.pop(0)
+            history_tokens.pop(0)
+            dropped += 1
+        # Never start the kept history with an orphaned assistant reply
+        while history and history[0].get("role") != "user":
+            history.pop(0)
+            history_tokens.pop(0)
+            dropped += 1
+
+        # Last resort: a pasted message bigger than the whole budget
+        if not history and fixed > self.max_prompt_tokens and latest and latest[0].get("role") == "user":
+            # Leave room for the message overhead, the truncation marker and the
+            # token or two that counts can shift by at the cut
+            overhead = self.estimator.count_message({"content": TRUNCATION_MARKER.format(tokens=0)}) + 2
+            room = self.max_prompt_tokens - (fixed - self.estimator.count_message(latest[0])) - overhead
+            latest = [self._truncate_message(latest[0], max(room, self.max_history_message_tokens))] + latest[1:]
+            fixed = self.estimator.count_messages(system + latest, functions)
+
+        trimmed = system + history + latest
+        after = fixed + sum(history_tokens)
+        saved = before - after
+        if saved > 0:
+            self.stats["trimmed_requests"] += 1
+            self.stats["tokens_saved"] += saved
+            self.stats["messages_dropped"] += dropped
+            metrics.PROMPT_TOKENS_TRIMMED.inc(saved)
+            logger.info(
+                f"Request {request_id}: prompt trimmed from ~{before} to ~{after} tokens "
+                f"(saved ~{saved}, dropped {dropped} messages)"
+            )
+        if after > self.max_prompt_tokens:
+            logger.warning(
+                f"Request {request_id}: prompt is ~{after} tokens even after trimming "
+                f"(budget {self.max_prompt_tokens})"
+            )
+        return trimmed
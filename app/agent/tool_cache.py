@@ -0,0 +1,145 @@
+import hashlib
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from app import fastjson, metrics
+from app.cache.memory import LRUCache
+from app.cache.redis import RedisClient
+
+logger = logging.getLogger('tool_cache')
+
+# Bump whenever the key layout changes so stale entries are never read
+TOOL_CACHE_KEY_PREFIX = "tool:v1:"
+
+
+def cache_policy(tool: Any, arguments: Dict[str, Any]) -> Optional[Tuple[int, str]]:
+    """
+    Get the TTL and data version a tool call may be cached under.
+
+    Tools opt in by defining ``cache_ttl`` (seconds) and
+    ``cache_version(arguments)``, which returns a key for the version of the
+    data the result depends on (a file mtime, a revision), or None when the
+    call must run every time (writes, random picks).
+
+    Returns:
+        (ttl, version), or None if the call is not cacheable
+    """
+    ttl = getattr(tool, "cache_ttl", None)
+    cache_version = getattr(tool, "cache_version", None)
+    if not ttl or not callable(cache_version):
+        return None
+    try:
+        version = cache_version(arguments)
+    except Exception as e:
+        logger.warning(f"Could not get the data version of tool '{getattr(tool, 'name', tool)}': {str(e)}")
+        return None
+    if version is None:
+        return None
+    return int(ttl), str(version)
+
+
+class ToolResultCache:
+    """
+    Results of deterministic tool calls, shared by every request.
+
+    A result is keyed by the tool, the version of the data it was computed
+    from and its canonical arguments (sorted keys, unset arguments left out),
+    so a change to the data is a new key rather than an invalidation. Results
+    are kept in an in-process LRU and, with Redis, for the other workers.
+    Only successful results are stored.
+    """
+
+    def __init__(
+        self,
+        redis_client: Optional[RedisClient] = None,
+        max_entries: int = 2000,
+        max_bytes: int = 16 * 1024 * 1024,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            redis_client: Shared Redis client (None for a worker-local cache)
+            max_entries: Results held in the in-process tier
+            max_bytes: Size limit of the in-process tier
+        """
+        self.redis_client = redis_client
+        self._l1 = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        # Counters per tool name
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def key(tool_name: str, version: str, arguments: Dict[str, Any]) -> str:
+        """Build the cache key of a tool call."""
+        canonical = fastjson.dumps({k: v for k, v in arguments.items() if v is not None}, sort_keys=True)
+        digest = hashlib.sha256(f"{version}\0{canonical}".encode("utf-8")).hexdigest()
+        return f"{TOOL_CACHE_KEY_PREFIX}{tool_name}:{digest}"
+
+    def _tool_stats(self, tool_name: str) -> Dict[str, int]:
+        return self.stats.setdefault(tool_name, {
+            "hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "redis_errors": 0,
+        })
+
+    async def get(self, tool_name: str, key: str, ttl: int) -> Optional[str]:
+        """
+        Look up a tool result (in-process first, then Redis).
+
+        Args:
+            tool_name: Tool name, for the per-tool counters
+            key: Key from ``key``
+            ttl: TTL of the tool, used when a Redis hit is copied in-process
+
+        Returns:
+            The cached result, or None on a miss
+        """
+        stats = self._tool_stats(tool_name)
+        value = self._l1.get(key)
+        if value is None and self.redis_client:
+            try:
+                value = await self.redis_client.get_value(key)
+            except Exception as e:
+                stats["redis_errors"] += 1
+                logger.warning(f"Could not read cached result of tool '{tool_name}': {str(e)}")
+            if value is not None:
+                stats["redis_hits"] += 1
+                self._l1.set(key, value, ttl=ttl)
+        if value is None:
+            stats["misses"] += 1
+            metrics.TOOL_CACHE_LOOKUPS.inc(tool=tool_name, result="miss")
+            return None
+        stats["hits"] += 1
+        metrics.TOOL_CACHE_LOOKUPS.inc(tool=tool_name, result="hit")
+        return value
+
+    async def set(self, tool_name: str, key: str, value: str, ttl: int) -> None:
+        """Store a tool result for ``ttl`` seconds."""
+        stats = self._tool_stats(tool_name)
+        stats["stores"] += 1
+        self._l1.set(key, value, ttl=ttl)
+        if not self.redis_client:
+            return
+        try:
+            await self.redis_client.set_value(key, value, expire=ttl)
+        except Exception as e:
+            stats["redis_errors"] += 1
+            logger.warning(f"Could not store result of tool '{tool_name}': {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the counters and hit rate of every tool, and the size of the in-process tier."""
+        tools = {}
+        for tool_name, stats in self.stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            tools[tool_name] = {**stats, "hit_rate": stats["hits"] / lookups if lookups else None}
+        return {
+            "tools": tools,
+            "l1_entries": len(self._l1),
+            "l1_bytes": self._l1.current_bytes,
+        }
+
+
+# Worker-local cache for agents created without a shared one
+default_tool_cache = ToolResultCache()
@@ -2,10 +2,11 @@
 Tools available for the DeepSeek AI Agent.
 """
 
-from typing import Dict, List, Type, Any, Optional
+from typing import Callable, Dict, List, Type, Any, Optional
 from pydantic import BaseModel, Field
-from langchain_core.tools import BaseTool, Tool
-import json
+from langchain_core.tools import BaseTool, StructuredTool, create_schema_from_function
+
+from app import fastjson
 
 # Import tools
 from app.agent.tools.brand_brief import BrandBriefTool
@@ -124,6 +125,17 @@ class ContentDatabaseInput(BaseModel):
     )
 
 
+class CachedTool(StructuredTool):
+    """A ``StructuredTool`` whose results the agent may cache (see ``app.agent.tool_cache``)."""
+    
+    cache_ttl: int = 600
+    version_func: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None
+    
+    def cache_version(self, arguments: Dict[str, Any]) -> Optional[str]:
+        """Return the data version for cached results, or None if this call must not be cached."""
+        return self.version_func(arguments) if self.version_func else None
+
+
 def create_content_database_tool():
     """Create a ContentDatabaseTool instance."""
     try:
@@ -138,20 +150,29 @@ def _run_tool(action: str, content_type: Optional[str] = None,
             try:
                 result = tool_instance.run(action, content_type, query, content_id, count)
                 # Convert result to string for the agent
-                return json.dumps(result, indent=2)
+                return fastjson.dumps(result, indent=True)
             except Exception as e:
                 import traceback
                 error_msg = f"Error running content_database tool: {str(e)}\n{traceback.format_exc()}"
                 print(error_msg)
-                return json.dumps({"error": error_msg, "status": "failed"}, indent=2)
+                return fastjson.dumps({"error": error_msg, "status": "failed"}, indent=True)
         
-        # Create a Tool instance instead of using a BaseTool class
-        return Tool(
+        def _data_version(arguments: Dict[str, Any]) -> Optional[str]:
+            """Lookups are cached until the database files change; random picks never are."""
+            if arguments.get("action") == "get_random":
+                return None
+            return tool_instance.data_version()
+        
+        # A structured tool, so the agent can pass the arguments as one dict
+        return CachedTool(
             name="content_database",
             description="""Search and retrieve branded content examples to inform your responses.
 Use this tool to find existing Tony Tech Insights content that matches user queries
 and adapt it to provide consistent, on-brand responses.""",
             func=_run_tool,
+            args_schema=create_schema_from_function("ContentDatabaseInput", _run_tool),
+            cache_ttl=600,
+            version_func=_data_version,
         )
         
     except Exception as e:
@@ -159,14 +180,16 @@ def _run_tool(action: str, content_type: Optional[str] = None,
         error_msg = f"Error initializing ContentDatabaseTool: {str(e)}\n{traceback.format_exc()}"
         print(error_msg)
         
-        # Create a dummy tool
-        def _dummy_tool(*args, **kwargs):
-            return json.dumps({"error": error_msg, "status": "failed"}, indent=2)
+        # Create a dummy tool taking the same arguments, so calls fail with the error above
+        def _dummy_tool(action: str, content_type: Optional[str] = None,
+                        query: Optional[str] = None, content_id: Optional[str] = None,
+                        count: Optional[int] = 1) -> str:
+            return fastjson.dumps({"error": error_msg, "status": "failed"}, indent=True)
         
-        return Tool(
+        return StructuredTool.from_function(
+            func=_dummy_tool,
             name="content_database",
             description="Content database tool (currently unavailable)",
-            func=_dummy_tool,
         )
 
 
@@ -113,6 +113,21 @@
 }
 
 
+# Version of BRAND_BRIEFS for cached tool results. The built-in briefs are the same
+# in every worker; a save or delete gives this worker's briefs a revision of their own.
+_BRIEF_REVISION = "builtin"
+
+
+def brief_revision() -> str:
+    """Return the revision of the brand briefs, which changes whenever a brief is saved or deleted."""
+    return _BRIEF_REVISION
+
+
+def _bump_brief_revision() -> None:
+    global _BRIEF_REVISION
+    _BRIEF_REVISION = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
 class BrandBriefInput(BaseModel):
     """Input for the brand brief tool."""
     
@@ -145,6 +160,15 @@ class BrandBriefTool(BaseTool):
     
     args_schema = BrandBriefInput
     
+    # Gets and lists are cached until the briefs change
+    cache_ttl: int = 3600
+    
+    def cache_version(self, arguments: Dict[str, Any]) -> Optional[str]:
+        """Return the data version for cached results, or None for operations that change the briefs."""
+        if arguments.get("operation") in ("get", "list"):
+            return brief_revision()
+        return None
+    
     def _run(self, operation: str, brief_name: Optional[str] = None, 
              content: Optional[Dict[str, Any]] = None) -> str:
         """Run the brand brief tool."""
@@ -208,6 +232,7 @@ def _save_brief(self, brief_name: Optional[str], content: Optional[Dict[str, Any
         
         # Save the brief
         BRAND_BRIEFS[brief_name] = content
+        _bump_brief_revision()
         
         return f"Brand brief '{brief_name}' saved successfully."
     
@@ -238,6 +263,7 @@ def _delete_brief(self, brief_name: Optional[str]) -> str:
             return f"Error: Brand brief '{brief_name}' not found."
         
         del BRAND_BRIEFS[brief_name]
+        _bump_brief_revision()
         return f"Brand brief '{brief_name}' deleted successfully."
 
 # Example Vietnamese brand brief
@@ -1,3 +1,4 @@
+import glob
 import json
 import os
 import sys
@@ -57,6 +58,22 @@ def __init__(self):
             print(f"Error initializing ContentDatabase: {e}")
             self.db = ContentDatabase()  # Will use fallback if import failed
     
+    def data_version(self) -> Optional[str]:
+        """
+        Return a key that changes whenever the database files change: their latest modification time.
+        
+        Returns:
+            The version key, or None if the database files cannot be found
+        """
+        base_path = getattr(self.db, "base_path", None)
+        if not base_path:
+            return None
+        paths = [os.path.join(base_path, "db_index.json")] + glob.glob(os.path.join(base_path, "content", "*.json"))
+        try:
+            return str(max(os.stat(path).st_mtime_ns for path in paths))
+        except OSError:
+            return None
+    
     @staticmethod
     def get_name() -> str:
         """Get the name of the tool."""
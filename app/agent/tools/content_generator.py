@@ -9,7 +9,7 @@
 
 from langchain_core.tools import BaseTool
 
-from app.agent.tools.brand_brief import BRAND_BRIEFS
+from app.agent.tools.brand_brief import BRAND_BRIEFS, brief_revision
 
 
 class ContentGeneratorInput(BaseModel):
@@ -92,6 +92,13 @@ class ContentGeneratorTool(BaseTool):
     
     args_schema = ContentGeneratorInput
     
+    # Instructions depend only on the arguments and the brand brief
+    cache_ttl: int = 3600
+    
+    def cache_version(self, arguments: Dict[str, Any]) -> Optional[str]:
+        """Return the data version for cached results: the revision of the brand briefs."""
+        return brief_revision()
+    
     def _run(self, content_type: str, brief_name: str, topic: str, platform: Optional[str] = None,
             length: Optional[str] = "medium", keywords: Optional[List[str]] = None,
             call_to_action: Optional[str] = None, language: Optional[str] = "en",
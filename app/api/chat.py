@@ -5,65 +5,19 @@
 import random
 import time
 
-class handler(BaseHTTPRequestHandler):
+class RuleBasedResponder:
     """
-    Chat API endpoint handler.
-    This endpoint handles chat requests from the frontend and returns responses.
+    Rule-based content generator used when no language model is available.
+    Serves the serverless chat endpoint and the DeepSeek circuit-breaker fallback.
     """
     
-    def do_POST(self):
-        """Handle POST request to the chat endpoint."""
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        
-        # Get request body
-        content_length = int(self.headers.get('Content-Length', 0))
-        request_body = self.rfile.read(content_length).decode('utf-8')
-        
-        try:
-            # Parse JSON body
-            if request_body:
-                body = json.loads(request_body)
-                prompt = body.get("prompt", "")
-                session_id = body.get("session_id") or str(uuid.uuid4())
-            else:
-                prompt = "Empty request"
-                session_id = str(uuid.uuid4())
-            
-            # Check if this is a content template request
-            if "Generate a " in prompt and " about " in prompt:
-                response_text = self.generate_template_content(prompt)
-            else:
-                # Generate a meaningful response based on the prompt
-                response_text = self.generate_response(prompt)
-            
-            # Create response
-            response = {
-                "response": response_text,
-                "session_id": session_id,
-                "tool_calls": [],
-                "request_id": f"req_{uuid.uuid4().hex[:10]}"
-            }
-            
-            self.wfile.write(json.dumps(response).encode())
-            
-        except Exception as e:
-            # Handle errors
-            error_response = {
-                "status": "error",
-                "message": str(e)
-            }
-            self.wfile.write(json.dumps(error_response).encode())
-    
-    def do_OPTIONS(self):
-        """Handle OPTIONS request for CORS preflight."""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+    def respond(self, prompt):
+        """Answer a prompt with template content or a canned topic response."""
+        # Check if this is a content template request
+        if "Generate a " in prompt and " about " in prompt:
+            return self.generate_template_content(prompt)
+        # Generate a meaningful response based on the prompt
+        return self.generate_response(prompt)
     
     def generate_template_content(self, prompt):
         """
@@ -477,4 +431,60 @@ def generate_response(self, prompt):
             "Looking for ways to leverage technology for your business? I can help with specific recommendations if you share more about your industry and goals."
         ]
         
-        return random.choice(general_responses) 
\ No newline at end of file
+        return random.choice(general_responses)
+
+
+class handler(RuleBasedResponder, BaseHTTPRequestHandler):
+    """
+    Chat API endpoint handler.
+    This endpoint handles chat requests from the frontend and returns responses.
+    """
+    
+    def do_POST(self):
+        """Handle POST request to the chat endpoint."""
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        
+        # Get request body
+        content_length = int(self.headers.get('Content-Length', 0))
+        request_body = self.rfile.read(content_length).decode('utf-8')
+        
+        try:
+            # Parse JSON body
+            if request_body:
+                body = json.loads(request_body)
+                prompt = body.get("prompt", "")
+                session_id = body.get("session_id") or str(uuid.uuid4())
+            else:
+                prompt = "Empty request"
+                session_id = str(uuid.uuid4())
+            
+            response_text = self.respond(prompt)
+            
+            # Create response
+            response = {
+                "response": response_text,
+                "session_id": session_id,
+                "tool_calls": [],
+                "request_id": f"req_{uuid.uuid4().hex[:10]}"
+            }
+            
+            self.wfile.write(json.dumps(response).encode())
+            
+        except Exception as e:
+            # Handle errors
+            error_response = {
+                "status": "error",
+                "message": str(e)
+            }
+            self.wfile.write(json.dumps(error_response).encode())
+    
+    def do_OPTIONS(self):
+        """Handle OPTIONS request for CORS preflight."""
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.end_headers()
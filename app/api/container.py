@@ -0,0 +1,296 @@
+"""
+Objects shared by every request of a worker, built once at startup.
+
+The FastAPI lifespan starts one ``AppContainer`` per worker. It owns the
+pooled HTTP session and Redis client, the upstream resilience pieces (retry
+policy, concurrency limiter, circuit breaker, router), the request registry,
+the session store, and a single DeepSeek wrapper and agent. Requests only get
+a ``RequestContext``: the shared agent plus their own session and request IDs.
+"""
+import logging
+import os
+import time
+import uuid
+from typing import List, Optional
+
+from app import metrics
+from app.agent.agent import DeepSeekAgent
+from app.agent.registry import RequestRegistry
+from app.agent.run_loop import RunLimits
+from app.agent.session_memory import SessionStore
+from app.agent.token_budget import TokenBudget
+from app.agent.tool_cache import ToolResultCache
+from app.agent.tools import AVAILABLE_TOOLS
+from app.api.chat import RuleBasedResponder
+from app.cache.redis import RedisClient, ValueCodec
+from app.cache.similarity import SimilarityCache
+from app.deepseek.breaker import CircuitBreaker
+from app.deepseek.cassette import Cassette
+from app.deepseek.limiter import AdaptiveConcurrencyLimiter, RedisSemaphore
+from app.deepseek.retry import RetryPolicy
+from app.deepseek.router import UpstreamRouter
+from app.deepseek.wrapper import DeepSeekWrapper, create_http_session
+
+logger = logging.getLogger('app_container')
+
+
+def deepseek_api_keys() -> List[str]:
+    """API keys from DEEPSEEK_API_KEYS (comma-separated), or the single DEEPSEEK_API_KEY."""
+    keys = [key.strip() for key in os.getenv("DEEPSEEK_API_KEYS", "").split(",") if key.strip()]
+    return keys or [os.getenv("DEEPSEEK_API_KEY", "")]
+
+
+def is_mock_key(api_key: str) -> bool:
+    """Whether an API key is missing or a placeholder, so mock mode should be used."""
+    return not api_key or api_key.lower() in ("", "your_api_key_here", "none", "test")
+
+
+def create_redis_client() -> RedisClient:
+    """Create a Redis client from the REDIS_* environment variables."""
+    return RedisClient(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        db=int(os.getenv("REDIS_DB", "0")),
+        password=os.getenv("REDIS_PASSWORD"),
+        url=os.getenv("REDIS_URL"),
+        codec=ValueCodec(
+            serializer=os.getenv("CACHE_SERIALIZER", "msgpack"),
+            compression=os.getenv("CACHE_COMPRESSION", "zlib"),
+            compress_threshold=int(os.getenv("CACHE_COMPRESS_THRESHOLD", "512")),
+        ),
+    )
+
+
+class RequestContext:
+    """The shared agent plus the IDs of one request."""
+
+    __slots__ = ("agent", "session_id", "request_id", "started_at")
+
+    def __init__(self, agent: DeepSeekAgent, session_id: str, request_id: str):
+        self.agent = agent
+        self.session_id = session_id
+        self.request_id = request_id
+        self.started_at = time.time()
+
+
+class AppContainer:
+    """
+    Long-lived objects of one worker, configured from environment variables.
+
+    Call ``start`` once at application startup and ``close`` at shutdown;
+    in between, ``request_context`` is all a request needs.
+    """
+
+    def __init__(self):
+        self.http_session = None
+        self.redis: Optional[RedisClient] = None
+        self.retry_policy: Optional[RetryPolicy] = None
+        self.request_registry: Optional[RequestRegistry] = None
+        self.session_store: Optional[SessionStore] = None
+        self.concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None
+        self.circuit_breaker: Optional[CircuitBreaker] = None
+        self.upstream_router: Optional[UpstreamRouter] = None
+        self.cassette: Optional[Cassette] = None
+        self.similarity_cache: Optional[SimilarityCache] = None
+        self.tool_cache: Optional[ToolResultCache] = None
+        self.wrapper: Optional[DeepSeekWrapper] = None
+        self.agent: Optional[DeepSeekAgent] = None
+
+    async def start(self) -> None:
+        """Open the connection pools and build the shared objects."""
+        self.http_session = create_http_session(
+            pool_size=int(os.getenv("DEEPSEEK_POOL_SIZE", "100")),
+            pool_size_per_host=int(os.getenv("DEEPSEEK_POOL_SIZE_PER_HOST", "20")),
+            dns_cache_ttl=int(os.getenv("DEEPSEEK_DNS_CACHE_TTL", "300")),
+            keepalive_timeout=float(os.getenv("DEEPSEEK_KEEPALIVE_TIMEOUT", "30")),
+        )
+        logger.info("DeepSeek HTTP connection pool started")
+
+        # One retry policy per worker so its attempt/retry counters cover every request
+        self.retry_policy = RetryPolicy(
+            max_attempts=int(os.getenv("DEEPSEEK_MAX_ATTEMPTS", "4")),
+            base_delay=float(os.getenv("DEEPSEEK_RETRY_BASE_DELAY", "0.25")),
+            max_delay=float(os.getenv("DEEPSEEK_RETRY_MAX_DELAY", "8")),
+        )
+        self.retry_policy.attempt_listeners.append(metrics.record_attempt)
+
+        # One pooled Redis client for the response cache and the state shared by all workers
+        if os.getenv("USE_REDIS", "true").lower() == "true":
+            try:
+                self.redis = create_redis_client()
+                await self.redis.redis.ping()
+            except Exception as e:
+                logger.warning(f"Redis connection error: {str(e)}. Proceeding without Redis.")
+                await self._close_redis()
+
+        # Request status and cancellation, shared across workers through Redis
+        self.request_registry = RequestRegistry(
+            self.redis,
+            ttl=int(os.getenv("REQUEST_STATUS_TTL", "300")),
+        )
+        await self.request_registry.start()
+
+        # Conversation history per session: in-process LRU in front of Redis lists
+        self.session_store = SessionStore(
+            self.redis,
+            max_messages=int(os.getenv("SESSION_MAX_MESSAGES", "20")),
+            max_tokens=int(os.getenv("SESSION_MAX_TOKENS", "4000")) or None,
+            ttl=int(os.getenv("SESSION_TTL", "86400")),
+            l1_ttl=float(os.getenv("SESSION_L1_TTL", "5")),
+        )
+        await self.session_store.start()
+
+        # Results of deterministic tools, shared across workers through Redis
+        self.tool_cache = ToolResultCache(
+            self.redis,
+            max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+        )
+
+        # Optionally cap concurrent upstream calls across all workers through Redis
+        shared_budget = None
+        shared_concurrency = int(os.getenv("DEEPSEEK_SHARED_CONCURRENCY", "0"))
+        if shared_concurrency and self.redis is not None:
+            shared_budget = RedisSemaphore(self.redis, "deepseek", shared_concurrency)
+
+        # One adaptive concurrency window per worker for all upstream calls
+        self.concurrency_limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=int(os.getenv("DEEPSEEK_CONCURRENCY_INITIAL", "10")),
+            max_limit=int(os.getenv("DEEPSEEK_CONCURRENCY_MAX", "100")),
+            latency_threshold=float(os.getenv("DEEPSEEK_LATENCY_THRESHOLD", "0")) or None,
+            max_queue=int(os.getenv("DEEPSEEK_MAX_QUEUE", "100")),
+            queue_timeout=float(os.getenv("DEEPSEEK_QUEUE_TIMEOUT", "30")),
+            shared_budget=shared_budget,
+        )
+        self.concurrency_limiter.queue_listeners.append(metrics.LIMITER_QUEUE_TIME.observe)
+
+        # One circuit breaker per worker; while open, requests get fallbacks instead of waiting on timeouts
+        self.circuit_breaker = CircuitBreaker(
+            failure_rate_threshold=float(os.getenv("BREAKER_FAILURE_RATE", "0.5")),
+            slow_call_rate_threshold=float(os.getenv("BREAKER_SLOW_CALL_RATE", "1.0")),
+            slow_call_duration=float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "30")) or None,
+            window_size=int(os.getenv("BREAKER_WINDOW_SIZE", "20")),
+            minimum_calls=int(os.getenv("BREAKER_MINIMUM_CALLS", "10")),
+            open_duration=float(os.getenv("BREAKER_OPEN_SECONDS", "30")),
+        )
+        self.circuit_breaker.state_listeners.append(metrics.record_circuit_transition)
+
+        # Every API key at every base URL is a target; calls go to the fastest healthy one
+        api_keys = deepseek_api_keys()
+        api_bases = [
+            base.strip()
+            for base in os.getenv("DEEPSEEK_API_BASES", os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")).split(",")
+            if base.strip()
+        ]
+        self.upstream_router = UpstreamRouter.from_keys(
+            api_bases,
+            api_keys,
+            strategy=os.getenv("DEEPSEEK_ROUTING_STRATEGY", "p2c"),
+            failure_threshold=int(os.getenv("DEEPSEEK_TARGET_FAILURE_THRESHOLD", "3")),
+            failure_cooldown=float(os.getenv("DEEPSEEK_TARGET_COOLDOWN", "30")),
+        )
+
+        # Optionally record DeepSeek traffic to a cassette, or replay one instead of calling the API
+        cassette_path = os.getenv("DEEPSEEK_CASSETTE")
+        if cassette_path:
+            self.cassette = Cassette(
+                cassette_path,
+                mode=os.getenv("DEEPSEEK_CASSETTE_MODE", "replay"),
+                timing=os.getenv("DEEPSEEK_CASSETTE_TIMING", "fast"),
+            )
+            logger.info(f"DeepSeek cassette {cassette_path} opened in {self.cassette.mode} mode")
+
+        # Near-duplicate prompt cache is opt-in and shared by all requests in this worker
+        if os.getenv("SIMILARITY_CACHE", "false").lower() == "true":
+            self.similarity_cache = SimilarityCache(
+                threshold=float(os.getenv("SIMILARITY_THRESHOLD", "0.9")),
+                ttl=int(os.getenv("CACHE_TTL", "3600")),
+            )
+
+        # Check if API key is valid, otherwise use mock mode
+        mock_mode = is_mock_key(api_keys[0])
+        if mock_mode:
+            logger.warning("No valid DEEPSEEK_API_KEY found. Using mock mode.")
+
+        # One wrapper per worker, so its L1 cache and request coalescing span all requests
+        self.wrapper = DeepSeekWrapper(
+            api_key=api_keys[0],
+            api_base=api_bases[0] if api_bases else "https://api.deepseek.com/v1",
+            model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+            redis_client=self.redis,
+            cache_ttl=int(os.getenv("CACHE_TTL", "3600")),
+            memory_cache_max_bytes=int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+            l1_cache_ttl=int(os.getenv("L1_CACHE_TTL", "300")),
+            cache_write_behind=os.getenv("CACHE_WRITE_BEHIND", "false").lower() == "true",
+            coalesce_across_workers=os.getenv("COALESCE_ACROSS_WORKERS", "false").lower() == "true",
+            mock_mode=mock_mode,
+            session=self.http_session,
+            similarity_cache=self.similarity_cache,
+            retry_policy=self.retry_policy,
+            concurrency_limiter=self.concurrency_limiter,
+            circuit_breaker=self.circuit_breaker,
+            fallback_chain=[f.strip() for f in os.getenv("DEEPSEEK_FALLBACKS", "stale_cache,rule_based").split(",") if f.strip()],
+            fallback_responder=RuleBasedResponder().respond,
+            stale_cache_ttl=int(os.getenv("STALE_CACHE_TTL", "86400")),
+            cassette=self.cassette,
+            router=self.upstream_router,
+        )
+        await self.wrapper.start()
+
+        # The agent keeps no per-request state, so one serves every request
+        self.agent = DeepSeekAgent(
+            deepseek_wrapper=self.wrapper,
+            tools=list(AVAILABLE_TOOLS.values()),
+            system_prompt=os.getenv("AGENT_SYSTEM_PROMPT"),
+            memory_window_size=int(os.getenv("MEMORY_WINDOW_SIZE", "5")),
+            token_budget=TokenBudget(
+                max_prompt_tokens=int(os.getenv("MAX_PROMPT_TOKENS", "6000")),
+                max_tool_result_tokens=int(os.getenv("MAX_TOOL_RESULT_TOKENS", "1500")),
+                max_history_message_tokens=int(os.getenv("MAX_HISTORY_MESSAGE_TOKENS", "1000")),
+            ),
+            request_registry=self.request_registry,
+            session_store=self.session_store,
+            max_parallel_tools=int(os.getenv("AGENT_MAX_PARALLEL_TOOLS", "4")),
+            run_limits=RunLimits(
+                max_steps=int(os.getenv("AGENT_MAX_STEPS", "5")),
+                max_seconds=float(os.getenv("AGENT_DEADLINE_SECONDS", "180")),
+                max_tokens=int(os.getenv("AGENT_MAX_RUN_TOKENS", "24000")) or None,
+            ),
+            tool_cache=self.tool_cache,
+        )
+
+    def request_context(self, session_id: Optional[str] = None, request_id: Optional[str] = None) -> RequestContext:
+        """
+        Get what one request needs to run.
+
+        Args:
+            session_id: Session ID from the client (generated if not provided)
+            request_id: Request ID from the client (generated if not provided)
+        """
+        return RequestContext(
+            self.agent,
+            session_id or str(uuid.uuid4()),
+            request_id or f"req_{uuid.uuid4().hex[:10]}",
+        )
+
+    async def close(self) -> None:
+        """Stop the listeners and close the connection pools."""
+        if self.wrapper is not None:
+            await self.wrapper.close()
+        if self.request_registry is not None:
+            await self.request_registry.stop()
+        if self.session_store is not None:
+            await self.session_store.stop()
+        if self.http_session is not None:
+            await self.http_session.close()
+        await self._close_redis()
+        if self.cassette is not None:
+            await self.cassette.close()
+        logger.info("DeepSeek HTTP connection pool closed")
+
+    async def _close_redis(self) -> None:
+        if self.redis is not None:
+            try:
+                await self.redis.close()
+            except Exception as e:
+                logger.warning(f"Error closing Redis connection: {str(e)}")
+            self.redis = None
@@ -5,12 +5,16 @@
 import uuid
 from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, File, UploadFile, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 import glob
 import time
 import sys
+from contextlib import asynccontextmanager
+
+from app import fastjson, metrics
+from app.api.responses import FastJSONResponse
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -23,10 +27,8 @@
 logger.info(f"Environment variables: {list(os.environ.keys())}")
 
 try:
-    from app.deepseek.wrapper import DeepSeekWrapper
-    from app.agent.agent import DeepSeekAgent, AgentResponse, ACTIVE_REQUESTS
-    from app.agent.tools import AVAILABLE_TOOLS
-    from app.cache.redis import RedisClient
+    from app.agent.agent import DeepSeekAgent, AgentResponse
+    from app.api.container import AppContainer, deepseek_api_keys, is_mock_key
     from app.api.test_endpoint import include_test_router
     
     logger.info("Successfully imported all modules")
@@ -35,10 +37,34 @@
     import traceback
     traceback.print_exc()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the shared objects of this worker (connection pools, wrapper, agent) for the lifetime of the app."""
+    app.state.container = AppContainer()
+    try:
+        await app.state.container.start()
+        yield
+    finally:
+        await app.state.container.close()
+
+
+def get_container(request: Request) -> AppContainer:
+    """Get the shared objects of this worker as a dependency."""
+    return request.app.state.container
+
+
+# Dependency for getting DeepSeek agent
+def get_agent(container: AppContainer = Depends(get_container)) -> DeepSeekAgent:
+    """Get the DeepSeek agent shared by all requests as a dependency."""
+    return container.agent
+
+
 app = FastAPI(
     title="DeepSeek AI Agent API",
     description="API for interacting with a DeepSeek-powered AI agent with tool capabilities",
     version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
 
 # Configure CORS - allow all origins for deployment
@@ -62,8 +88,7 @@
 async def root():
     """Root endpoint for health check."""
     try:
-        api_key = os.getenv("DEEPSEEK_API_KEY", "")
-        mock_mode = not api_key or api_key.lower() in ("", "your_api_key_here", "none", "test")
+        mock_mode = is_mock_key(deepseek_api_keys()[0])
         
         return {
             "status": "ok", 
@@ -79,11 +104,46 @@ async def root():
             "message": str(e)
         }
 
+@app.get("/upstream-status")
+async def upstream_status(container: AppContainer = Depends(get_container)):
+    """Circuit breaker state, concurrency window and per-target health for the DeepSeek upstream."""
+    breaker = container.circuit_breaker
+    limiter = container.concurrency_limiter
+    router = container.upstream_router
+    return {
+        "circuit_breaker": breaker.snapshot() if breaker else None,
+        "concurrency_limiter": limiter.snapshot() if limiter else None,
+        "router": router.snapshot() if router else None,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(container: AppContainer = Depends(get_container)):
+    """Latency histograms and counters of this worker in the Prometheus text format."""
+    breaker = container.circuit_breaker
+    if breaker is not None:
+        current = breaker.state
+        for state in ("closed", "open", "half_open"):
+            metrics.CIRCUIT_STATE.set(1 if state == current else 0, state=state)
+    limiter = container.concurrency_limiter
+    if limiter is not None:
+        metrics.CONCURRENCY_LIMIT.set(limiter.limit)
+        metrics.INFLIGHT_CALLS.set(limiter.in_flight)
+        metrics.QUEUED_CALLS.set(limiter.queue_length)
+    router = container.upstream_router
+    if router is not None:
+        metrics.record_router(router)
+    registry = container.request_registry
+    if registry is not None:
+        metrics.ACTIVE_AGENT_REQUESTS.set(registry.active_count)
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 # Models for request/response
 class ChatRequest(BaseModel):
     """Chat request model."""
     prompt: str = Field(..., description="User's prompt/query")
     session_id: Optional[str] = Field(None, description="Session ID (generated if not provided)")
+    request_id: Optional[str] = Field(None, description="Request ID for cancellation before the response arrives (generated if not provided)")
 
 
 class ChatResponse(BaseModel):
@@ -92,6 +152,9 @@ class ChatResponse(BaseModel):
     session_id: str = Field(..., description="Session ID for this conversation")
     tool_calls: List[Dict[str, Any]] = Field(default_factory=list, description="Tools called during response generation")
     request_id: Optional[str] = Field(None, description="Request ID for tracking and cancellation")
+    steps: List[Dict[str, Any]] = Field(default_factory=list, description="Timing and token usage of each agent step")
+    stop_reason: Optional[str] = Field(None, description="Why the agent stopped")
+    similarity: Optional[Dict[str, Any]] = Field(None, description="Entry ID and score if the answer came from the similarity cache")
 
 
 class CancelRequest(BaseModel):
@@ -105,6 +168,17 @@ class CancelResponse(BaseModel):
     message: str = Field(..., description="Status message about the cancellation")
 
 
+class FalseHitRequest(BaseModel):
+    """Report of a wrong answer served from the similarity cache."""
+    entry_id: str = Field(..., description="entry_id from the similarity field of the chat response")
+
+
+class FalseHitResponse(BaseModel):
+    """Response to a false-hit report."""
+    success: bool = Field(..., description="Whether the entry was found and dropped")
+    message: str = Field(..., description="Status message about the report")
+
+
 class RequestStatusResponse(BaseModel):
     """Response with status information about a request."""
     status: str = Field(..., description="Current status of the request (processing, completed, cancelled, error)")
@@ -115,74 +189,6 @@ class RequestStatusResponse(BaseModel):
     error: Optional[str] = Field(None, description="Error message if request failed")
 
 
-# Dependency for getting Redis client
-async def get_redis_client():
-    """Get a Redis client as a dependency."""
-    use_redis = os.getenv("USE_REDIS", "true").lower() == "true"
-    
-    if not use_redis:
-        # Yield None if Redis is disabled
-        yield None
-        return
-        
-    try:
-        redis_url = os.getenv("REDIS_URL")
-        redis_host = os.getenv("REDIS_HOST", "localhost")
-        redis_port = int(os.getenv("REDIS_PORT", "6379"))
-        redis_db = int(os.getenv("REDIS_DB", "0"))
-        redis_password = os.getenv("REDIS_PASSWORD")
-        
-        client = RedisClient(
-            host=redis_host,
-            port=redis_port,
-            db=redis_db,
-            password=redis_password,
-            url=redis_url,
-        )
-        
-        # Test Redis connection
-        await client.redis.ping()
-        
-        try:
-            yield client
-        finally:
-            await client.close()
-    except Exception as e:
-        logger.warning(f"Redis connection error: {str(e)}. Proceeding without Redis.")
-        yield None
-
-
-# Dependency for getting DeepSeek agent
-async def get_agent(redis_client: Optional[RedisClient] = Depends(get_redis_client)):
-    """Get a DeepSeek agent as a dependency."""
-    api_key = os.getenv("DEEPSEEK_API_KEY", "")
-    
-    # Check if API key is valid, otherwise use mock mode
-    mock_mode = not api_key or api_key.lower() in ("", "your_api_key_here", "none", "test")
-    if mock_mode:
-        logger.warning("No valid DEEPSEEK_API_KEY found. Using mock mode.")
-    
-    # Initialize DeepSeek API wrapper
-    deepseek_wrapper = DeepSeekWrapper(
-        api_key=api_key,
-        api_base=os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1"),
-        model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
-        redis_client=redis_client,
-        cache_ttl=int(os.getenv("CACHE_TTL", "3600")),
-        mock_mode=mock_mode,
-    )
-    
-    # Initialize agent with tools
-    agent = DeepSeekAgent(
-        deepseek_wrapper=deepseek_wrapper,
-        tools=list(AVAILABLE_TOOLS.values()),
-        system_prompt=os.getenv("AGENT_SYSTEM_PROMPT"),
-        memory_window_size=int(os.getenv("MEMORY_WINDOW_SIZE", "5")),
-    )
-    
-    return agent
-
-
 @app.get("/brand-briefs")
 async def list_brand_briefs():
     """List all JSON files in the tools directory that could be brand briefs."""
@@ -237,40 +243,89 @@ async def get_brand_brief(brief_name: str):
 @app.post("/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
-    agent: DeepSeekAgent = Depends(get_agent),
+    container: AppContainer = Depends(get_container),
 ):
     """
     Chat with the DeepSeek agent.
     
     Args:
         request: Chat request with prompt and optional session_id
-        agent: DeepSeek agent dependency
+        container: Shared objects of this worker
     
     Returns:
         Agent response
     """
-    # Ensure we have a session ID
-    session_id = request.session_id or str(uuid.uuid4())
+    # Session and request IDs are generated if not provided
+    context = container.request_context(request.session_id, request.request_id)
     
     try:
         # Process the query with the agent
-        agent_response = await agent.process_query(
+        agent_response = await context.agent.process_query(
             query=request.prompt,
-            session_id=session_id,
+            session_id=context.session_id,
+            request_id=context.request_id,
         )
         
         # Return the response
         return {
             "response": agent_response.response,
-            "session_id": session_id,
+            "session_id": context.session_id,
             "tool_calls": agent_response.tool_calls,
             "request_id": agent_response.request_id,
+            "steps": agent_response.steps,
+            "stop_reason": agent_response.stop_reason,
+            "similarity": agent_response.similarity,
         }
         
     except Exception as e:
         # Log the error
         print(f"Error processing chat request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+    
+    finally:
+        metrics.CHAT_LATENCY.observe(time.time() - context.started_at, endpoint="chat")
+
+
+@app.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    container: AppContainer = Depends(get_container),
+):
+    """
+    Chat with the DeepSeek agent, streaming the response as Server-Sent Events.
+    
+    Each event has a type (start, token, tool_call, tool_result, done, error)
+    and a JSON payload; the final ``done`` event carries the full response.
+    
+    Args:
+        request: Chat request with prompt and optional session_id
+        container: Shared objects of this worker
+    
+    Returns:
+        An ``text/event-stream`` response
+    """
+    # Session and request IDs are generated if not provided
+    context = container.request_context(request.session_id, request.request_id)
+    
+    async def event_stream():
+        try:
+            async for event in context.agent.process_query_stream(
+                query=request.prompt,
+                session_id=context.session_id,
+                request_id=context.request_id,
+            ):
+                yield f"event: {event['type']}\ndata: {fastjson.dumps(event)}\n\n"
+        finally:
+            metrics.CHAT_LATENCY.observe(time.time() - context.started_at, endpoint="chat_stream")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # Disable proxy buffering so tokens flush immediately
+        },
+    )
 
 
 @app.post("/cancel", response_model=CancelResponse)
@@ -298,7 +353,7 @@ async def cancel_request(
     
     try:
         # Attempt to cancel the request
-        success = agent.cancel_request(request_id)
+        success = await agent.cancel_request(request_id)
         
         if success:
             logger.info(f"Request {request_id} cancelled successfully")
@@ -320,6 +375,32 @@ async def cancel_request(
         )
 
 
+@app.post("/similarity/false-hit", response_model=FalseHitResponse)
+async def report_similarity_false_hit(
+    request: FalseHitRequest,
+    agent: DeepSeekAgent = Depends(get_agent),
+):
+    """
+    Report that an answer served from the similarity cache was wrong.
+    
+    The entry is dropped so the prompt is answered by the API next time,
+    and the report is counted in ``deepseek_similarity_false_hits_total``.
+    
+    Args:
+        request: Report with the entry_id of the chat response
+        agent: DeepSeek agent dependency
+    
+    Returns:
+        Report status
+    """
+    if agent.report_similarity_false_hit(request.entry_id):
+        return FalseHitResponse(success=True, message=f"Similarity cache entry {request.entry_id} dropped")
+    return FalseHitResponse(
+        success=False,
+        message=f"Similarity cache entry {request.entry_id} not found (disabled, expired or already dropped)",
+    )
+
+
 @app.get("/request-status/{request_id}", response_model=RequestStatusResponse)
 async def get_request_status(
     request_id: str,
@@ -338,8 +419,8 @@ async def get_request_status(
     if not request_id:
         raise HTTPException(status_code=400, detail="No request ID provided")
     
-    # Get the status from the agent
-    status_data = DeepSeekAgent.get_request_status(request_id)
+    # Get the status from the registry shared by all workers
+    status_data = await agent.get_request_status(request_id)
     
     if not status_data:
         raise HTTPException(status_code=404, detail=f"Request {request_id} not found")
@@ -0,0 +1,12 @@
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+from app import fastjson
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with the app's fast JSON encoder (orjson when installed)."""
+
+    def render(self, content: Any) -> bytes:
+        return fastjson.dumpb(content)
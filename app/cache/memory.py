@@ -0,0 +1,163 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from app import fastjson
+
+
+def _default_sizer(value: Any) -> int:
+    """Estimate the size of a value in bytes."""
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(fastjson.dumpb(value, default=str))
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with LRU eviction, lazy TTL expiry and stats.
+
+    All operations are O(1): entries live in an ordered dict that is kept in
+    recency order, expired entries are dropped when they are read (or when they
+    reach the LRU end), and eviction pops from the least recently used end until
+    both the entry and byte budgets are met.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 1000,
+        max_bytes: Optional[int] = 16 * 1024 * 1024,
+        default_ttl: Optional[float] = None,
+        sizer: Optional[Callable[[Any], int]] = None,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of entries (None for no limit)
+            max_bytes: Maximum total size of stored values in bytes (None for no limit)
+            default_ttl: Default time-to-live in seconds (None to never expire)
+            sizer: Function returning the size of a value in bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._sizer = sizer or _default_sizer
+
+        # key -> (value, expires_at, size); ordered from least to most recently used
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not self._is_expired(entry)
+
+    @property
+    def current_bytes(self) -> int:
+        """Total size of stored values in bytes."""
+        return self._bytes
+
+    @staticmethod
+    def _is_expired(entry: tuple) -> bool:
+        expires_at = entry[1]
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value, marking it as most recently used."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if self._is_expired(entry):
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> bool:
+        """
+        Store a value.
+
+        Args:
+            key: Cache key
+            value: Value to store
+            ttl: Time-to-live in seconds (defaults to ``default_ttl``)
+
+        Returns:
+            True if stored, False if the value alone exceeds the byte budget
+        """
+        size = self._sizer(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.rejections += 1
+            return False
+
+        if key in self._entries:
+            self._remove(key)
+
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+
+        self._evict()
+        return True
+
+    def _evict(self) -> None:
+        """Pop least recently used entries until within both budgets."""
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            key, entry = next(iter(self._entries.items()))
+            self._remove(key)
+            if self._is_expired(entry):
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> bool:
+        """Delete a key. Returns True if it was present."""
+        if key in self._entries:
+            self._remove(key)
+            return True
+        return False
+
+    def clear(self) -> None:
+        """Remove all entries (stats are kept)."""
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters and current usage."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "rejections": self.rejections,
+        }
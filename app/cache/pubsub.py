@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Optional
+
+from app import metrics
+from app.cache.redis import RedisClient
+
+logger = logging.getLogger('pubsub')
+
+
+async def listen_forever(
+    redis_client: RedisClient,
+    channel: str,
+    on_message: Callable[[str], None],
+    on_reconnect: Optional[Callable[[], Awaitable[None]]] = None,
+    initial_backoff: float = 0.5,
+    max_backoff: float = 30.0,
+) -> None:
+    """
+    Handle the messages of a pub/sub channel until cancelled.
+
+    A failed subscription is retried with exponential backoff and jitter, so
+    a Redis restart or network blip pauses the listener instead of ending it.
+    Messages published while the subscription is down are lost: once it is
+    back, ``on_reconnect`` is awaited so the caller can drop or recheck
+    whatever those messages would have changed.
+
+    Args:
+        redis_client: Redis client to subscribe with
+        channel: Channel to listen on
+        on_message: Called with each message, decoded to a string
+        on_reconnect: Awaited after a subscription that follows a failure
+        initial_backoff: Seconds to wait after the first failure
+        max_backoff: Largest wait between attempts
+    """
+    backoff = initial_backoff
+    missed_messages = False
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            backoff = initial_backoff
+            if missed_messages:
+                missed_messages = False
+                metrics.PUBSUB_RECONNECTS.inc(channel=channel)
+                logger.info(f"Resubscribed to {channel}")
+                if on_reconnect is not None:
+                    await on_reconnect()
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                data = message.get("data")
+                if isinstance(data, bytes):
+                    data = data.decode("utf-8")
+                try:
+                    on_message(data)
+                except Exception as e:
+                    logger.error(f"Error handling message on {channel}: {str(e)}")
+            logger.warning(f"Subscription to {channel} ended, resubscribing in {backoff:.1f}s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Subscription to {channel} failed, retrying in {backoff:.1f}s: {str(e)}")
+        finally:
+            try:
+                await pubsub.unsubscribe(channel)
+                await pubsub.close()
+            except Exception:
+                pass
+        missed_messages = True
+        await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+        backoff = min(backoff * 2, max_backoff)
@@ -1,7 +1,132 @@
-﻿import json
-from typing import Any, Dict, Optional, Union
+﻿import logging
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Union
 import redis.asyncio as redis
 
+from app import fastjson
+
+try:
+    import msgpack
+except ImportError:  # JSON is used instead
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # zlib is used instead
+    zstandard = None
+
+logger = logging.getLogger('redis_cache')
+
+# First byte of every value written by ValueCodec. Values without it are legacy
+# JSON text, which can only start with whitespace or a JSON token, never 0x01.
+CODEC_HEADER_V1 = 0x01
+
+# Second byte: serializer in the low nibble, compression in the high nibble
+SERIALIZER_JSON = 0x00
+SERIALIZER_MSGPACK = 0x01
+COMPRESSION_NONE = 0x00
+COMPRESSION_ZLIB = 0x10
+COMPRESSION_ZSTD = 0x20
+
+
+class ValueCodec:
+    """
+    Encode cached values and session blobs for Redis.
+
+    Values are serialized with msgpack (or JSON) and compressed with zstd (or
+    zlib) once they exceed ``compress_threshold`` bytes. Encoded values start
+    with a two-byte header recording the format version, serializer and
+    compression, so any codec configuration can read any other's values, and
+    values without a header are decoded as the plain JSON written before.
+    """
+
+    def __init__(
+        self,
+        serializer: str = "msgpack",
+        compression: str = "zlib",
+        compress_threshold: int = 512,
+        compression_level: Optional[int] = None,
+    ):
+        """
+        Initialize the codec.
+
+        Args:
+            serializer: "msgpack" or "json" (msgpack falls back to JSON if not installed)
+            compression: "zstd", "zlib" or "none" (zstd falls back to zlib if not installed)
+            compress_threshold: Serialized size in bytes above which values are compressed
+            compression_level: Compression level (default: 3 for zstd, 6 for zlib)
+        """
+        if serializer == "msgpack" and msgpack is None:
+            logger.warning("msgpack is not installed; caching values as JSON")
+            serializer = "json"
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed; compressing cached values with zlib")
+            compression = "zlib"
+        if serializer not in ("msgpack", "json"):
+            raise ValueError(f"Unknown serializer: {serializer}")
+        if compression not in ("zstd", "zlib", "none"):
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+        if compression == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=compression_level or 3)
+        self.compression_level = compression_level if compression_level is not None else 6
+
+    def encode(self, value: Any) -> bytes:
+        """Serialize (and maybe compress) a value, prefixed with the codec header."""
+        if self.serializer == "msgpack":
+            flags = SERIALIZER_MSGPACK
+            data = msgpack.packb(value, use_bin_type=True)
+        else:
+            flags = SERIALIZER_JSON
+            data = fastjson.dumpb(value)
+
+        if self.compression != "none" and len(data) > self.compress_threshold:
+            if self.compression == "zstd":
+                flags |= COMPRESSION_ZSTD
+                data = self._compressor.compress(data)
+            else:
+                flags |= COMPRESSION_ZLIB
+                data = zlib.compress(data, self.compression_level)
+
+        return bytes((CODEC_HEADER_V1, flags)) + data
+
+    @staticmethod
+    def decode(data: Union[bytes, str]) -> Any:
+        """Decode a value written by any codec configuration, or legacy JSON."""
+        if isinstance(data, str) or not data or data[0] != CODEC_HEADER_V1:
+            return fastjson.loads(data)
+
+        flags = data[1]
+        payload = data[2:]
+        compression = flags & 0xF0
+        if compression == COMPRESSION_ZLIB:
+            payload = zlib.decompress(payload)
+        elif compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise ValueError("Cached value is zstd-compressed but zstandard is not installed")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+
+        if flags & 0x0F == SERIALIZER_MSGPACK:
+            if msgpack is None:
+                raise ValueError("Cached value is msgpack-encoded but msgpack is not installed")
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        return fastjson.loads(payload)
+
+
+# Delete a lock only if it still holds our token, so we never release a lock
+# that expired and was taken over by another worker
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 class RedisClient:
     """
@@ -15,6 +140,7 @@ def __init__(
         db: int = 0,
         password: Optional[str] = None,
         url: Optional[str] = None,
+        codec: Optional[ValueCodec] = None,
     ):
         """
         Initialize Redis client.
@@ -25,7 +151,9 @@ def __init__(
             db: Redis database
             password: Redis password
             url: Redis URL (takes precedence if provided)
+            codec: Codec for cached values and session data
         """
+        # Responses stay as bytes: encoded values are binary
         if url:
             self.redis = redis.from_url(url)
         else:
@@ -34,21 +162,36 @@ def __init__(
                 port=port,
                 db=db,
                 password=password,
-                decode_responses=True,
             )
+        self.codec = codec or ValueCodec()
 
-    async def get(self, key: str) -> Optional[str]:
+    async def get(self, key: str) -> Optional[bytes]:
         """Get value from Redis."""
         return await self.redis.get(key)
 
     async def set(
-        self, key: str, value: str, expire: Optional[int] = None
+        self, key: str, value: Union[str, bytes], expire: Optional[int] = None
     ) -> bool:
         """Set value in Redis with optional expiration."""
         if expire:
             return await self.redis.setex(key, expire, value)
         return await self.redis.set(key, value)
 
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Get several values from Redis in one round trip."""
+        if not keys:
+            return []
+        return await self.redis.mget(keys)
+
+    async def get_value(self, key: str) -> Optional[Any]:
+        """Get and decode a value stored with ``set_value``."""
+        data = await self.get(key)
+        return self.codec.decode(data) if data else None
+
+    async def set_value(self, key: str, value: Any, expire: Optional[int] = None) -> bool:
+        """Encode a value with the codec and store it."""
+        return await self.set(key, self.codec.encode(value), expire)
+
     async def delete(self, key: str) -> int:
         """Delete key from Redis."""
         return await self.redis.delete(key)
@@ -57,6 +200,33 @@ async def exists(self, key: str) -> bool:
         """Check if key exists in Redis."""
         return await self.redis.exists(key)
 
+    async def publish(self, channel: str, message: str) -> int:
+        """Publish a message to a pub/sub channel."""
+        return await self.redis.publish(channel, message)
+
+    def pubsub(self):
+        """Create a pub/sub object for subscribing to channels."""
+        return self.redis.pubsub()
+
+    async def acquire_lock(self, name: str, ttl_ms: int = 30000) -> Optional[str]:
+        """
+        Try to take a short-lived lock.
+        
+        Args:
+            name: Lock name
+            ttl_ms: Lock expiry in milliseconds, in case the holder dies
+            
+        Returns:
+            A token to pass to ``release_lock`` if acquired, otherwise None
+        """
+        token = uuid.uuid4().hex
+        acquired = await self.redis.set(f"lock:{name}", token, nx=True, px=ttl_ms)
+        return token if acquired else None
+
+    async def release_lock(self, name: str, token: str) -> bool:
+        """Release a lock taken with ``acquire_lock``."""
+        return bool(await self.redis.eval(_RELEASE_LOCK_SCRIPT, 1, f"lock:{name}", token))
+
     async def store_session_data(
         self, session_id: str, data: Dict[str, Any], expire: int = 86400
     ) -> bool:
@@ -69,8 +239,7 @@ async def store_session_data(
             expire: Session expiration time in seconds (default: 24 hours)
         """
         key = f"session:{session_id}"
-        value = json.dumps(data)
-        return await self.set(key, value, expire)
+        return await self.set_value(key, data, expire)
 
     async def get_session_data(self, session_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -80,10 +249,7 @@ async def get_session_data(self, session_id: str) -> Optional[Dict[str, Any]]:
             session_id: Unique session identifier
         """
         key = f"session:{session_id}"
-        data = await self.get(key)
-        if data:
-            return json.loads(data)
-        return None
+        return await self.get_value(key)
 
     async def delete_session(self, session_id: str) -> int:
         """
@@ -0,0 +1,285 @@
+import hashlib
+import random
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from app import fastjson
+
+# Mersenne prime used for the MinHash permutations (a*x + b) mod p
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_BRIEF_PATTERN = re.compile(r"\b[\w]+_brief\b")
+
+# Words that may differ between two prompts without changing what is asked
+DEFAULT_FILLER_WORDS = frozenset({
+    "a", "an", "the", "please", "pls", "kindly", "me", "us", "can", "could",
+    "would", "you", "some", "just", "hi", "hello", "hey", "thanks", "thank",
+})
+
+
+def normalize_prompt(text: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace (keeps Vietnamese letters)."""
+    text = unicodedata.normalize("NFC", text).lower()
+    text = "".join(
+        " " if unicodedata.category(ch).startswith(("P", "S")) else ch
+        for ch in text
+    )
+    return " ".join(text.split())
+
+
+def _shingles(text: str, k: int) -> Set[bytes]:
+    """Character k-shingles of a normalized prompt."""
+    if len(text) <= k:
+        return {text.encode("utf-8")}
+    return {text[i:i + k].encode("utf-8") for i in range(len(text) - k + 1)}
+
+
+class SimilarityCache:
+    """
+    Near-duplicate prompt cache using MinHash signatures and an LSH index.
+
+    Prompts are normalized and split into character shingles; a MinHash
+    signature estimates their Jaccard similarity. Signatures are split into
+    bands and indexed, so a lookup only compares against prompts sharing at
+    least one band. A candidate is accepted only if:
+
+    - everything except the last user message (system prompt, history,
+      functions, model and sampling parameters) is byte-identical,
+    - both prompts name the same brand briefs,
+    - the estimated similarity reaches ``threshold``, and
+    - the prompts differ by at most ``max_word_difference`` words that are
+      not filler words (so "about cloud" never matches "about edge").
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 5,
+        max_entries: int = 2000,
+        ttl: Optional[float] = 3600,
+        max_word_difference: int = 0,
+        filler_words: FrozenSet[str] = DEFAULT_FILLER_WORDS,
+        seed: int = 1,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            threshold: Minimum estimated Jaccard similarity for a hit
+            num_perm: Number of MinHash permutations (signature length)
+            bands: Number of LSH bands; must divide ``num_perm``
+            shingle_size: Characters per shingle
+            max_entries: Maximum number of cached prompts (LRU eviction)
+            ttl: Time-to-live of an entry in seconds (None to never expire)
+            max_word_difference: Allowed number of differing non-filler words
+            filler_words: Words ignored when comparing prompts word by word
+            seed: Seed for the permutation coefficients
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_word_difference = max_word_difference
+        self.filler_words = filler_words
+
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+
+        # entry id -> entry dict; ordered from least to most recently used
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # (scope, band index, band values) -> entry ids
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[str]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.rejected_candidates = 0
+        self.false_hits = 0
+        self._hit_similarity_total = 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def scope_key(
+        messages: List[Dict[str, Any]],
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        functions: Optional[List[Dict[str, Any]]] = None,
+    ) -> Optional[str]:
+        """
+        Digest of everything that must match exactly for a similarity hit.
+
+        Returns None if the conversation does not end with a user message.
+        """
+        if not messages or messages[-1].get("role") != "user":
+            return None
+        context = {
+            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "functions": functions or None,
+            "messages": messages[:-1],
+        }
+        return hashlib.sha256(fastjson.dumpb(context, sort_keys=True)).hexdigest()
+
+    def _signature(self, text: str) -> Tuple[int, ...]:
+        # Filler words are left out so "please ..." does not lower the similarity
+        content = " ".join(w for w in text.split() if w not in self.filler_words) or text
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle, digest_size=4).digest(), "little")
+            for shingle in _shingles(content, self.shingle_size)
+        ]
+        return tuple(
+            min((a * h + b) % _MERSENNE_PRIME for h in hashes) & _MAX_HASH
+            for a, b in self._permutations
+        )
+
+    def _band_keys(self, scope: str, signature: Tuple[int, ...]):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield (scope, band, signature[start:start + self.rows])
+
+    def _similarity(self, a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+        return sum(1 for x, y in zip(a, b) if x == y) / self.num_perm
+
+    def _words_match(self, a: FrozenSet[str], b: FrozenSet[str]) -> bool:
+        differing = (a ^ b) - self.filler_words
+        return len(differing) <= self.max_word_difference
+
+    def lookup(self, scope: str, prompt: str) -> Optional[Tuple[str, Any, float]]:
+        """
+        Find a cached response for a near-duplicate prompt.
+
+        Args:
+            scope: Result of ``scope_key`` for the request
+            prompt: Text of the last user message
+
+        Returns:
+            ``(entry_id, response, similarity)`` on a hit, otherwise None
+        """
+        text = normalize_prompt(prompt)
+        signature = self._signature(text)
+        words = frozenset(text.split())
+        briefs = frozenset(_BRIEF_PATTERN.findall(prompt.lower()))
+
+        candidates: Set[str] = set()
+        for key in self._band_keys(scope, signature):
+            candidates.update(self._buckets.get(key, ()))
+
+        best = None
+        now = time.monotonic()
+        for entry_id in candidates:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                continue
+            if entry["expires_at"] is not None and entry["expires_at"] <= now:
+                self._remove(entry_id)
+                continue
+            similarity = self._similarity(signature, entry["signature"])
+            if (
+                similarity < self.threshold
+                or entry["briefs"] != briefs
+                or not self._words_match(words, entry["words"])
+            ):
+                self.rejected_candidates += 1
+                continue
+            if best is None or similarity > best[2]:
+                best = (entry_id, entry["response"], similarity)
+
+        if best is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(best[0])
+        self.hits += 1
+        self._hit_similarity_total += best[2]
+        return best
+
+    def add(self, scope: str, prompt: str, response: Any) -> str:
+        """
+        Cache a response for a prompt.
+
+        Args:
+            scope: Result of ``scope_key`` for the request
+            prompt: Text of the last user message
+            response: Response to return for near-duplicate prompts
+
+        Returns:
+            The entry id
+        """
+        text = normalize_prompt(prompt)
+        entry_id = hashlib.sha256(f"{scope}:{text}".encode("utf-8")).hexdigest()[:32]
+        if entry_id in self._entries:
+            self._remove(entry_id)
+
+        signature = self._signature(text)
+        self._entries[entry_id] = {
+            "scope": scope,
+            "signature": signature,
+            "words": frozenset(text.split()),
+            "briefs": frozenset(_BRIEF_PATTERN.findall(prompt.lower())),
+            "response": response,
+            "expires_at": time.monotonic() + self.ttl if self.ttl is not None else None,
+        }
+        for key in self._band_keys(scope, signature):
+            self._buckets.setdefault(key, set()).add(entry_id)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+        return entry_id
+
+    def _remove(self, entry_id: str) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in self._band_keys(entry["scope"], entry["signature"]):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def report_false_hit(self, entry_id: str) -> bool:
+        """
+        Record that a hit served the wrong answer and drop the entry.
+
+        Returns:
+            True if the entry was still cached (unknown IDs are not counted)
+        """
+        if entry_id not in self._entries:
+            return False
+        self.false_hits += 1
+        self._remove(entry_id)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit, miss and false-hit counters."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "rejected_candidates": self.rejected_candidates,
+            "false_hits": self.false_hits,
+            "false_hit_ratio": self.false_hits / self.hits if self.hits else 0.0,
+            "mean_hit_similarity": self._hit_similarity_total / self.hits if self.hits else 0.0,
+        }
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Set
+
+from app import metrics
+from app.cache.memory import LRUCache
+from app.cache.pubsub import listen_forever
+from app.cache.redis import RedisClient
+
+logger = logging.getLogger('tiered_cache')
+
+# Channel used to tell every worker to drop a key from its L1
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+
+class TieredCache:
+    """
+    Two-tier read-through cache: a per-process L1 LRU in front of Redis (L2).
+
+    Reads are served from L1 when possible; an L1 miss falls through to L2 and
+    the value is promoted into L1. Writes go to both tiers, either awaiting the
+    Redis write (write-through) or scheduling it in the background
+    (write-behind). Deletes remove the key from both tiers and are broadcast so
+    other workers drop their L1 copy too.
+
+    With ``stale_ttl`` set, every write also keeps a long-lived stale copy that
+    ``get_stale`` can serve when the upstream is unavailable.
+    """
+
+    def __init__(
+        self,
+        l1: Optional[LRUCache] = None,
+        l2: Optional[RedisClient] = None,
+        l1_ttl: Optional[int] = 300,
+        l2_ttl: Optional[int] = 3600,
+        write_behind: bool = False,
+        stale_ttl: Optional[int] = None,
+        stale_max_entries: int = 1000,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            l1: In-process cache (a default LRUCache is created if omitted)
+            l2: Redis client, or None to run with L1 only
+            l1_ttl: Time-to-live for L1 entries in seconds
+            l2_ttl: Time-to-live for L2 entries in seconds
+            write_behind: Write to Redis in the background instead of awaiting it
+            stale_ttl: Time-to-live for stale copies in seconds (None to keep none)
+            stale_max_entries: Maximum stale copies kept in process
+        """
+        self.l1 = l1 if l1 is not None else LRUCache(default_ttl=l1_ttl)
+        self.l2 = l2
+        self.l1_ttl = l1_ttl
+        self.l2_ttl = l2_ttl
+        self.write_behind = write_behind
+        self.stale_ttl = stale_ttl
+        # In-process stale copies, so there is something to serve without Redis too
+        self._stale = LRUCache(max_entries=stale_max_entries, default_ttl=stale_ttl) if stale_ttl else None
+
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.l2_errors = 0
+        self.stale_hits = 0
+
+        self._pending_writes: Set[asyncio.Task] = set()
+        self._listener_task: Optional[asyncio.Task] = None
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Get a value from L1, falling back to L2 and promoting it into L1."""
+        value = self.l1.get(key)
+        metrics.CACHE_LOOKUPS.inc(tier="l1", result="hit" if value is not None else "miss")
+        if value is not None:
+            return value
+
+        if not self.l2:
+            return None
+
+        try:
+            cached = await self.l2.get(key)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"L2 cache read failed for {key}: {str(e)}")
+            return None
+
+        value = await self._decode(key, cached) if cached else None
+        if value is None:
+            self.l2_misses += 1
+            metrics.CACHE_LOOKUPS.inc(tier="l2", result="miss")
+            return None
+
+        self.l2_hits += 1
+        metrics.CACHE_LOOKUPS.inc(tier="l2", result="hit")
+        self.l1.set(key, value, ttl=self.l1_ttl)
+        return value
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Get several values, reading all L1 misses from L2 in one round trip.
+
+        Returns:
+            Mapping of the keys that were found to their values
+        """
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        for key in keys:
+            value = self.l1.get(key)
+            metrics.CACHE_LOOKUPS.inc(tier="l1", result="hit" if value is not None else "miss")
+            if value is not None:
+                found[key] = value
+            else:
+                missing.append(key)
+
+        if not missing or not self.l2:
+            return found
+
+        try:
+            cached_values = await self.l2.mget(missing)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"L2 cache read failed for {len(missing)} keys: {str(e)}")
+            return found
+
+        for key, cached in zip(missing, cached_values):
+            value = await self._decode(key, cached) if cached else None
+            if value is None:
+                self.l2_misses += 1
+                metrics.CACHE_LOOKUPS.inc(tier="l2", result="miss")
+                continue
+            self.l2_hits += 1
+            metrics.CACHE_LOOKUPS.inc(tier="l2", result="hit")
+            self.l1.set(key, value, ttl=self.l1_ttl)
+            found[key] = value
+        return found
+
+    async def _decode(self, key: str, cached: bytes) -> Optional[Any]:
+        """
+        Decode an L2 value, or drop it if it can't be decoded.
+
+        A value can be corrupt, or written by a worker with a codec this one
+        lacks (zstd or msgpack not installed); either way it is a miss.
+        """
+        try:
+            return self.l2.codec.decode(cached)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"Dropping undecodable L2 value for {key}: {str(e)}")
+        try:
+            await self.l2.delete(key)
+        except Exception as e:
+            logger.warning(f"L2 cache delete failed for {key}: {str(e)}")
+        return None
+
+    @staticmethod
+    def _stale_key(key: str) -> str:
+        return f"{key}:stale"
+
+    async def get_stale(self, key: str) -> Optional[Any]:
+        """Get the stale copy of a value, which outlives the regular TTL."""
+        if self._stale is None:
+            return None
+
+        value = self._stale.get(key)
+        if value is None and self.l2:
+            try:
+                cached = await self.l2.get(self._stale_key(key))
+            except Exception as e:
+                self.l2_errors += 1
+                logger.warning(f"L2 stale read failed for {key}: {str(e)}")
+                return None
+            if cached:
+                value = await self._decode(self._stale_key(key), cached)
+                if value is not None:
+                    self._stale.set(key, value)
+
+        if value is not None:
+            self.stale_hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        """Store a value in L1 and write it to L2."""
+        self.l1.set(key, value, ttl=self.l1_ttl)
+        if self._stale is not None:
+            self._stale.set(key, value)
+
+        if not self.l2:
+            return
+
+        if self.write_behind:
+            task = asyncio.create_task(self._write_l2(key, value))
+            # Keep a reference so the task is not garbage collected mid-write
+            self._pending_writes.add(task)
+            task.add_done_callback(self._pending_writes.discard)
+        else:
+            await self._write_l2(key, value)
+
+    async def _write_l2(self, key: str, value: Any) -> None:
+        try:
+            data = self.l2.codec.encode(value)
+            await self.l2.set(key, data, expire=self.l2_ttl)
+            if self.stale_ttl:
+                await self.l2.set(self._stale_key(key), data, expire=self.stale_ttl)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"L2 cache write failed for {key}: {str(e)}")
+
+    async def delete(self, key: str) -> None:
+        """Delete a key from both tiers and tell other workers to drop it from L1."""
+        self.l1.delete(key)
+        if self._stale is not None:
+            self._stale.delete(key)
+
+        if not self.l2:
+            return
+
+        try:
+            await self.l2.delete(key)
+            if self.stale_ttl:
+                await self.l2.delete(self._stale_key(key))
+            await self.l2.publish(INVALIDATION_CHANNEL, key)
+        except Exception as e:
+            self.l2_errors += 1
+            logger.warning(f"L2 cache delete failed for {key}: {str(e)}")
+
+    async def flush(self) -> None:
+        """Wait for pending write-behind writes to finish."""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+    async def start(self) -> None:
+        """Start listening for invalidations published by other workers."""
+        if self.l2 and self._listener_task is None:
+            self._listener_task = asyncio.create_task(
+                listen_forever(self.l2, INVALIDATION_CHANNEL, self._invalidate, self._resync)
+            )
+
+    async def stop(self) -> None:
+        """Stop the invalidation listener and flush pending writes."""
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+        await self.flush()
+
+    def _invalidate(self, key: str) -> None:
+        self.l1.delete(key)
+        if self._stale is not None:
+            self._stale.delete(key)
+
+    async def _resync(self) -> None:
+        # Invalidations published while the listener was down are lost
+        logger.info(f"Dropping {len(self.l1)} L1 entries after the invalidation listener reconnected")
+        self.l1.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return per-tier hit/miss counters."""
+        return {
+            "l1": self.l1.stats(),
+            "l2": {
+                "enabled": self.l2 is not None,
+                "hits": self.l2_hits,
+                "misses": self.l2_misses,
+                "errors": self.l2_errors,
+                "pending_writes": len(self._pending_writes),
+            },
+            "stale": {
+                "enabled": self._stale is not None,
+                "entries": len(self._stale) if self._stale is not None else 0,
+                "hits": self.stale_hits,
+            },
+        }
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.deepseek.errors import DeepSeekAPIError
+
+logger = logging.getLogger('deepseek_breaker')
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Errors raised before a request reaches the upstream (open circuit, full limiter queue, cassette miss)
+LOCAL_REASONS = frozenset({"circuit_open", "queue_full", "queue_timeout", "cassette_miss"})
+
+
+def is_upstream_failure(error: Optional[BaseException]) -> Optional[bool]:
+    """
+    Decide whether the result of an upstream call says the upstream is unhealthy.
+
+    Returns:
+        False for a success, True for 5xx/429/timeouts/dropped connections, and
+        None for outcomes that say nothing about upstream health (cancellation,
+        bad requests, auth errors, calls refused on this side)
+    """
+    if error is None:
+        return False
+    if isinstance(error, asyncio.CancelledError):
+        return None
+    if isinstance(error, DeepSeekAPIError):
+        if error.reason in LOCAL_REASONS:
+            return None
+        if error.retryable or error.reason in ("timeout", "connection") or (error.status or 0) >= 500:
+            return True
+        # A non-retryable 4xx is about the request, not the upstream
+        return None
+    return isinstance(error, asyncio.TimeoutError)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker around the DeepSeek API.
+
+    While CLOSED, the outcome of every upstream call goes into a sliding window
+    of the last ``window_size`` calls. Once the window holds ``minimum_calls``
+    calls and either the failure rate or the slow-call rate reaches its
+    threshold, the circuit OPENS and calls fail immediately for
+    ``open_duration`` seconds. After that it goes HALF_OPEN and lets up to
+    ``half_open_max_calls`` trial calls through: if they all succeed the
+    circuit closes again, and any failure opens it for another period.
+    """
+
+    def __init__(
+        self,
+        failure_rate_threshold: float = 0.5,
+        slow_call_rate_threshold: float = 1.0,
+        slow_call_duration: Optional[float] = 30.0,
+        window_size: int = 20,
+        minimum_calls: int = 10,
+        open_duration: float = 30.0,
+        half_open_max_calls: int = 3,
+    ):
+        """
+        Initialize the breaker.
+
+        Args:
+            failure_rate_threshold: Fraction of failed calls in the window that opens the circuit
+            slow_call_rate_threshold: Fraction of slow calls in the window that opens the circuit
+            slow_call_duration: Calls slower than this (seconds) count as slow (None to disable)
+            window_size: Number of most recent calls the rates are computed over
+            minimum_calls: Calls needed in the window before the rates are evaluated
+            open_duration: Seconds the circuit stays open before allowing trial calls
+            half_open_max_calls: Trial calls allowed (and needed to close) while half-open
+        """
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+
+        self._state = CLOSED
+        self._opened_at = 0.0
+        # (failed, slow) per call, most recent last
+        self._window: Deque[Tuple[bool, bool]] = deque(maxlen=window_size)
+        self._half_open_calls = 0
+        self._half_open_successes = 0
+
+        # Called with (old state, new state) on every transition
+        self.state_listeners: List[Callable[[str, str], None]] = []
+
+        self.stats: Dict[str, Any] = {
+            "calls": 0,
+            "failures": 0,
+            "slow_calls": 0,
+            "rejected": 0,
+            "opened": 0,
+            "fallbacks": {},
+        }
+
+    @property
+    def state(self) -> str:
+        """Current state; an open circuit turns half-open once ``open_duration`` has passed."""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_duration:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def allow(self) -> None:
+        """
+        Check that a call may go to the upstream, reserving a trial slot when half-open.
+
+        Raises:
+            DeepSeekAPIError: With reason "circuit_open" if the call must not be made
+        """
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+            self._half_open_calls += 1
+            return
+
+        self.stats["rejected"] += 1
+        retry_in = max(self.open_duration - (time.monotonic() - self._opened_at), 0.0)
+        raise DeepSeekAPIError(
+            "DeepSeek API is temporarily unavailable (circuit breaker open). Please try again later.",
+            retry_after=retry_in if state == OPEN else None,
+            reason="circuit_open",
+        )
+
+    def record(self, error: Optional[BaseException], duration: Optional[float] = None) -> None:
+        """
+        Record the outcome of a call let through by ``allow``.
+
+        Args:
+            error: The exception the call raised, or None if it succeeded
+            duration: Seconds the call took
+        """
+        failed = is_upstream_failure(error)
+        if failed is None:
+            self.cancel()
+            return
+
+        slow = (
+            self.slow_call_duration is not None
+            and duration is not None
+            and duration >= self.slow_call_duration
+        )
+        self.stats["calls"] += 1
+        self.stats["failures"] += failed
+        self.stats["slow_calls"] += slow
+
+        if self._state == HALF_OPEN:
+            if failed or slow:
+                self._open()
+            else:
+                self._half_open_successes += 1
+                if self._half_open_successes >= self.half_open_max_calls:
+                    self._transition(CLOSED)
+            return
+
+        if self._state == OPEN:
+            # A call that started before the circuit opened
+            return
+
+        self._window.append((failed, slow))
+        if len(self._window) < self.minimum_calls:
+            return
+        failure_rate, slow_rate = self._rates()
+        if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+            logger.error(
+                f"Opening DeepSeek circuit: failure rate {failure_rate:.0%}, slow-call rate {slow_rate:.0%} "
+                f"over the last {len(self._window)} calls"
+            )
+            self._open()
+
+    def cancel(self) -> None:
+        """Give back the trial slot of a call that never reached the upstream."""
+        if self._state == HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def record_fallback(self, source: str) -> None:
+        """Count a response served by a fallback while the circuit was open."""
+        self.stats["fallbacks"][source] = self.stats["fallbacks"].get(source, 0) + 1
+
+    def _rates(self) -> Tuple[float, float]:
+        calls = len(self._window)
+        if not calls:
+            return 0.0, 0.0
+        failures = sum(1 for failed, _ in self._window if failed)
+        slow = sum(1 for _, is_slow in self._window if is_slow)
+        return failures / calls, slow / calls
+
+    def _open(self) -> None:
+        self._opened_at = time.monotonic()
+        self.stats["opened"] += 1
+        self._transition(OPEN)
+
+    def _transition(self, new_state: str) -> None:
+        old_state = self._state
+        self._state = new_state
+        self._window.clear()
+        self._half_open_calls = 0
+        self._half_open_successes = 0
+        if old_state == new_state:
+            return
+        logger.warning(f"DeepSeek circuit {old_state} -> {new_state}")
+        for listener in self.state_listeners:
+            try:
+                listener(old_state, new_state)
+            except Exception as e:
+                logger.error(f"Circuit breaker state listener failed: {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the current state, window rates and counters."""
+        state = self.state
+        failure_rate, slow_rate = self._rates()
+        return {
+            **self.stats,
+            "state": state,
+            "window_calls": len(self._window),
+            "failure_rate": failure_rate,
+            "slow_call_rate": slow_rate,
+            "open_for": (
+                max(self.open_duration - (time.monotonic() - self._opened_at), 0.0)
+                if state == OPEN else 0.0
+            ),
+        }
@@ -0,0 +1,273 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from app.deepseek.errors import DeepSeekAPIError
+
+logger = logging.getLogger('deepseek_cassette')
+
+CASSETTE_VERSION = 1
+
+# Cassette modes
+RECORD = "record"
+REPLAY = "replay"
+
+# Replay timings
+FAST = "fast"  # as fast as possible
+ORIGINAL = "original"  # sleep for the recorded latency and chunk cadence
+
+
+class Cassette:
+    """
+    Record DeepSeek API traffic to disk and replay it deterministically.
+
+    A cassette is a gzip-compressed JSON Lines file with one interaction per
+    line: the request payload, the response (or the streamed chunks with their
+    offsets from the start of the request), the status and the latency. Error
+    responses are recorded too, and so are streams that broke partway, with
+    the chunks that arrived before the break. Interactions are matched on a
+    SHA-256 digest of the canonical request body; several recordings of the
+    same request are replayed in turn.
+
+    Recorded interactions are written to disk in a worker thread, in the
+    order they were recorded, so recording doesn't block the event loop.
+
+    Credentials are never recorded, only request payloads.
+    """
+
+    def __init__(self, path: str, mode: str = REPLAY, timing: str = FAST, flush_every: int = 20):
+        """
+        Initialize the cassette.
+
+        Args:
+            path: Cassette file (``.jsonl.gz``)
+            mode: "record" to append traffic, "replay" to serve it
+            timing: Replay "fast" (no waiting) or with the "original" timing
+            flush_every: Recorded interactions buffered before writing to disk
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if timing not in (FAST, ORIGINAL):
+            raise ValueError(f"Unknown cassette timing: {timing}")
+
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.flush_every = flush_every
+
+        self._buffer: List[Dict[str, Any]] = []
+        # Latest background write; each write waits for the one before it
+        self._pending_write: Optional[asyncio.Task] = None
+        # request key -> recorded interactions, replayed round-robin
+        self._interactions: Dict[str, Deque[Dict[str, Any]]] = {}
+
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+
+        if mode == REPLAY:
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == REPLAY
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == RECORD
+
+    @staticmethod
+    def request_key(body: bytes) -> str:
+        """Digest identifying a request by its canonical JSON body."""
+        return hashlib.sha256(body).hexdigest()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"Cassette not found: {self.path}")
+        count = 0
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                if interaction.get("v") != CASSETTE_VERSION:
+                    logger.warning(f"Skipping interaction with unsupported cassette version {interaction.get('v')}")
+                    continue
+                self._interactions.setdefault(interaction["key"], deque()).append(interaction)
+                count += 1
+        logger.info(f"Loaded {count} interactions ({len(self._interactions)} distinct requests) from {self.path}")
+
+    def record(
+        self,
+        body: bytes,
+        response: Optional[Dict[str, Any]] = None,
+        chunks: Optional[List[Tuple[float, Dict[str, Any]]]] = None,
+        latency: float = 0.0,
+        status: int = 200,
+        error_text: Optional[str] = None,
+        retry_after: Optional[str] = None,
+        stream_error: Optional[BaseException] = None,
+    ) -> None:
+        """
+        Record one API interaction.
+
+        Args:
+            body: Canonical JSON request body that was sent
+            response: Parsed response for a non-streaming request
+            chunks: ``(seconds since request start, chunk)`` pairs for a stream
+            latency: Seconds until the full response (or the stream's end)
+            status: HTTP status of the response
+            error_text: Response body of a non-200 response
+            retry_after: Retry-After header of a non-200 response
+            stream_error: Error that broke a stream after ``chunks`` arrived
+        """
+        if not self.recording:
+            return
+        interaction = {
+            "v": CASSETTE_VERSION,
+            "key": self.request_key(body),
+            "recorded_at": time.time(),
+            "request": json.loads(body),
+            "status": status,
+            "latency": round(latency, 4),
+        }
+        if response is not None:
+            interaction["response"] = response
+        if chunks is not None:
+            interaction["chunks"] = [[round(offset, 4), chunk] for offset, chunk in chunks]
+        if status != 200:
+            interaction["error_text"] = error_text
+            interaction["retry_after"] = retry_after
+        if stream_error is not None:
+            interaction["stream_error"] = {
+                "type": "timeout" if isinstance(stream_error, asyncio.TimeoutError) else "connection",
+                "message": str(stream_error),
+            }
+
+        self._buffer.append(interaction)
+        self.recorded += 1
+        if len(self._buffer) >= self.flush_every:
+            self._write_in_background()
+
+    def _write(self, interactions: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Each write appends a gzip member; gzip readers treat them as one stream
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            for interaction in interactions:
+                f.write(json.dumps(interaction, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _write_in_background(self) -> None:
+        interactions, self._buffer = self._buffer, []
+        previous = self._pending_write
+
+        async def write() -> None:
+            if previous is not None:
+                await asyncio.wait([previous])
+            try:
+                await asyncio.to_thread(self._write, interactions)
+            except Exception as e:
+                logger.error(f"Could not write {len(interactions)} interactions to {self.path}: {str(e)}")
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Recorded outside the event loop: nothing to block
+            self._write(interactions)
+            return
+        self._pending_write = loop.create_task(write())
+
+    async def flush(self) -> None:
+        """Append buffered interactions to the cassette file and wait for pending writes."""
+        if self._buffer:
+            self._write_in_background()
+        if self._pending_write is not None:
+            await self._pending_write
+
+    async def close(self) -> None:
+        """Write anything still buffered."""
+        await self.flush()
+
+    def next_interaction(self, body: bytes) -> Dict[str, Any]:
+        """
+        Return the next recorded interaction for a request.
+
+        Raises:
+            DeepSeekAPIError: If the cassette has no recording of the request
+        """
+        recordings = self._interactions.get(self.request_key(body))
+        if not recordings:
+            self.misses += 1
+            raise DeepSeekAPIError(
+                "DeepSeek API cassette has no recording of this request.",
+                reason="cassette_miss",
+            )
+        interaction = recordings[0]
+        recordings.rotate(-1)
+        self.replayed += 1
+        return interaction
+
+    async def wait(self, seconds: float) -> None:
+        """Sleep for a recorded duration when replaying with the original timing."""
+        if self.timing == ORIGINAL and seconds > 0:
+            await asyncio.sleep(seconds)
+
+    async def replay_stream(self, interaction: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield the recorded chunks of a stream, at the recorded cadence if timing is original.
+
+        Raises:
+            asyncio.TimeoutError, aiohttp.ClientPayloadError: The error that
+                broke the recorded stream, after its chunks
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for offset, chunk in interaction.get("chunks") or []:
+            if self.timing == ORIGINAL:
+                delay = started + offset - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+        stream_error = interaction.get("stream_error")
+        if stream_error:
+            await self.wait(interaction.get("latency", 0.0) - (loop.time() - started))
+            if stream_error.get("type") == "timeout":
+                raise asyncio.TimeoutError()
+            raise aiohttp.ClientPayloadError(stream_error.get("message") or "Recorded stream was interrupted")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return recorded, replayed and missed interaction counts."""
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "timing": self.timing,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses,
+            "distinct_requests": len(self._interactions),
+        }
+
+
+class ReplayedStream:
+    """A recorded stream standing in for the open HTTP response of a streaming request."""
+
+    status = 200
+
+    def __init__(self, cassette: Cassette, interaction: Dict[str, Any]):
+        self.cassette = cassette
+        self.interaction = interaction
+
+    def chunks(self) -> AsyncIterator[Dict[str, Any]]:
+        return self.cassette.replay_stream(self.interaction)
+
+    def release(self) -> None:
+        pass
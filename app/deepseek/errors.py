@@ -0,0 +1,38 @@
+from typing import Optional
+
+
+class DeepSeekAPIError(Exception):
+    """
+    Error talking to the DeepSeek API.
+    
+    Messages keep the ``DeepSeek API ...`` wording used throughout the app, and
+    carry enough detail for the retry policy to decide whether to try again.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status: Optional[int] = None,
+        retryable: bool = False,
+        retry_after: Optional[float] = None,
+        reason: Optional[str] = None,
+    ):
+        """
+        Initialize the error.
+        
+        Args:
+            message: Human-readable error message
+            status: HTTP status code, if the API answered
+            retryable: Whether the same request may succeed if sent again
+            retry_after: Seconds the API asked us to wait (Retry-After header)
+            reason: Short machine-readable cause, e.g. "429", "timeout", "connection"
+        """
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.reason = reason or (str(status) if status else "error")
+
+
+# Status codes worth retrying: request timeout, rate limit and transient server errors
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from app.cache.redis import RedisClient
+from app.deepseek.errors import DeepSeekAPIError
+
+logger = logging.getLogger('deepseek_limiter')
+
+# Outcomes passed to AdaptiveConcurrencyLimiter.release
+SUCCESS = "success"
+OVERLOAD = "overload"  # 429s and timeouts: the upstream is saturated
+IGNORE = "ignore"  # errors that say nothing about upstream capacity
+
+
+class RedisSemaphore:
+    """
+    Counting semaphore shared by all workers, kept in a Redis sorted set.
+
+    Each holder adds a token scored by time; a holder is admitted if its token
+    ranks within the limit. Tokens older than ``lease_seconds`` are treated as
+    leaked by a dead worker and removed.
+    """
+
+    def __init__(self, redis_client: RedisClient, name: str, limit: int, lease_seconds: float = 300):
+        self.redis_client = redis_client
+        self.key = f"semaphore:{name}"
+        self.limit = limit
+        self.lease_seconds = lease_seconds
+
+    async def try_acquire(self) -> Optional[str]:
+        """Take a slot if one is free. Returns a token for ``release``, or None."""
+        token = uuid.uuid4().hex
+        now = time.time()
+        pipe = self.redis_client.redis.pipeline(transaction=True)
+        pipe.zremrangebyscore(self.key, 0, now - self.lease_seconds)
+        pipe.zadd(self.key, {token: now})
+        pipe.zrank(self.key, token)
+        pipe.expire(self.key, int(self.lease_seconds))
+        _, _, rank, _ = await pipe.execute()
+        if rank is not None and rank < self.limit:
+            return token
+        await self.redis_client.redis.zrem(self.key, token)
+        return None
+
+    async def release(self, token: str) -> None:
+        """Give a slot back."""
+        await self.redis_client.redis.zrem(self.key, token)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Client-side concurrency limiter with an AIMD window.
+
+    Upstream calls take a slot before they start. The window grows by about one
+    slot per window's worth of successful calls (additive increase) and halves
+    when the upstream pushes back with 429s, timeouts or calls slower than
+    ``latency_threshold`` (multiplicative decrease, at most once per
+    ``decrease_cooldown``). Callers beyond the window wait in a bounded FIFO
+    queue; when it is full, or a caller has waited too long, the call fails fast
+    instead of piling more load onto a struggling upstream.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 100,
+        decrease_factor: float = 0.5,
+        latency_threshold: Optional[float] = None,
+        decrease_cooldown: float = 1.0,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+        shared_budget: Optional[RedisSemaphore] = None,
+        shared_poll_interval: float = 0.05,
+    ):
+        """
+        Initialize the limiter.
+
+        Args:
+            initial_limit: Starting concurrency window
+            min_limit: Smallest window
+            max_limit: Largest window
+            decrease_factor: Window multiplier on overload
+            latency_threshold: Calls slower than this (seconds) count as overload
+            decrease_cooldown: Minimum seconds between two decreases
+            max_queue: Maximum number of callers waiting for a slot
+            queue_timeout: Maximum seconds a caller waits for a slot
+            shared_budget: Optional Redis semaphore capping calls across workers
+            shared_poll_interval: Seconds between attempts on the shared budget
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_threshold = latency_threshold
+        self.decrease_cooldown = decrease_cooldown
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.shared_budget = shared_budget
+        self.shared_poll_interval = shared_poll_interval
+
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+
+        # Called with the seconds each caller spent queued
+        self.queue_listeners: List[Callable[[float], None]] = []
+
+        self.stats: Dict[str, Any] = {
+            "acquired": 0,
+            "queued": 0,
+            "rejected": 0,
+            "queue_timeouts": 0,
+            "increases": 0,
+            "decreases": 0,
+            "queue_time_total": 0.0,
+            "queue_time_max": 0.0,
+            "latency_ewma": None,
+        }
+
+    @property
+    def limit(self) -> int:
+        """Current concurrency window."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_length(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Wait for a slot.
+
+        Args:
+            timeout: Maximum seconds to wait (capped at ``queue_timeout``)
+
+        Returns:
+            A shared-budget token to pass to ``release`` (None without Redis)
+
+        Raises:
+            DeepSeekAPIError: If the queue is full or the wait timed out
+        """
+        started = time.monotonic()
+        wait_limit = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+
+        if self._in_flight >= self.limit or self._waiters:
+            if len(self._waiters) >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise DeepSeekAPIError(
+                    "DeepSeek API client is overloaded (too many queued requests). Please try again later.",
+                    reason="queue_full",
+                )
+
+            self.stats["queued"] += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=wait_limit)
+            except asyncio.TimeoutError:
+                self.stats["queue_timeouts"] += 1
+                raise DeepSeekAPIError(
+                    f"DeepSeek API client is overloaded (waited {wait_limit:.0f}s for a slot). Please try again later.",
+                    reason="queue_timeout",
+                )
+            except asyncio.CancelledError:
+                # If we were handed a slot just as we were cancelled, pass it on
+                if waiter.done() and not waiter.cancelled():
+                    self._in_flight -= 1
+                    self._wake_waiters()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        else:
+            self._in_flight += 1
+
+        token = None
+        try:
+            if self.shared_budget is not None:
+                token = await self._acquire_shared(started + wait_limit)
+        except BaseException:
+            self._in_flight -= 1
+            self._wake_waiters()
+            raise
+
+        queue_time = time.monotonic() - started
+        self.stats["acquired"] += 1
+        self.stats["queue_time_total"] += queue_time
+        self.stats["queue_time_max"] = max(self.stats["queue_time_max"], queue_time)
+        for listener in self.queue_listeners:
+            try:
+                listener(queue_time)
+            except Exception as e:
+                logger.error(f"Limiter queue listener failed: {str(e)}")
+        return token
+
+    async def _acquire_shared(self, deadline: float) -> Optional[str]:
+        while True:
+            try:
+                token = await self.shared_budget.try_acquire()
+            except Exception as e:
+                # Redis trouble should not stop traffic; fall back to the local window
+                logger.warning(f"Shared concurrency budget unavailable: {str(e)}")
+                return None
+            if token:
+                return token
+            if time.monotonic() >= deadline:
+                self.stats["queue_timeouts"] += 1
+                raise DeepSeekAPIError(
+                    "DeepSeek API client is overloaded (shared concurrency budget exhausted). Please try again later.",
+                    reason="queue_timeout",
+                )
+            await asyncio.sleep(self.shared_poll_interval)
+
+    def release(self, outcome: str = SUCCESS, latency: Optional[float] = None, token: Optional[str] = None) -> None:
+        """
+        Give a slot back and adjust the window.
+
+        Args:
+            outcome: SUCCESS, OVERLOAD or IGNORE
+            latency: Seconds the call took (used with ``latency_threshold``)
+            token: Shared-budget token returned by ``acquire``
+        """
+        self._in_flight -= 1
+
+        if latency is not None:
+            ewma = self.stats["latency_ewma"]
+            self.stats["latency_ewma"] = latency if ewma is None else 0.8 * ewma + 0.2 * latency
+            if outcome == SUCCESS and self.latency_threshold and latency > self.latency_threshold:
+                outcome = OVERLOAD
+
+        if outcome == SUCCESS:
+            if self._limit < self.max_limit:
+                # +1 slot per full window of successes
+                self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+                self.stats["increases"] += 1
+        elif outcome == OVERLOAD:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.decrease_cooldown:
+                self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                self._last_decrease = now
+                self.stats["decreases"] += 1
+                logger.warning(f"Upstream overloaded; concurrency limit lowered to {self.limit}")
+
+        if token is not None and self.shared_budget is not None:
+            task = asyncio.ensure_future(self.shared_budget.release(token))
+            task.add_done_callback(_log_release_failure)
+
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the current window, usage and queue counters."""
+        acquired = self.stats["acquired"]
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "queue_length": len(self._waiters),
+            "queue_time_avg": self.stats["queue_time_total"] / acquired if acquired else 0.0,
+        }
+
+
+def _log_release_failure(task: asyncio.Future) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Could not release shared concurrency slot: {task.exception()}")
+
+
+def classify_outcome(error: Optional[BaseException]) -> str:
+    """Map the result of an upstream call to a limiter outcome."""
+    if error is None:
+        return SUCCESS
+    if isinstance(error, DeepSeekAPIError) and (error.status == 429 or error.reason == "timeout"):
+        return OVERLOAD
+    if isinstance(error, asyncio.TimeoutError):
+        return OVERLOAD
+    return IGNORE
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception
+
+from app.deepseek.errors import DeepSeekAPIError
+
+logger = logging.getLogger('deepseek_retry')
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given as seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error from an API attempt is worth retrying."""
+    if isinstance(error, DeepSeekAPIError):
+        return error.retryable
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+def _error_reason(error: BaseException) -> str:
+    if isinstance(error, DeepSeekAPIError):
+        return error.reason
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, aiohttp.ClientConnectionError):
+        return "connection"
+    return type(error).__name__
+
+
+class RetryPolicy:
+    """
+    Retry policy for DeepSeek API calls, built on tenacity.
+
+    Retryable errors (429, 5xx, timeouts, dropped connections) are retried with
+    exponential backoff and full jitter; a ``Retry-After`` from the API is
+    honoured as the minimum wait. All attempts and waits share one deadline
+    budget per request, and each attempt gets only the time left in it.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.25,
+        max_delay: float = 8.0,
+        max_retry_after: float = 30.0,
+        min_attempt_time: float = 1.0,
+    ):
+        """
+        Initialize the retry policy.
+
+        Args:
+            max_attempts: Maximum attempts per request, including the first
+            base_delay: Backoff ceiling for the first retry in seconds
+            max_delay: Upper bound of the backoff ceiling in seconds
+            max_retry_after: Longest Retry-After we are willing to wait
+            min_attempt_time: Don't start an attempt with less budget left than this
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.min_attempt_time = min_attempt_time
+
+        # Called with (request_id, attempt number, outcome, duration) after every attempt
+        self.attempt_listeners: List[Callable[[str, int, str, float], None]] = []
+
+        self.stats: Dict[str, Any] = {
+            "requests": 0,
+            "attempts": 0,
+            "retries": 0,
+            "succeeded_after_retry": 0,
+            "exhausted": 0,
+            "fatal": 0,
+            "retry_reasons": {},
+        }
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number ``attempt`` (1-based)."""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    async def call(
+        self,
+        fn: Callable[[float], Awaitable[Any]],
+        request_id: str,
+        deadline: float,
+    ) -> Any:
+        """
+        Call ``fn`` until it succeeds, fails fatally, or the budget runs out.
+
+        Args:
+            fn: Coroutine function taking the timeout (seconds) for one attempt
+            request_id: Request ID for logging
+            deadline: Total seconds allowed for all attempts and waits
+
+        Returns:
+            The result of the first successful attempt; the last error is raised otherwise
+        """
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + deadline
+
+        def remaining() -> float:
+            return deadline_at - loop.time()
+
+        def stop(retry_state: RetryCallState) -> bool:
+            if retry_state.attempt_number >= self.max_attempts:
+                return True
+            left = remaining() - self.min_attempt_time
+            error = retry_state.outcome.exception()
+            retry_after = getattr(error, "retry_after", None)
+            if retry_after is not None and retry_after > min(left, self.max_retry_after):
+                return True
+            return left <= 0
+
+        def wait(retry_state: RetryCallState) -> float:
+            delay = self.backoff(retry_state.attempt_number)
+            retry_after = getattr(retry_state.outcome.exception(), "retry_after", None)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            return max(0.0, min(delay, remaining() - self.min_attempt_time))
+
+        def before_sleep(retry_state: RetryCallState) -> None:
+            error = retry_state.outcome.exception()
+            reason = _error_reason(error)
+            self.stats["retries"] += 1
+            self.stats["retry_reasons"][reason] = self.stats["retry_reasons"].get(reason, 0) + 1
+            logger.warning(
+                f"Request {request_id} attempt {retry_state.attempt_number} failed ({reason}); "
+                f"retrying in {retry_state.next_action.sleep:.2f}s"
+            )
+
+        self.stats["requests"] += 1
+        retrying = AsyncRetrying(
+            stop=stop,
+            wait=wait,
+            retry=retry_if_exception(is_retryable),
+            before_sleep=before_sleep,
+            reraise=True,
+        )
+
+        try:
+            # A failed attempt's exception is captured by tenacity, so code after
+            # the awaited call inside the block only runs on success
+            async for attempt in retrying:
+                with attempt:
+                    attempt_number = attempt.retry_state.attempt_number
+                    self.stats["attempts"] += 1
+                    started = time.time()
+                    outcome = "ok"
+                    try:
+                        result = await fn(max(remaining(), self.min_attempt_time))
+                    except asyncio.CancelledError:
+                        outcome = "cancelled"
+                        raise
+                    except BaseException as e:
+                        outcome = _error_reason(e)
+                        raise
+                    finally:
+                        self._notify(request_id, attempt_number, outcome, time.time() - started)
+                    if attempt_number > 1:
+                        self.stats["succeeded_after_retry"] += 1
+            return result
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            if is_retryable(e):
+                self.stats["exhausted"] += 1
+            else:
+                self.stats["fatal"] += 1
+            raise
+
+    def _notify(self, request_id: str, attempt: int, outcome: str, duration: float) -> None:
+        for listener in self.attempt_listeners:
+            try:
+                listener(request_id, attempt, outcome, duration)
+            except Exception as e:
+                logger.error(f"Retry attempt listener failed: {str(e)}")
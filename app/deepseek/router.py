@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Set
+from urllib.parse import urlparse
+
+import aiohttp
+
+from app import metrics
+from app.deepseek.errors import DeepSeekAPIError
+
+logger = logging.getLogger('deepseek_router')
+
+# Target selection strategies
+LEAST_LATENCY = "least_latency"
+POWER_OF_TWO = "p2c"
+
+
+class UpstreamTarget:
+    """One API key at one OpenAI-compatible base URL, with its health and latency."""
+
+    def __init__(self, name: str, api_base: str, api_key: str):
+        """
+        Initialize the target.
+
+        Args:
+            name: Label for logs and metrics (never contains the key)
+            api_base: Base URL, e.g. https://api.deepseek.com/v1
+            api_key: API key sent as the bearer token
+        """
+        self.name = name
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.url = f"{self.api_base}/chat/completions"
+
+        # Smoothed seconds per call; None until the first success
+        self.ewma_latency: Optional[float] = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        # The target is skipped until this time (monotonic) after a 429 or repeated failures
+        self.cooldown_until = 0.0
+        self.cooldown_reason: Optional[str] = None
+
+        self.stats: Dict[str, int] = {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "rate_limited": 0,
+            "cooldowns": 0,
+        }
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        }
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            **self.stats,
+            "api_base": self.api_base,
+            "ewma_latency": self.ewma_latency,
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "available": self.available(now),
+            "cooldown_for": max(self.cooldown_until - now, 0.0),
+            "cooldown_reason": self.cooldown_reason if not self.available(now) else None,
+        }
+
+
+class UpstreamRouter:
+    """
+    Spreads DeepSeek calls over several API keys and base URLs.
+
+    Every call goes to the best available target: the one with the lowest
+    expected wait (EWMA latency times its calls in flight plus one), either
+    over all targets (``least_latency``) or over two picked at random
+    (``p2c``, which keeps a fast target from being swamped by every worker
+    at once). Targets with no latency yet are tried first.
+
+    A 429 takes the target out of rotation for its Retry-After (or
+    ``rate_limit_cooldown``); ``failure_threshold`` failures in a row (5xx,
+    timeouts, dropped connections) take it out for ``failure_cooldown``; an
+    auth error takes it out for ``auth_cooldown``. The failed call moves on
+    to the next target straight away, without the retry policy's backoff,
+    as long as ``min_failover_time`` of its budget is left.
+    """
+
+    def __init__(
+        self,
+        targets: Sequence[UpstreamTarget],
+        strategy: str = POWER_OF_TWO,
+        ewma_alpha: float = 0.3,
+        failure_threshold: int = 3,
+        failure_cooldown: float = 30.0,
+        rate_limit_cooldown: float = 10.0,
+        auth_cooldown: float = 300.0,
+        min_failover_time: float = 1.0,
+    ):
+        """
+        Initialize the router.
+
+        Args:
+            targets: Upstream targets (at least one)
+            strategy: "p2c" (power of two choices) or "least_latency"
+            ewma_alpha: Weight of the newest latency sample in the moving average
+            failure_threshold: Consecutive failures that put a target in cooldown
+            failure_cooldown: Seconds a failing target is skipped
+            rate_limit_cooldown: Seconds a rate-limited target is skipped without a Retry-After
+            auth_cooldown: Seconds a target whose key was rejected is skipped
+            min_failover_time: Don't fail over with less of the call's budget left than this
+        """
+        if not targets:
+            raise ValueError("UpstreamRouter needs at least one target")
+        if strategy not in (POWER_OF_TWO, LEAST_LATENCY):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.targets = list(targets)
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.failure_cooldown = failure_cooldown
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.auth_cooldown = auth_cooldown
+        self.min_failover_time = min_failover_time
+        self._random = random.Random()
+
+        self.stats: Dict[str, int] = {
+            "calls": 0,
+            "failovers": 0,
+            "all_cooling_down": 0,
+        }
+
+    @classmethod
+    def from_keys(cls, api_bases: Sequence[str], api_keys: Sequence[str], **kwargs: Any) -> "UpstreamRouter":
+        """
+        Build a router with one target per (base URL, key) pair.
+
+        Args:
+            api_bases: Base URLs of the OpenAI-compatible endpoints
+            api_keys: API keys, each valid at every base URL
+            **kwargs: Passed on to the constructor
+        """
+        targets = []
+        for api_base in api_bases:
+            host = urlparse(api_base).netloc or api_base
+            for index, api_key in enumerate(api_keys):
+                name = host if len(api_keys) == 1 else f"{host}#key{index + 1}"
+                targets.append(UpstreamTarget(name, api_base, api_key))
+        return cls(targets, **kwargs)
+
+    def _score(self, target: UpstreamTarget) -> float:
+        # Unmeasured targets score 0 so they get their first samples
+        if target.ewma_latency is None:
+            return 0.0
+        return target.ewma_latency * (target.in_flight + 1)
+
+    def pick(self, exclude: Optional[Set[str]] = None) -> UpstreamTarget:
+        """
+        Choose the target for the next call.
+
+        Args:
+            exclude: Names of targets that already failed this request
+
+        Returns:
+            The best available target; if every target is excluded or cooling
+            down, the one whose cooldown ends first
+        """
+        now = time.monotonic()
+        exclude = exclude or set()
+        candidates = [t for t in self.targets if t.available(now) and t.name not in exclude]
+        if not candidates:
+            candidates = [t for t in self.targets if t.available(now)]
+        if not candidates:
+            self.stats["all_cooling_down"] += 1
+            return min(self.targets, key=lambda t: t.cooldown_until)
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.strategy == POWER_OF_TWO:
+            candidates = self._random.sample(candidates, 2)
+        return min(candidates, key=self._score)
+
+    def record(self, target: UpstreamTarget, error: Optional[BaseException], latency: float) -> None:
+        """
+        Update a target's latency and health with the outcome of a call.
+
+        Args:
+            target: Target the call went to
+            error: The exception the call raised, or None if it succeeded
+            latency: Seconds the call took
+        """
+        if isinstance(error, asyncio.CancelledError):
+            return
+        target.stats["calls"] += 1
+        if error is None:
+            target.stats["successes"] += 1
+            metrics.TARGET_CALLS.inc(target=target.name, result="success")
+            target.consecutive_failures = 0
+            if target.ewma_latency is None:
+                target.ewma_latency = latency
+            else:
+                target.ewma_latency += self.ewma_alpha * (latency - target.ewma_latency)
+            return
+
+        status = getattr(error, "status", None)
+        if status == 429:
+            target.stats["rate_limited"] += 1
+            metrics.TARGET_CALLS.inc(target=target.name, result="rate_limited")
+            retry_after = getattr(error, "retry_after", None)
+            self._cool_down(target, retry_after if retry_after is not None else self.rate_limit_cooldown, "rate_limited")
+        elif status in (401, 403):
+            target.stats["failures"] += 1
+            metrics.TARGET_CALLS.inc(target=target.name, result="failure")
+            self._cool_down(target, self.auth_cooldown, "auth")
+        elif self.is_target_failure(error):
+            target.stats["failures"] += 1
+            metrics.TARGET_CALLS.inc(target=target.name, result="failure")
+            target.consecutive_failures += 1
+            if target.consecutive_failures >= self.failure_threshold:
+                self._cool_down(target, self.failure_cooldown, "failing")
+        else:
+            metrics.TARGET_CALLS.inc(target=target.name, result="other")
+
+    @staticmethod
+    def is_target_failure(error: BaseException) -> bool:
+        """Whether another target might succeed where this one failed (as opposed to a bad request)."""
+        if isinstance(error, DeepSeekAPIError):
+            if error.reason == "circuit_open":
+                return False
+            return error.retryable or error.status in (401, 403)
+        return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+    def _cool_down(self, target: UpstreamTarget, seconds: float, reason: str) -> None:
+        target.cooldown_until = time.monotonic() + seconds
+        target.cooldown_reason = reason
+        target.consecutive_failures = 0
+        target.stats["cooldowns"] += 1
+        logger.warning(f"DeepSeek target {target.name} out of rotation for {seconds:.1f}s ({reason})")
+
+    async def call(
+        self,
+        fn: Callable[[UpstreamTarget, float], Awaitable[Any]],
+        request_id: str,
+        timeout: float,
+    ) -> Any:
+        """
+        Run one API attempt on the best target, failing over to the others.
+
+        Args:
+            fn: Coroutine function taking the target and the timeout (seconds) for the call
+            request_id: Request ID for logging
+            timeout: Seconds allowed for the attempt, failovers included
+
+        Returns:
+            The result of the first target that succeeds; the last error is raised otherwise
+        """
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + timeout
+        tried: Set[str] = set()
+        self.stats["calls"] += 1
+        while True:
+            target = self.pick(exclude=tried)
+            tried.add(target.name)
+            target.in_flight += 1
+            started = loop.time()
+            error = None
+            try:
+                return await fn(target, max(deadline_at - started, 0.0))
+            except BaseException as e:
+                error = e
+                now = time.monotonic()
+                can_fail_over = (
+                    self.is_target_failure(e)
+                    and any(t.available(now) and t.name not in tried for t in self.targets if t is not target)
+                    and deadline_at - loop.time() >= self.min_failover_time
+                )
+                if not can_fail_over:
+                    raise
+                self.stats["failovers"] += 1
+                metrics.FAILOVERS.inc()
+                logger.warning(f"Request {request_id} failed on {target.name} ({getattr(e, 'reason', type(e).__name__)}); failing over")
+            finally:
+                target.in_flight -= 1
+                self.record(target, error, loop.time() - started)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the strategy, counters and the state of every target."""
+        return {
+            **self.stats,
+            "strategy": self.strategy,
+            "targets": {target.name: target.snapshot() for target in self.targets},
+        }
@@ -0,0 +1,448 @@
+"""
+OpenAI-compatible stand-in for the DeepSeek API, for offline load and latency testing.
+
+Unlike the wrapper's mock mode, requests go through the real HTTP, pooling,
+retry, limiter and streaming code. Run it and point the app at it:
+
+    python -m app.deepseek.stub_server
+    DEEPSEEK_API_BASE=http://127.0.0.1:8001/v1 DEEPSEEK_API_KEY=stub python app/main.py
+
+Behaviour is configured with STUB_* environment variables (see ``StubConfig.from_env``).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('deepseek_stub')
+
+_WORDS = (
+    "technology business growth digital marketing content brand audience strategy "
+    "customers innovation cloud data insights platform social engagement campaign "
+    "product value quality service trust community results performance solution"
+).split()
+
+# Prompt prefixes are cached in units of this many tokens, as DeepSeek does
+PROMPT_CACHE_UNIT = 64
+PROMPT_CACHE_MAX_PREFIXES = 10000
+
+# Latency distributions
+FIXED = "fixed"
+LOGNORMAL = "lognormal"
+LONG_TAIL = "long_tail"
+
+
+class StubConfig:
+    """Latency, pacing, error and size settings for the stand-in server."""
+
+    def __init__(
+        self,
+        latency_distribution: str = FIXED,
+        latency_ms: float = 200.0,
+        latency_sigma: float = 0.5,
+        tail_probability: float = 0.05,
+        tail_multiplier: float = 10.0,
+        tokens_per_second: float = 50.0,
+        response_tokens: int = 100,
+        response_tokens_jitter: float = 0.2,
+        error_rate_429: float = 0.0,
+        error_rate_500: float = 0.0,
+        timeout_rate: float = 0.0,
+        timeout_hang_seconds: float = 300.0,
+        retry_after: Optional[float] = 1.0,
+        function_call_rate: float = 0.0,
+        tool_calls_per_turn: int = 1,
+        seed: Optional[int] = None,
+    ):
+        """
+        Initialize the configuration.
+
+        Args:
+            latency_distribution: "fixed", "lognormal" or "long_tail" time to first token
+            latency_ms: Fixed latency, or the median for lognormal/long_tail
+            latency_sigma: Spread (sigma of the underlying normal) for lognormal/long_tail
+            tail_probability: Fraction of long_tail requests that are slow
+            tail_multiplier: How much slower a long_tail slow request is
+            tokens_per_second: Generation speed after the first token (0 for instant)
+            response_tokens: Mean number of tokens (words) per response
+            response_tokens_jitter: Relative random variation of the response size
+            error_rate_429: Fraction of requests answered with 429
+            error_rate_500: Fraction of requests answered with 500
+            timeout_rate: Fraction of requests that hang until the client gives up
+            timeout_hang_seconds: How long a hanging request hangs
+            retry_after: Retry-After header on 429 responses (None to omit)
+            function_call_rate: Chance of a function call when functions are offered
+                (a prompt containing "search" always triggers one)
+            tool_calls_per_turn: Tools called at once when ``tools`` are offered
+                (web_search first, then the others in the order offered)
+            seed: Random seed for reproducible runs
+        """
+        self.latency_distribution = latency_distribution
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tail_probability = tail_probability
+        self.tail_multiplier = tail_multiplier
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.response_tokens_jitter = response_tokens_jitter
+        self.error_rate_429 = error_rate_429
+        self.error_rate_500 = error_rate_500
+        self.timeout_rate = timeout_rate
+        self.timeout_hang_seconds = timeout_hang_seconds
+        self.retry_after = retry_after
+        self.function_call_rate = function_call_rate
+        self.tool_calls_per_turn = tool_calls_per_turn
+        self.seed = seed
+
+    @classmethod
+    def from_env(cls) -> "StubConfig":
+        """Build a configuration from STUB_* environment variables."""
+        retry_after = os.getenv("STUB_RETRY_AFTER", "1")
+        seed = os.getenv("STUB_SEED")
+        return cls(
+            latency_distribution=os.getenv("STUB_LATENCY_DISTRIBUTION", FIXED),
+            latency_ms=float(os.getenv("STUB_LATENCY_MS", "200")),
+            latency_sigma=float(os.getenv("STUB_LATENCY_SIGMA", "0.5")),
+            tail_probability=float(os.getenv("STUB_TAIL_PROBABILITY", "0.05")),
+            tail_multiplier=float(os.getenv("STUB_TAIL_MULTIPLIER", "10")),
+            tokens_per_second=float(os.getenv("STUB_TOKENS_PER_SECOND", "50")),
+            response_tokens=int(os.getenv("STUB_RESPONSE_TOKENS", "100")),
+            response_tokens_jitter=float(os.getenv("STUB_RESPONSE_TOKENS_JITTER", "0.2")),
+            error_rate_429=float(os.getenv("STUB_ERROR_RATE_429", "0")),
+            error_rate_500=float(os.getenv("STUB_ERROR_RATE_500", "0")),
+            timeout_rate=float(os.getenv("STUB_TIMEOUT_RATE", "0")),
+            timeout_hang_seconds=float(os.getenv("STUB_TIMEOUT_HANG_SECONDS", "300")),
+            retry_after=float(retry_after) if retry_after else None,
+            function_call_rate=float(os.getenv("STUB_FUNCTION_CALL_RATE", "0")),
+            tool_calls_per_turn=int(os.getenv("STUB_TOOL_CALLS_PER_TURN", "1")),
+            seed=int(seed) if seed else None,
+        )
+
+
+class StubServer:
+    """
+    aiohttp application answering ``/chat/completions`` like the DeepSeek API.
+
+    Supports plain and SSE-streamed responses, tool calls when ``tools``
+    (or legacy ``functions``) are sent, injected 429/500/hanging requests, and exposes
+    its own counters at ``/stats``.
+    """
+
+    def __init__(self, config: Optional[StubConfig] = None):
+        """
+        Initialize the server.
+
+        Args:
+            config: Behaviour settings (defaults to ``StubConfig()``)
+        """
+        self.config = config or StubConfig()
+        self._random = random.Random(self.config.seed)
+        self.in_flight = 0
+        self.stats: Dict[str, Any] = {
+            "requests": 0,
+            "streamed": 0,
+            "function_calls": 0,
+            "errors_429": 0,
+            "errors_500": 0,
+            "timeouts": 0,
+            "peak_in_flight": 0,
+            "prompt_cache_hit_tokens": 0,
+            "prompt_cache_miss_tokens": 0,
+        }
+        # Digests of prompt prefixes seen so far (oldest first)
+        self._prompt_prefixes: "OrderedDict[str, None]" = OrderedDict()
+
+    def create_app(self) -> web.Application:
+        """Create the aiohttp application (routes with and without the /v1 prefix)."""
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        for prefix in ("", "/v1"):
+            app.router.add_post(f"{prefix}/chat/completions", self.handle_completion)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "in_flight": self.in_flight})
+
+    def _first_token_latency(self) -> float:
+        """Draw the time to first token in seconds."""
+        config = self.config
+        median = config.latency_ms / 1000
+        if config.latency_distribution == LOGNORMAL:
+            return self._random.lognormvariate(math.log(median), config.latency_sigma)
+        if config.latency_distribution == LONG_TAIL:
+            latency = self._random.lognormvariate(math.log(median), config.latency_sigma)
+            if self._random.random() < config.tail_probability:
+                latency *= config.tail_multiplier
+            return latency
+        return median
+
+    def _response_size(self) -> int:
+        jitter = self.config.response_tokens_jitter
+        scale = 1 + self._random.uniform(-jitter, jitter)
+        return max(1, int(round(self.config.response_tokens * scale)))
+
+    def _token_delay(self) -> float:
+        return 1 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0.0
+
+    def _injected_error(self) -> Optional[str]:
+        """Pick an injected failure for this request, if any."""
+        roll = self._random.random()
+        config = self.config
+        for kind, rate in (("429", config.error_rate_429), ("500", config.error_rate_500), ("timeout", config.timeout_rate)):
+            if roll < rate:
+                return kind
+            roll -= rate
+        return None
+
+    def _function_calls(self, body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Return the function calls for the request (name and JSON arguments), or [] for a text answer."""
+        functions = body.get("functions") or [
+            tool.get("function", {}) for tool in body.get("tools") or []
+        ]
+        messages: List[Dict[str, Any]] = body.get("messages") or []
+        if not functions or not messages or messages[-1].get("role") != "user":
+            return []
+        prompt = messages[-1].get("content") or ""
+        if "search" not in prompt.lower() and self._random.random() >= self.config.function_call_rate:
+            return []
+
+        # Legacy function calling allows one call per turn
+        count = self.config.tool_calls_per_turn if body.get("tools") else 1
+        ordered = sorted(functions, key=lambda f: f.get("name") != "web_search")
+        calls = []
+        for function in ordered[:max(count, 1)]:
+            parameters = function.get("parameters") or {}
+            arguments = {
+                name: prompt if schema.get("type", "string") == "string" else None
+                for name, schema in (parameters.get("properties") or {}).items()
+                if name in (parameters.get("required") or [])
+            }
+            calls.append({"name": function.get("name", ""), "arguments": json.dumps(arguments, ensure_ascii=False)})
+        return calls
+
+    @staticmethod
+    def _finish_reason(function_calls: List[Dict[str, Any]], use_tools: bool) -> str:
+        if not function_calls:
+            return "stop"
+        return "tool_calls" if use_tools else "function_call"
+
+    @staticmethod
+    def _prompt_tokens(body: Dict[str, Any]) -> int:
+        # Rough estimate: about four characters per token
+        return max(1, len(json.dumps(body.get("messages") or [], ensure_ascii=False)) // 4)
+
+    def _prompt_cache_usage(self, body: Dict[str, Any], prompt_tokens: int) -> Tuple[int, int]:
+        """
+        Emulate DeepSeek's prompt prefix cache.
+
+        Prefixes are the tools plus the first 1..n messages. The hit tokens
+        are those of the longest prefix seen in an earlier request, rounded
+        down to whole cache units; the rest are misses.
+
+        Returns:
+            (prompt_cache_hit_tokens, prompt_cache_miss_tokens)
+        """
+        messages = body.get("messages") or []
+        tools = body.get("tools") or body.get("functions") or []
+        digest = hashlib.sha256(json.dumps(tools, ensure_ascii=False).encode("utf-8"))
+        hit_tokens = 0
+        for i, message in enumerate(messages):
+            digest.update(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+            key = digest.hexdigest()
+            if key in self._prompt_prefixes:
+                self._prompt_prefixes.move_to_end(key)
+                hit_tokens = self._prompt_tokens({"messages": messages[:i + 1]})
+            else:
+                self._prompt_prefixes[key] = None
+        while len(self._prompt_prefixes) > PROMPT_CACHE_MAX_PREFIXES:
+            self._prompt_prefixes.popitem(last=False)
+        hit_tokens = min(prompt_tokens, hit_tokens // PROMPT_CACHE_UNIT * PROMPT_CACHE_UNIT)
+        return hit_tokens, prompt_tokens - hit_tokens
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        """Answer a chat completion request, streamed or not."""
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+        try:
+            try:
+                body = await request.json()
+            except json.JSONDecodeError:
+                return web.json_response({"error": {"message": "Invalid JSON body"}}, status=400)
+
+            error = self._injected_error()
+            if error == "timeout":
+                self.stats["timeouts"] += 1
+                await asyncio.sleep(self.config.timeout_hang_seconds)
+            if error == "429":
+                self.stats["errors_429"] += 1
+                headers = {}
+                if self.config.retry_after is not None:
+                    headers["Retry-After"] = f"{self.config.retry_after:g}"
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                    status=429,
+                    headers=headers,
+                )
+            if error == "500":
+                self.stats["errors_500"] += 1
+                return web.json_response({"error": {"message": "Internal server error"}}, status=500)
+
+            await asyncio.sleep(self._first_token_latency())
+
+            function_calls = self._function_calls(body)
+            use_tools = bool(body.get("tools"))
+            if function_calls:
+                self.stats["function_calls"] += len(function_calls)
+                words = []
+            else:
+                words = [self._random.choice(_WORDS) for _ in range(self._response_size())]
+
+            completion_id = f"stub-{uuid.uuid4().hex}"
+            model = body.get("model", "deepseek-chat")
+            usage = {
+                "prompt_tokens": self._prompt_tokens(body),
+                "completion_tokens": len(words) or 10,
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            usage["prompt_cache_hit_tokens"], usage["prompt_cache_miss_tokens"] = self._prompt_cache_usage(
+                body, usage["prompt_tokens"]
+            )
+            self.stats["prompt_cache_hit_tokens"] += usage["prompt_cache_hit_tokens"]
+            self.stats["prompt_cache_miss_tokens"] += usage["prompt_cache_miss_tokens"]
+
+            if body.get("stream"):
+                self.stats["streamed"] += 1
+                return await self._stream(request, completion_id, model, words, function_calls, use_tools, usage)
+
+            # Non-streaming responses arrive once the whole answer is generated
+            await asyncio.sleep(len(words) * self._token_delay())
+            message: Dict[str, Any] = {"role": "assistant", "content": None if function_calls else " ".join(words)}
+            if function_calls and use_tools:
+                message["tool_calls"] = [
+                    {"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function", "function": call}
+                    for call in function_calls
+                ]
+            elif function_calls:
+                message["function_call"] = function_calls[0]
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": self._finish_reason(function_calls, use_tools),
+                    }
+                ],
+                "usage": usage,
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(
+        self,
+        request: web.Request,
+        completion_id: str,
+        model: str,
+        words: List[str],
+        function_calls: List[Dict[str, Any]],
+        use_tools: bool,
+        usage: Dict[str, int],
+    ) -> web.StreamResponse:
+        """
+        Send the answer as server-sent ``chat.completion.chunk`` events, paced per token.
+
+        Like the DeepSeek API, the last chunk has no choices and carries the
+        ``usage`` of the whole stream.
+        """
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        created = int(time.time())
+
+        async def write(chunk: Dict[str, Any]) -> None:
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        async def send(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> None:
+            await write({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        delay = self._token_delay()
+        if function_calls and use_tools:
+            # Each call is announced with its id and name, then its arguments follow in fragments
+            for index, call in enumerate(function_calls):
+                head = {"index": index, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                        "function": {"name": call["name"], "arguments": ""}}
+                delta: Dict[str, Any] = {"tool_calls": [head]}
+                if index == 0:
+                    delta.update(role="assistant", content=None)
+                await send(delta)
+                arguments = call["arguments"]
+                for start in range(0, len(arguments), 16):
+                    await send({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + 16]}}]})
+                    if delay:
+                        await asyncio.sleep(delay)
+            await send({}, "tool_calls")
+        elif function_calls:
+            function_call = function_calls[0]
+            await send({"role": "assistant", "content": None, "function_call": {"name": function_call["name"], "arguments": ""}})
+            arguments = function_call["arguments"]
+            for start in range(0, len(arguments), 16):
+                await send({"function_call": {"arguments": arguments[start:start + 16]}})
+                if delay:
+                    await asyncio.sleep(delay)
+            await send({}, "function_call")
+        else:
+            for i, word in enumerate(words):
+                delta = {"content": word if i == 0 else f" {word}"}
+                if i == 0:
+                    delta["role"] = "assistant"
+                await send(delta)
+                if delay:
+                    await asyncio.sleep(delay)
+            await send({}, "stop")
+
+        await write({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [],
+            "usage": usage,
+        })
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+if __name__ == "__main__":
+    host = os.getenv("STUB_HOST", "127.0.0.1")
+    port = int(os.getenv("STUB_PORT", "8001"))
+    config = StubConfig.from_env()
+    logger.info(
+        f"DeepSeek stand-in listening on http://{host}:{port}/v1 "
+        f"({config.latency_distribution} latency, {config.latency_ms:g}ms, {config.tokens_per_second:g} tokens/s)"
+    )
+    # No access log: per-request logging would skew load-test numbers
+    web.run_app(StubServer(config).create_app(), host=host, port=port, print=None, access_log=None)
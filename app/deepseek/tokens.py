@@ -0,0 +1,130 @@
+import json
+import math
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+# Characters per token by kind of text, calibrated against the deepseek-chat
+# byte-level BPE vocabulary. English words are mostly single tokens; Vietnamese
+# syllables with diacritics usually split into two or three byte-level pieces.
+DEFAULT_CALIBRATION: Dict[str, float] = {
+    "latin": 6.0,  # ASCII words
+    "vietnamese": 2.5,  # Latin words with diacritics (Vietnamese and other accented text)
+    "digits": 3.0,  # numbers are split into groups of up to three digits
+    "cjk": 1.0,  # one token per Han/Kana/Hangul character
+    "other_word": 2.0,  # words in other scripts
+    "symbol": 1.0,  # punctuation and symbols
+    "emoji": 0.5,  # emoji are several bytes, usually two tokens each
+}
+
+# Tokens added per chat message for role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Pre-tokenizer: words, digit runs, newline runs, and single other characters;
+# a leading space merges into the following word like in the BPE vocabulary
+_PIECE_PATTERN = re.compile(r" ?[^\W\d_]+| ?\d+|\n+|\s+|.", re.UNICODE)
+
+
+def _is_cjk(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x4E00 <= code <= 0x9FFF  # CJK unified ideographs
+        or 0x3400 <= code <= 0x4DBF
+        or 0x3040 <= code <= 0x30FF  # Hiragana, Katakana
+        or 0xAC00 <= code <= 0xD7AF  # Hangul
+    )
+
+
+def _is_emoji(ch: str) -> bool:
+    code = ord(ch)
+    return 0x1F000 <= code <= 0x1FAFF or 0x2600 <= code <= 0x27BF
+
+
+class TokenEstimator:
+    """
+    Local token counter approximating the deepseek-chat tokenizer.
+
+    Text is pre-tokenized into words, numbers and symbols; each piece is
+    charged by its length and a chars-per-token ratio from the calibration
+    table. Estimates are approximate, but close enough to keep prompts
+    within a budget without shipping the real tokenizer.
+    """
+
+    def __init__(self, calibration: Optional[Dict[str, float]] = None):
+        """
+        Initialize the estimator.
+
+        Args:
+            calibration: Characters per token by text kind (merged over the defaults)
+        """
+        self.calibration = {**DEFAULT_CALIBRATION, **(calibration or {})}
+
+    def _piece_tokens(self, piece: str) -> int:
+        word = piece.lstrip(" ")
+        if not word:
+            return 1
+        if word[0] == "\n":
+            return 1
+        if word[0].isdigit():
+            return math.ceil(len(word) / self.calibration["digits"])
+        if word[0].isspace():
+            return math.ceil(len(word) / 4)
+        if word[0].isalpha():
+            if word.isascii():
+                return math.ceil(len(word) / self.calibration["latin"])
+            if _is_cjk(word[0]):
+                return math.ceil(len(word) / self.calibration["cjk"])
+            if unicodedata.name(word[0], "").startswith("LATIN"):
+                return math.ceil(len(word) / self.calibration["vietnamese"])
+            return math.ceil(len(word) / self.calibration["other_word"])
+        if _is_emoji(word[0]):
+            return math.ceil(1 / self.calibration["emoji"])
+        return math.ceil(len(word) / self.calibration["symbol"])
+
+    def count(self, text: Optional[str]) -> int:
+        """Estimate the number of tokens in a text."""
+        if not text:
+            return 0
+        text = unicodedata.normalize("NFC", text)
+        return sum(self._piece_tokens(piece) for piece in _PIECE_PATTERN.findall(text))
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        """Estimate the tokens a chat message adds to the prompt."""
+        tokens = MESSAGE_OVERHEAD_TOKENS + self.count(message.get("content"))
+        if message.get("name"):
+            tokens += self.count(message["name"])
+        if message.get("function_call"):
+            tokens += self.count(json.dumps(message["function_call"], ensure_ascii=False))
+        if message.get("tool_calls"):
+            tokens += self.count(json.dumps(message["tool_calls"], ensure_ascii=False))
+        return tokens
+
+    def count_messages(
+        self,
+        messages: List[Dict[str, Any]],
+        functions: Optional[List[Dict[str, Any]]] = None,
+    ) -> int:
+        """Estimate the prompt tokens of a request, including function schemas."""
+        tokens = sum(self.count_message(message) for message in messages)
+        if functions:
+            tokens += self.count(json.dumps(functions, ensure_ascii=False))
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut a text to roughly ``max_tokens`` tokens, keeping its beginning."""
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        end = max(int(len(text) * max_tokens / total), 0)
+        while end > 0 and self.count(text[:end]) > max_tokens:
+            end = int(end * 0.9)
+        return text[:end]
+
+
+# Shared default instance
+default_estimator = TokenEstimator()
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Estimate the number of deepseek-chat tokens in a text."""
+    return default_estimator.count(text)
@@ -1,18 +1,71 @@
 ﻿import aiohttp
+import copy
+import hashlib
 import json
 import os
 import time
 import asyncio
 import logging
 import uuid
-from typing import Dict, List, Optional, Any, Union
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Any, Sequence, Union
 
+from app import fastjson, metrics
+from app.cache.memory import LRUCache
 from app.cache.redis import RedisClient
+from app.cache.similarity import SimilarityCache
+from app.cache.singleflight import SingleFlight
+from app.cache.tiered import TieredCache
+from app.deepseek.breaker import CircuitBreaker
+from app.deepseek.cassette import Cassette, ReplayedStream
+from app.deepseek.errors import DeepSeekAPIError, RETRYABLE_STATUS_CODES
+from app.deepseek.limiter import AdaptiveConcurrencyLimiter, IGNORE, SUCCESS, classify_outcome
+from app.deepseek.retry import RetryPolicy, parse_retry_after
+from app.deepseek.router import UpstreamRouter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('deepseek_wrapper')
 
+# Bump whenever the cache key layout changes so stale entries are never read
+CACHE_KEY_VERSION = 3
+
+# Fallbacks tried in order while the circuit breaker is open
+FALLBACK_STALE_CACHE = "stale_cache"
+FALLBACK_RULE_BASED = "rule_based"
+DEFAULT_FALLBACK_CHAIN = (FALLBACK_STALE_CACHE, FALLBACK_RULE_BASED)
+
+
+def create_http_session(
+    pool_size: int = 100,
+    pool_size_per_host: int = 20,
+    dns_cache_ttl: int = 300,
+    keepalive_timeout: float = 30.0,
+) -> aiohttp.ClientSession:
+    """
+    Create a keep-alive HTTP session for talking to the DeepSeek API.
+    
+    The session reuses TCP/TLS connections and caches DNS lookups, so only the
+    first request to a host pays for the handshake.
+    
+    Args:
+        pool_size: Maximum number of open connections
+        pool_size_per_host: Maximum number of open connections per host
+        dns_cache_ttl: Seconds to cache resolved addresses
+        keepalive_timeout: Seconds an idle connection is kept open
+        
+    Returns:
+        A new aiohttp ClientSession; the caller is responsible for closing it
+    """
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
 class DeepSeekWrapper:
     """
     Wrapper class for the DeepSeek API with async methods and Redis caching.
@@ -27,6 +80,26 @@ def __init__(
         cache_ttl: int = 3600,  # 1 hour cache by default
         request_timeout: int = 60,  # Default timeout in seconds
         mock_mode: bool = False,  # Enable mock mode for testing without API
+        session: Optional[aiohttp.ClientSession] = None,  # Shared HTTP session (pool)
+        pool_size: int = 100,  # Total connections in the pool
+        pool_size_per_host: int = 20,  # Connections per upstream host
+        dns_cache_ttl: int = 300,  # Seconds to cache DNS lookups
+        keepalive_timeout: float = 30.0,  # Seconds to keep idle connections open
+        memory_cache_max_entries: int = 1000,  # In-memory cache entry limit
+        memory_cache_max_bytes: int = 16 * 1024 * 1024,  # In-memory cache size limit
+        l1_cache_ttl: Optional[int] = 300,  # TTL for the in-process tier in front of Redis
+        cache_write_behind: bool = False,  # Write to Redis in the background
+        coalesce_across_workers: bool = False,  # Use a Redis lock to coalesce across processes
+        coalesce_poll_interval: float = 0.1,  # Seconds between cache checks while another worker fetches
+        similarity_cache: Optional[SimilarityCache] = None,  # Opt-in near-duplicate prompt cache
+        retry_policy: Optional[RetryPolicy] = None,  # Backoff policy for transient API errors
+        concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,  # Bounds concurrent API calls
+        circuit_breaker: Optional[CircuitBreaker] = None,  # Fails fast while the API is down
+        fallback_chain: Sequence[str] = DEFAULT_FALLBACK_CHAIN,  # Fallbacks while the circuit is open
+        fallback_responder: Optional[Callable[[str], str]] = None,  # Rule-based answer for a prompt
+        stale_cache_ttl: Optional[int] = 86400,  # How long stale copies are kept for fallback
+        cassette: Optional[Cassette] = None,  # Records API traffic, or replays it instead of calling the API
+        router: Optional[UpstreamRouter] = None,  # Spreads calls over several API keys/base URLs
     ):
         self.api_key = api_key
         self.api_base = api_base
@@ -35,65 +108,177 @@ def __init__(
         self.cache_ttl = cache_ttl
         self.request_timeout = request_timeout
         self.mock_mode = mock_mode or api_key.lower() in ("", "your_api_key_here", "none", "test")
+        # A replayed cassette stands in for the API, so no key is needed
+        self.cassette = cassette
+        if cassette is not None and cassette.replaying:
+            self.mock_mode = False
+            logger.warning(f"DeepSeek wrapper replaying cassette {cassette.path} - no actual API calls will be made")
         if self.mock_mode:
             logger.warning("DeepSeek wrapper running in MOCK MODE - no actual API calls will be made")
             
-        # In-memory cache as fallback when Redis is not available
-        self._memory_cache = {}
-        # To store active requests for cancellation
+        # Connection pool settings, used when the wrapper owns its session
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        # Long-lived HTTP session; only closed by us if we created it
+        self._session = session
+        self._owns_session = session is None
+            
+        # In-process L1 cache; sits in front of Redis, or stands alone without it
+        self._memory_cache = LRUCache(
+            max_entries=memory_cache_max_entries,
+            max_bytes=memory_cache_max_bytes,
+            default_ttl=cache_ttl,
+        )
+        # Without Redis the L1 is the only tier, so it keeps the full TTL
+        self._cache = TieredCache(
+            l1=self._memory_cache,
+            l2=redis_client,
+            l1_ttl=min(l1_cache_ttl, cache_ttl) if redis_client and l1_cache_ttl else cache_ttl,
+            l2_ttl=cache_ttl,
+            write_behind=cache_write_behind,
+            stale_ttl=stale_cache_ttl if FALLBACK_STALE_CACHE in fallback_chain else None,
+        )
+        # Retries 429/5xx/timeouts within each request's timeout budget
+        self.retry_policy = retry_policy or RetryPolicy()
+        
+        # Adapts how many API calls run at once to what the upstream can take
+        self.limiter = concurrency_limiter or AdaptiveConcurrencyLimiter()
+        
+        # Picks the API key and base URL for each call; just api_key at api_base by default
+        self.router = router or UpstreamRouter.from_keys([api_base], [api_key])
+        
+        # Stops calling the API while it is failing and serves fallbacks instead
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.fallback_chain = tuple(fallback_chain)
+        self.fallback_responder = fallback_responder
+        
+        # Serves cached completions for prompts that differ only trivially
+        self.similarity_cache = similarity_cache
+        
+        # Identical cacheable requests in flight share one upstream call
+        self._single_flight = SingleFlight()
+        self.coalesce_across_workers = coalesce_across_workers
+        self.coalesce_poll_interval = coalesce_poll_interval
+        
+        # To store active request tasks for cancellation
         self._active_requests = {}
 
-    async def _generate_cache_key(self, messages: List[Dict[str, str]], model: str) -> str:
-        """Generate a unique cache key for the request."""
-        cache_data = {
+    async def start(self) -> None:
+        """Open the shared HTTP session and cache listeners. Call once at application startup."""
+        await self._get_session()
+        await self._cache.start()
+
+    async def close(self) -> None:
+        """Close the shared HTTP session if this wrapper owns it. Call at shutdown."""
+        await self._cache.stop()
+        if self._owns_session and self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the pooled HTTP session, creating it on first use."""
+        if self._session is None or self._session.closed:
+            self._session = create_http_session(
+                pool_size=self.pool_size,
+                pool_size_per_host=self.pool_size_per_host,
+                dns_cache_ttl=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._owns_session = True
+        return self._session
+
+    def _build_payload(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        functions: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """Build the chat completion request payload, offering ``functions`` as tools."""
+        payload = {
+            "model": self.model,
             "messages": messages,
-            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
         }
-        return f"deepseek:{hash(json.dumps(cache_data, sort_keys=True))}"
+        if functions:
+            payload["tools"] = [{"type": "function", "function": function} for function in functions]
+        return payload
+
+    @staticmethod
+    def _serialize_payload(payload: Dict[str, Any]) -> bytes:
+        """Serialize a request payload to canonical JSON (sorted keys, no whitespace)."""
+        return fastjson.dumpb(payload, sort_keys=True)
+
+    def _generate_cache_key(self, body: bytes) -> str:
+        """
+        Generate a stable cache key for a serialized request payload.
+        
+        The key is a SHA-256 digest of the canonical request body, so it is the
+        same in every worker and across restarts, and covers every parameter that
+        affects the output (messages, temperature, max_tokens, tools).
+        
+        Args:
+            body: Canonical JSON request body from ``_serialize_payload``
+            
+        Returns:
+            Cache key namespaced by key-schema version and model
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        return f"deepseek:v{CACHE_KEY_VERSION}:{self.model}:{digest}"
 
     async def _get_cached_response(self, cache_key: str) -> Optional[Dict[str, Any]]:
-        """Get cached response if available."""
-        if self.redis_client:
-            cached = await self.redis_client.get(cache_key)
-            if cached:
-                return json.loads(cached)
-        else:
-            # Use in-memory cache if Redis is not available
-            if cache_key in self._memory_cache:
-                cache_entry = self._memory_cache[cache_key]
-                # Check if cache entry is still valid
-                if cache_entry["expires"] > time.time():
-                    return cache_entry["data"]
-                else:
-                    # Remove expired entry
-                    del self._memory_cache[cache_key]
-        return None
+        """Get cached response if available (L1 memory, then Redis)."""
+        return await self._cache.get(cache_key)
 
     async def _cache_response(self, cache_key: str, response: Dict[str, Any]) -> None:
-        """Cache the response with TTL."""
-        if self.redis_client:
-            await self.redis_client.set(
-                cache_key, json.dumps(response), expire=self.cache_ttl
-            )
-        else:
-            # Use in-memory cache if Redis is not available
-            self._memory_cache[cache_key] = {
-                "data": response,
-                "expires": time.time() + self.cache_ttl
-            }
+        """Cache the response in both tiers."""
+        await self._cache.set(cache_key, response)
+
+    async def invalidate_cached_response(self, cache_key: str) -> None:
+        """Remove a cached response from every tier and every worker's L1."""
+        await self._cache.delete(cache_key)
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Return per-tier hit/miss/eviction and request coalescing stats."""
+        stats = self._cache.stats()
+        stats["single_flight"] = self._single_flight.stats()
+        if self.similarity_cache is not None:
+            stats["similarity"] = self.similarity_cache.stats()
+        return stats
+
+    def get_limiter_stats(self) -> Dict[str, Any]:
+        """Return the concurrency window, in-flight calls and queue-time stats."""
+        return self.limiter.snapshot()
+
+    def get_breaker_stats(self) -> Dict[str, Any]:
+        """Return the circuit breaker state, failure rates and fallback counters."""
+        return self.circuit_breaker.snapshot()
+
+    def get_router_stats(self) -> Dict[str, Any]:
+        """Return the health, latency and failover counters of each upstream target."""
+        return self.router.snapshot()
+
+    def get_retry_stats(self) -> Dict[str, Any]:
+        """Return attempt, retry and failure counters for API calls."""
+        return self.retry_policy.stats
+
+    def report_similarity_false_hit(self, entry_id: str) -> bool:
+        """
+        Record that a similarity cache hit returned the wrong answer and drop it.
+        
+        Args:
+            entry_id: ``entry_id`` from the ``similarity`` field of the response
             
-            # Simple cache cleanup - remove oldest entries if cache gets too large
-            if len(self._memory_cache) > 100:  # Arbitrary limit
-                # Remove expired entries first
-                now = time.time()
-                expired_keys = [k for k, v in self._memory_cache.items() if v["expires"] <= now]
-                for k in expired_keys:
-                    del self._memory_cache[k]
-                
-                # If still too many entries, remove oldest
-                if len(self._memory_cache) > 100:
-                    oldest_key = min(self._memory_cache.keys(), key=lambda k: self._memory_cache[k]["expires"])
-                    del self._memory_cache[oldest_key]
+        Returns:
+            True if the entry was found and dropped
+        """
+        if self.similarity_cache is None or not self.similarity_cache.report_false_hit(entry_id):
+            return False
+        metrics.SIMILARITY_FALSE_HITS.inc()
+        return True
 
     def cancel_request(self, request_id: str) -> bool:
         """
@@ -106,12 +291,11 @@ def cancel_request(self, request_id: str) -> bool:
             True if a request was found and cancelled, False otherwise
         """
         if request_id in self._active_requests:
-            session, task = self._active_requests[request_id]
+            task = self._active_requests[request_id]
             if not task.done():
                 logger.info(f"Cancelling request {request_id}")
-                # Close the session which will abort any ongoing requests
-                session.close()
-                # Cancel the task
+                # Cancel the task; aiohttp releases its connection back to the
+                # pool, so the shared session stays usable for other requests
                 task.cancel()
                 # Remove from active requests
                 del self._active_requests[request_id]
@@ -136,8 +320,8 @@ async def _generate_mock_response(self, messages: List[Dict[str, str]], function
         # Generate a mock response
         await asyncio.sleep(1)  # Simulate API latency
         
-        # Check if we should generate a function call
-        if functions and "search" in last_message.lower():
+        # Check if we should generate a tool call (not when answering tool results)
+        if functions and messages and messages[-1].get("role") == "user" and "search" in last_message.lower():
             # Mock a web search function call
             search_function = None
             for func in functions:
@@ -146,6 +330,10 @@ async def _generate_mock_response(self, messages: List[Dict[str, str]], function
                     break
                     
             if search_function:
+                # Name the argument after the tool's schema ("query"); tools now get their
+                # arguments as a validated dict, so the old "search_term" would be rejected
+                required = (search_function.get("parameters") or {}).get("required") or ["query"]
+                argument = required[0]
                 return {
                     "id": f"mock-{uuid.uuid4()}",
                     "object": "chat.completion",
@@ -157,13 +345,19 @@ async def _generate_mock_response(self, messages: List[Dict[str, str]], function
                             "message": {
                                 "role": "assistant",
                                 "content": None,
-                                "function_call": {
-                                    "name": "web_search",
-                                    "arguments": json.dumps({"search_term": last_message})
-                                },
+                                "tool_calls": [
+                                    {
+                                        "id": f"call_{uuid.uuid4().hex[:24]}",
+                                        "type": "function",
+                                        "function": {
+                                            "name": "web_search",
+                                            "arguments": json.dumps({argument: last_message})
+                                        }
+                                    }
+                                ],
                                 "previous_messages": messages
                             },
-                            "finish_reason": "function_call"
+                            "finish_reason": "tool_calls"
                         }
                     ],
                     "usage": {
@@ -207,7 +401,7 @@ async def generate_completion(
         use_cache: bool = True,
         request_id: Optional[str] = None,
         timeout: Optional[int] = None,
-    ) -> Dict[str, Any]:
+    ) -> Union[Dict[str, Any], AsyncIterator[Dict[str, Any]]]:
         """
         Generate a completion from DeepSeek API with caching support.
         
@@ -215,15 +409,27 @@ async def generate_completion(
             messages: List of message dictionaries with role and content
             temperature: Sampling temperature
             max_tokens: Maximum number of tokens to generate
-            stream: Whether to stream the response
+            stream: Whether to stream the response (see ``stream_completion``)
             functions: List of function definitions
             use_cache: Whether to use Redis caching
             request_id: Optional ID to track this request for cancellation
             timeout: Custom timeout for this request in seconds (overrides default)
             
         Returns:
-            Response dictionary from DeepSeek API
+            Response dictionary from DeepSeek API, or an async iterator of
+            chunk dictionaries when ``stream`` is True
         """
+        # Streamed responses are never cached; hand back the chunk iterator
+        if stream:
+            return self.stream_completion(
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                functions=functions,
+                request_id=request_id,
+                timeout=timeout,
+            )
+        
         # If in mock mode, return a mock response
         if self.mock_mode:
             logger.info(f"Using mock mode for request {request_id}")
@@ -236,71 +442,112 @@ async def generate_completion(
         # Use custom timeout if provided, otherwise use default
         request_timeout = timeout if timeout is not None else self.request_timeout
         
+        # Prepare request payload
+        payload = self._build_payload(messages, temperature, max_tokens, functions)
+        
+        # Serialize once: the same bytes are hashed for the cache key and sent
+        body = self._serialize_payload(payload)
+        
         # Check cache if enabled
         cache_key = None
         if use_cache:
-            cache_key = await self._generate_cache_key(messages, self.model)
+            cache_key = self._generate_cache_key(body)
             cached_response = await self._get_cached_response(cache_key)
             if cached_response:
                 logger.info(f"Cache hit for request {request_id}")
                 return cached_response
-
-        # Prepare request payload
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-        }
         
-        if functions:
-            payload["functions"] = functions
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        # Fall back to a near-duplicate prompt with the same context
+        similarity_scope = None
+        if use_cache and self.similarity_cache is not None:
+            similarity_scope = SimilarityCache.scope_key(
+                messages, self.model, temperature, max_tokens, functions
+            )
+            if similarity_scope:
+                match = self.similarity_cache.lookup(similarity_scope, messages[-1].get("content") or "")
+                metrics.CACHE_LOOKUPS.inc(tier="similarity", result="hit" if match else "miss")
+                if match:
+                    entry_id, similar_response, similarity = match
+                    logger.info(f"Similarity cache hit for request {request_id} (entry {entry_id}, similarity {similarity:.2f})")
+                    # A copy, so callers can't change the cached response, carrying the
+                    # entry ID a false hit is reported with
+                    response = copy.deepcopy(similar_response)
+                    response["similarity"] = {"entry_id": entry_id, "score": round(similarity, 4)}
+                    return response
         
         # Track time for metrics
         start_time = time.time()
-        session = None
         
         try:
-            # Make API request
-            session = aiohttp.ClientSession()
+            # Reuse the pooled session instead of opening a new connection
+            session = await self._get_session()
             
-            # Create the task for the API request
-            request_task = asyncio.create_task(
-                self._make_api_request(
-                    session,
-                    f"{self.api_base}/chat/completions",
-                    headers,
-                    payload,
-                    stream,
-                    request_timeout,
-                    cache_key,
-                    use_cache,
+            def api_call():
+                # Retries share the request timeout as their overall deadline
+                return self.retry_policy.call(
+                    lambda attempt_timeout: self._call_with_limiter(
+                        lambda call_timeout: self.router.call(
+                            lambda target, target_timeout: self._make_api_request(
+                                session,
+                                target.url,
+                                target.headers,
+                                body,
+                                target_timeout,
+                                cache_key,
+                                use_cache,
+                                request_id,
+                            ),
+                            request_id,
+                            call_timeout,
+                        ),
+                        attempt_timeout,
+                    ),
                     request_id,
+                    deadline=request_timeout,
                 )
-            )
             
-            # Store session and task for potential cancellation
-            self._active_requests[request_id] = (session, request_task)
+            if cache_key:
+                # Join an identical request already in flight instead of paying twice;
+                # cancelling this task only detaches this caller from the shared call
+                request_coro = self._single_flight.do(
+                    cache_key,
+                    lambda: self._fetch_with_worker_lock(cache_key, api_call, request_timeout),
+                )
+            else:
+                request_coro = api_call()
+            
+            # Create the task for the API request
+            request_task = asyncio.create_task(request_coro)
+            
+            # Store task for potential cancellation
+            self._active_requests[request_id] = request_task
             
             # Wait for the task to complete
-            result = await request_task
+            try:
+                result = await request_task
+            except DeepSeekAPIError as e:
+                if e.reason != "circuit_open":
+                    raise
+                fallback = await self._fallback_response(messages, cache_key, request_id)
+                if fallback is None:
+                    raise
+                metrics.COMPLETION_LATENCY.observe(time.time() - start_time, stream="false", outcome="fallback")
+                return fallback
+            
+            if similarity_scope:
+                self.similarity_cache.add(similarity_scope, messages[-1].get("content") or "", result)
             
             # Log successful completion
             duration = time.time() - start_time
             logger.info(f"Request {request_id} completed in {duration:.2f}s")
+            metrics.COMPLETION_LATENCY.observe(duration, stream="false", outcome="ok")
             
             return result
             
         except asyncio.CancelledError:
             logger.warning(f"Request {request_id} was cancelled after {time.time() - start_time:.2f}s")
+            metrics.COMPLETION_LATENCY.observe(time.time() - start_time, stream="false", outcome="cancelled")
             # Clean up
-            if session and not session.closed:
-                await session.close()
             if request_id in self._active_requests:
                 del self._active_requests[request_id]
             raise
@@ -308,9 +555,8 @@ async def generate_completion(
         except Exception as e:
             duration = time.time() - start_time
             logger.error(f"Request {request_id} failed after {duration:.2f}s: {str(e)}")
+            metrics.COMPLETION_LATENCY.observe(duration, stream="false", outcome="error")
             # Clean up
-            if session and not session.closed:
-                await session.close()
             if request_id in self._active_requests:
                 del self._active_requests[request_id]
             raise
@@ -319,97 +565,647 @@ async def generate_completion(
             # Clean up regardless of outcome
             if request_id in self._active_requests:
                 del self._active_requests[request_id]
-            if session and not session.closed:
-                await session.close()
+
+    async def generate_completions(
+        self,
+        requests: Iterable[Dict[str, Any]],
+        max_concurrency: int = 8,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Generate many independent completions with bounded concurrency.
+        
+        All cache keys are looked up up front (one Redis round trip), identical
+        requests are sent once, and the rest run at most ``max_concurrency`` at
+        a time. A failed item is reported in its result and does not stop the
+        batch.
+        
+        Args:
+            requests: Keyword arguments for ``generate_completion`` per item
+                (messages, temperature, max_tokens, functions, use_cache, timeout)
+            max_concurrency: Maximum number of completions in flight
+            
+        Yields:
+            One dict per request, in completion order, with ``index`` (position
+            in ``requests``), ``response`` (None on failure), ``error`` (the
+            exception, or None) and ``cached``
+        """
+        requests = list(requests)
+        batch_id = f"batch_{int(time.time() * 1000)}"
+        
+        # Group identical requests so each distinct payload is generated once
+        groups: Dict[bytes, List[int]] = {}
+        for index, request in enumerate(requests):
+            if request.get("stream"):
+                raise ValueError("generate_completions does not support streaming")
+            body = self._serialize_payload(self._build_payload(
+                request["messages"],
+                request.get("temperature", 0.7),
+                request.get("max_tokens", 1024),
+                request.get("functions"),
+            ))
+            groups.setdefault(body, []).append(index)
+        
+        # Answer everything already cached before scheduling any API call
+        cache_keys = {
+            body: self._generate_cache_key(body)
+            for body, indexes in groups.items()
+            if requests[indexes[0]].get("use_cache", True)
+        }
+        cached = {}
+        if cache_keys and not self.mock_mode:
+            cached = await self._cache.get_many(list(cache_keys.values()))
+        
+        pending = []
+        for body, indexes in groups.items():
+            response = cached.get(cache_keys.get(body))
+            if response is not None:
+                for index in indexes:
+                    yield {"index": index, "response": response, "error": None, "cached": True}
+            else:
+                pending.append(indexes)
+        
+        if not pending:
+            return
+        
+        logger.info(
+            f"Batch {batch_id}: {len(requests)} requests, {len(requests) - sum(map(len, pending))} "
+            f"answered up front, {len(pending)} to generate"
+        )
+        
+        work: asyncio.Queue = asyncio.Queue()
+        for indexes in pending:
+            work.put_nowait(indexes)
+        results: asyncio.Queue = asyncio.Queue()
+        
+        async def worker():
+            while True:
+                try:
+                    indexes = work.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                request = dict(requests[indexes[0]])
+                request.setdefault("request_id", f"{batch_id}_{indexes[0]}")
+                try:
+                    response = await self.generate_completion(**request)
+                    error = None
+                except Exception as e:
+                    response, error = None, e
+                for index in indexes:
+                    results.put_nowait({"index": index, "response": response, "error": error, "cached": False})
+        
+        workers = [asyncio.create_task(worker()) for _ in range(min(max_concurrency, len(pending)))]
+        try:
+            for _ in range(sum(map(len, pending))):
+                yield await results.get()
+        finally:
+            # Stop outstanding work if the caller stops iterating early
+            while not work.empty():
+                work.get_nowait()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _call_with_limiter(self, fn, timeout: float) -> Any:
+        """
+        Run one API attempt through the circuit breaker and a concurrency-limiter slot.
+        
+        An open circuit fails the attempt before it queues. Time spent queued
+        for the slot counts against ``timeout``; the outcome (success,
+        429/timeout, other error) feeds the limiter's AIMD window and the
+        breaker's failure and slow-call rates.
+        """
+        self.circuit_breaker.allow()
+        loop = asyncio.get_running_loop()
+        queued_at = loop.time()
+        try:
+            token = await self.limiter.acquire(timeout=timeout)
+        except BaseException:
+            # Never reached the upstream; hand back a half-open trial slot
+            self.circuit_breaker.cancel()
+            raise
+        started = loop.time()
+        error = None
+        try:
+            return await fn(max(timeout - (started - queued_at), 1.0))
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            latency = loop.time() - started
+            self.circuit_breaker.record(error, latency)
+            if isinstance(error, asyncio.CancelledError):
+                self.limiter.release(IGNORE, token=token)
+            else:
+                self.limiter.release(classify_outcome(error), latency=latency if error is None else None, token=token)
+
+    async def _fallback_response(
+        self,
+        messages: List[Dict[str, str]],
+        cache_key: Optional[str],
+        request_id: str,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Answer a request without the API while the circuit breaker is open.
+        
+        Tries each source in ``fallback_chain`` in order: a stale cached
+        response for the same request, then the rule-based responder. The
+        response carries a ``degraded`` field naming the source.
+        
+        Returns:
+            A completion-shaped response, or None to fail fast
+        """
+        for source in self.fallback_chain:
+            response = None
+            if source == FALLBACK_STALE_CACHE and cache_key:
+                stale = await self._cache.get_stale(cache_key)
+                metrics.CACHE_LOOKUPS.inc(tier="stale", result="hit" if stale else "miss")
+                if stale:
+                    response = {**stale, "degraded": source}
+            elif source == FALLBACK_RULE_BASED and self.fallback_responder is not None:
+                prompt = next(
+                    (m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"),
+                    "",
+                )
+                try:
+                    content = self.fallback_responder(prompt)
+                except Exception as e:
+                    logger.error(f"Rule-based fallback failed for request {request_id}: {str(e)}")
+                    continue
+                response = {
+                    "id": f"fallback-{uuid.uuid4()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": self.model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                    "degraded": source,
+                }
+            
+            if response is not None:
+                logger.warning(f"Circuit open; served request {request_id} from {source} fallback")
+                self.circuit_breaker.record_fallback(source)
+                return response
+        
+        logger.warning(f"Circuit open; failing request {request_id} fast")
+        return None
+
+    async def _fetch_with_worker_lock(self, cache_key: str, fetch, lock_timeout: float) -> Dict[str, Any]:
+        """
+        Coalesce a cacheable request across uvicorn workers with a Redis lock.
+        
+        The worker holding the lock calls the API and fills the shared cache;
+        the others poll the cache until the result appears, the lock is freed
+        (then they try to take it), or ``lock_timeout`` passes (then they call
+        the API themselves).
+        
+        Args:
+            cache_key: Cache key of the request, also used as the lock name
+            fetch: Zero-argument function returning the API call coroutine
+            lock_timeout: Seconds before the lock expires and waiters give up
+        """
+        if not (self.coalesce_across_workers and self.redis_client):
+            return await fetch()
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + lock_timeout
+        
+        while True:
+            try:
+                token = await self.redis_client.acquire_lock(cache_key, ttl_ms=int(lock_timeout * 1000))
+            except Exception as e:
+                logger.warning(f"Could not take request lock for {cache_key}: {str(e)}")
+                return await fetch()
+            
+            if token:
+                try:
+                    return await fetch()
+                finally:
+                    try:
+                        await self.redis_client.release_lock(cache_key, token)
+                    except Exception as e:
+                        logger.warning(f"Could not release request lock for {cache_key}: {str(e)}")
+            
+            # Another worker is fetching; wait for it to fill the cache
+            cached_response = await self._get_cached_response(cache_key)
+            if cached_response:
+                return cached_response
+            
+            if loop.time() >= deadline:
+                logger.warning(f"Gave up waiting for another worker on {cache_key}")
+                return await fetch()
+            
+            await asyncio.sleep(self.coalesce_poll_interval)
 
     async def _make_api_request(
         self,
         session, 
         url, 
         headers, 
-        payload, 
-        stream, 
+        body, 
         timeout,
         cache_key,
         use_cache,
         request_id
     ):
         """Make the actual API request with timeout handling."""
+        if self.cassette is not None and self.cassette.replaying:
+            return await self._replay_api_request(body, timeout, cache_key, use_cache, request_id)
+        
         try:
             logger.info(f"Making API request for {request_id} (timeout: {timeout}s)")
+            sent_at = time.time()
             
-            # Check if the request has been cancelled before making the API call
-            if request_id not in self._active_requests:
-                logger.warning(f"Request {request_id} was cancelled before API call")
-                raise asyncio.CancelledError("Request cancelled before API call")
-                
             async with session.post(
                 url,
                 headers=headers,
-                json=payload,
+                data=body,
                 timeout=timeout,
             ) as response:
+                metrics.UPSTREAM_TTFB.observe(time.time() - sent_at, stream="false")
                 if response.status != 200:
                     error_text = await response.text()
-                    logger.error(f"API error: {response.status} - {error_text} for request {request_id}")
-                    
-                    # Check for specific error types
-                    if response.status == 429:
-                        raise Exception(f"DeepSeek API rate limit exceeded. Please try again later.")
-                    elif response.status == 401 or response.status == 403:
-                        raise Exception(f"DeepSeek API authentication error. Please check your API key.")
-                    elif response.status >= 500:
-                        raise Exception(f"DeepSeek API server error ({response.status}). The service may be experiencing issues.")
-                    else:
-                        raise Exception(f"DeepSeek API error: {response.status} - {error_text}")
+                    retry_after = response.headers.get("Retry-After")
+                    if self.cassette is not None:
+                        self.cassette.record(
+                            body,
+                            latency=time.time() - sent_at,
+                            status=response.status,
+                            error_text=error_text,
+                            retry_after=retry_after,
+                        )
+                    raise self._status_error(response.status, error_text, retry_after, request_id)
                 
-                if stream:
-                    # Handle streaming response (return async generator)
-                    return self._handle_streaming_response(response)
-                else:
-                    # Handle normal response
-                    try:
-                        # Use a timeout for reading the response as well
-                        read_timeout = max(timeout / 2, 10)  # At least 10 seconds for reading
-                        response_task = asyncio.create_task(response.json())
-                        result = await asyncio.wait_for(response_task, timeout=read_timeout)
-                        
-                        # Cache result if caching is enabled
-                        if use_cache and cache_key:
-                            await self._cache_response(cache_key, result)
-                        
-                        return result
-                    except asyncio.TimeoutError:
-                        logger.error(f"Request {request_id} timed out while reading response after {read_timeout}s")
-                        raise Exception(f"DeepSeek API response reading timed out after {read_timeout} seconds")
+                # Handle normal response
+                try:
+                    # Use a timeout for reading the response as well
+                    read_timeout = max(timeout / 2, 10)  # At least 10 seconds for reading
+                    response_task = asyncio.create_task(response.json(loads=fastjson.loads))
+                    result = await asyncio.wait_for(response_task, timeout=read_timeout)
+                    metrics.record_usage(result)
+                    
+                    if self.cassette is not None:
+                        self.cassette.record(body, response=result, latency=time.time() - sent_at)
+                    
+                    # Cache result if caching is enabled
+                    if use_cache and cache_key:
+                        await self._cache_response(cache_key, result)
+                    
+                    return result
+                except asyncio.TimeoutError:
+                    logger.error(f"Request {request_id} timed out while reading response after {read_timeout}s")
+                    raise DeepSeekAPIError(
+                        f"DeepSeek API response reading timed out after {read_timeout} seconds",
+                        retryable=True,
+                        reason="timeout",
+                    )
                     
         except asyncio.TimeoutError:
-            logger.error(f"Request {request_id} timed out after {timeout}s")
-            raise Exception(f"DeepSeek API request timed out after {timeout} seconds. Please try a simpler query or try again later.")
+            logger.error(f"Request {request_id} timed out after {timeout:.1f}s")
+            raise DeepSeekAPIError(
+                f"DeepSeek API request timed out after {timeout:.0f} seconds. Please try a simpler query or try again later.",
+                retryable=True,
+                reason="timeout",
+            )
         except asyncio.CancelledError:
             logger.warning(f"Request {request_id} was cancelled during API call")
             raise
+        except DeepSeekAPIError:
+            # Re-raise API-specific exceptions
+            raise
         except Exception as e:
-            if str(e).startswith("DeepSeek API"):
-                # Re-raise API-specific exceptions
-                raise
+            # Log and wrap other exceptions; dropped connections are worth retrying
+            logger.error(f"Error during API request {request_id}: {str(e)}", exc_info=True)
+            raise DeepSeekAPIError(
+                f"Error communicating with DeepSeek API: {str(e)}",
+                retryable=isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)),
+                reason="connection",
+            )
+
+    async def _replay_api_request(
+        self,
+        body: bytes,
+        timeout: float,
+        cache_key: Optional[str],
+        use_cache: bool,
+        request_id: str,
+    ) -> Dict[str, Any]:
+        """Serve a request from the cassette instead of the API."""
+        interaction = await self._next_replayed(body, timeout, request_id)
+        result = interaction["response"]
+        metrics.record_usage(result)
+        if use_cache and cache_key:
+            await self._cache_response(cache_key, result)
+        return result
+
+    async def _replay_stream_open(self, body: bytes, timeout: float, request_id: str) -> ReplayedStream:
+        """Open a recorded stream instead of calling the API."""
+        return ReplayedStream(self.cassette, await self._next_replayed(body, timeout, request_id, stream=True))
+
+    async def _next_replayed(self, body: bytes, timeout: float, request_id: str, stream: bool = False) -> Dict[str, Any]:
+        """
+        Take the next recorded interaction for a request, raising its recorded error response.
+        
+        With the original timing, waits for the recorded latency (capped by
+        ``timeout``, which then times out like the API call would). A
+        successful stream doesn't wait here: its chunks carry their own cadence.
+        """
+        interaction = self.cassette.next_interaction(body)
+        status = interaction.get("status", 200)
+        if not (stream and status == 200):
+            latency = interaction.get("latency", 0.0)
+            if self.cassette.timing == "original" and latency > timeout:
+                await self.cassette.wait(timeout)
+                raise DeepSeekAPIError(
+                    f"DeepSeek API request timed out after {timeout:.0f} seconds. Please try a simpler query or try again later.",
+                    retryable=True,
+                    reason="timeout",
+                )
+            await self.cassette.wait(latency)
+        
+        if status != 200:
+            raise self._status_error(status, interaction.get("error_text") or "", interaction.get("retry_after"), request_id)
+        return interaction
+
+    def _status_error(
+        self,
+        status: int,
+        error_text: str,
+        retry_after_header: Optional[str],
+        request_id: str,
+    ) -> DeepSeekAPIError:
+        """Build a descriptive DeepSeekAPIError for a non-200 API response."""
+        logger.error(f"API error: {status} - {error_text} for request {request_id}")
+        
+        retryable = status in RETRYABLE_STATUS_CODES
+        retry_after = parse_retry_after(retry_after_header)
+        
+        # Check for specific error types
+        if status == 429:
+            message = f"DeepSeek API rate limit exceeded. Please try again later."
+        elif status == 401 or status == 403:
+            message = f"DeepSeek API authentication error. Please check your API key."
+        elif status >= 500:
+            message = f"DeepSeek API server error ({status}). The service may be experiencing issues."
+        else:
+            message = f"DeepSeek API error: {status} - {error_text}"
+        
+        return DeepSeekAPIError(message, status=status, retryable=retryable, retry_after=retry_after)
+
+    async def stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        functions: Optional[List[Dict[str, Any]]] = None,
+        request_id: Optional[str] = None,
+        timeout: Optional[int] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream a completion from DeepSeek API as it is generated.
+        
+        The HTTP response stays open until the iterator is exhausted or closed,
+        so chunks reach the caller as soon as the API sends them.
+        
+        Args:
+            messages: List of message dictionaries with role and content
+            temperature: Sampling temperature
+            max_tokens: Maximum number of tokens to generate
+            functions: List of function definitions
+            request_id: Optional ID to track this request for cancellation
+            timeout: Maximum seconds to wait for the connection or between chunks
+            
+        Yields:
+            Chunk dictionaries in the ``chat.completion.chunk`` format
+        """
+        if not request_id:
+            request_id = f"req_{int(time.time() * 1000)}"
+        
+        if self.mock_mode:
+            logger.info(f"Using mock mode for streaming request {request_id}")
+            async for chunk in self._generate_mock_stream(messages, functions):
+                yield chunk
+            return
+        
+        request_timeout = timeout if timeout is not None else self.request_timeout
+        
+        payload = self._build_payload(messages, temperature, max_tokens, functions)
+        payload["stream"] = True
+        
+        start_time = time.time()
+        first_chunk_time = None
+        # Reported with the stream's total time: ok, fallback, cancelled or error
+        stream_outcome = "error"
+        
+        # The consuming task is what gets cancelled by cancel_request
+        current_task = asyncio.current_task()
+        if current_task is not None:
+            self._active_requests[request_id] = current_task
+        
+        # Serialized like non-streaming requests so cassette keys are stable
+        body = self._serialize_payload(payload)
+        
+        try:
+            session = await self._get_session()
+            logger.info(f"Making streaming API request for {request_id} (timeout: {request_timeout}s)")
+            
+            limiter_token = None
+            opened_at = None
+            
+            async def open_stream(attempt_timeout: float):
+                nonlocal limiter_token, opened_at
+                self.circuit_breaker.allow()
+                # The stream holds a limiter slot from opening until it is fully read
+                try:
+                    limiter_token = await self.limiter.acquire(timeout=attempt_timeout)
+                except BaseException:
+                    self.circuit_breaker.cancel()
+                    raise
+                opened_at = time.time()
+                
+                async def post(target, post_timeout: float):
+                    # A replayed stream goes through the same retry, limiter, breaker and router
+                    if self.cassette is not None and self.cassette.replaying:
+                        return await self._replay_stream_open(body, post_timeout, request_id)
+                    sent_at = time.time()
+                    response = await session.post(
+                        target.url,
+                        headers=target.headers,
+                        data=body,
+                        # Bound connect and idle time between chunks, not the whole stream
+                        timeout=aiohttp.ClientTimeout(
+                            total=None,
+                            sock_connect=post_timeout,
+                            sock_read=post_timeout,
+                        ),
+                    )
+                    if response.status != 200:
+                        try:
+                            error_text = await response.text()
+                        finally:
+                            response.release()
+                        retry_after = response.headers.get("Retry-After")
+                        if self.cassette is not None:
+                            self.cassette.record(
+                                body,
+                                chunks=[],
+                                latency=time.time() - sent_at,
+                                status=response.status,
+                                error_text=error_text,
+                                retry_after=retry_after,
+                            )
+                        raise self._status_error(response.status, error_text, retry_after, request_id)
+                    return response
+                
+                try:
+                    response = await self.router.call(post, request_id, attempt_timeout)
+                except BaseException as e:
+                    self.circuit_breaker.record(e, time.time() - opened_at)
+                    outcome = IGNORE if isinstance(e, asyncio.CancelledError) else classify_outcome(e)
+                    self.limiter.release(outcome, token=limiter_token)
+                    raise
+                self.circuit_breaker.record(None, time.time() - opened_at)
+                return response
+            
+            # Only opening the stream is retried; once chunks flow we are committed
+            try:
+                response = await self.retry_policy.call(open_stream, request_id, deadline=request_timeout)
+            except DeepSeekAPIError as e:
+                if e.reason != "circuit_open":
+                    raise
+                # Look up a stale copy of the same request made without streaming
+                cache_key = None
+                if FALLBACK_STALE_CACHE in self.fallback_chain:
+                    cache_key = self._generate_cache_key(
+                        self._serialize_payload({k: v for k, v in payload.items() if k != "stream"})
+                    )
+                fallback = await self._fallback_response(messages, cache_key, request_id)
+                if fallback is None:
+                    raise
+                stream_outcome = "fallback"
+                async for chunk in self._replay_as_stream(fallback):
+                    yield chunk
+                return
+            stream_error = None
+            # Chunk cadence for the cassette, relative to the start of the request
+            recorded_chunks = [] if self.cassette is not None and self.cassette.recording else None
+            if isinstance(response, ReplayedStream):
+                chunks = response.chunks()
             else:
-                # Log and wrap other exceptions
-                logger.error(f"Error during API request {request_id}: {str(e)}", exc_info=True)
-                raise Exception(f"Error communicating with DeepSeek API: {str(e)}")
+                chunks = self._handle_streaming_response(response)
+            try:
+                async for chunk in chunks:
+                    if first_chunk_time is None:
+                        first_chunk_time = time.time()
+                        logger.info(f"Request {request_id} received first chunk after {first_chunk_time - start_time:.2f}s")
+                        metrics.UPSTREAM_TTFB.observe(first_chunk_time - opened_at, stream="true")
+                    # The final chunk carries the usage of the whole stream
+                    metrics.record_usage(chunk)
+                    if recorded_chunks is not None:
+                        recorded_chunks.append((time.time() - start_time, chunk))
+                    yield chunk
+            except BaseException as e:
+                stream_error = e
+                raise
+            finally:
+                response.release()
+                # Time to first chunk is the latency signal for streams
+                if stream_error is None or isinstance(stream_error, (asyncio.CancelledError, GeneratorExit)):
+                    ttfb = first_chunk_time - start_time if first_chunk_time else None
+                    self.limiter.release(SUCCESS if ttfb is not None else IGNORE, latency=ttfb, token=limiter_token)
+                else:
+                    self.limiter.release(classify_outcome(stream_error), token=limiter_token)
+                # Broken streams are recorded with their error; abandoned ones say nothing about the API
+                if recorded_chunks is not None and not isinstance(stream_error, (asyncio.CancelledError, GeneratorExit)):
+                    self.cassette.record(
+                        body,
+                        chunks=recorded_chunks,
+                        latency=time.time() - start_time,
+                        stream_error=stream_error,
+                    )
+            
+            logger.info(f"Streaming request {request_id} completed in {time.time() - start_time:.2f}s")
+            stream_outcome = "ok"
+            
+        except asyncio.TimeoutError:
+            logger.error(f"Streaming request {request_id} timed out after {request_timeout}s")
+            raise DeepSeekAPIError(
+                f"DeepSeek API request timed out after {request_timeout} seconds. Please try a simpler query or try again later.",
+                retryable=True,
+                reason="timeout",
+            )
+        except (asyncio.CancelledError, GeneratorExit):
+            stream_outcome = "cancelled"
+            logger.warning(f"Streaming request {request_id} was cancelled after {time.time() - start_time:.2f}s")
+            raise
+        except aiohttp.ClientError as e:
+            logger.error(f"Error during streaming request {request_id}: {str(e)}", exc_info=True)
+            raise DeepSeekAPIError(f"Error communicating with DeepSeek API: {str(e)}", reason="connection")
+        finally:
+            metrics.COMPLETION_LATENCY.observe(time.time() - start_time, stream="true", outcome=stream_outcome)
+            if request_id in self._active_requests:
+                del self._active_requests[request_id]
+
+    async def _generate_mock_stream(
+        self,
+        messages: List[Dict[str, str]],
+        functions: Optional[List[Dict[str, Any]]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Replay a mock response as a sequence of streaming chunks."""
+        response = await self._generate_mock_response(messages, functions)
+        async for chunk in self._replay_as_stream(response, pace=0.02):  # Simulate token pacing
+            yield chunk
+
+    async def _replay_as_stream(self, response: Dict[str, Any], pace: float = 0) -> AsyncIterator[Dict[str, Any]]:
+        """Split a complete response into ``chat.completion.chunk`` chunks, word by word."""
+        choice = response["choices"][0]
+        message = choice["message"]
+        
+        def make_chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+            return {
+                "id": response.get("id"),
+                "object": "chat.completion.chunk",
+                "created": response.get("created", int(time.time())),
+                "model": response.get("model", self.model),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+        
+        if message.get("tool_calls"):
+            yield make_chunk({
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{"index": i, **call} for i, call in enumerate(message["tool_calls"])],
+            })
+        elif message.get("function_call"):
+            yield make_chunk({"role": "assistant", "content": None, "function_call": message["function_call"]})
+        else:
+            words = (message.get("content") or "").split(" ")
+            for i, word in enumerate(words):
+                delta = {"content": word if i == 0 else f" {word}"}
+                if i == 0:
+                    delta["role"] = "assistant"
+                yield make_chunk(delta)
+                if pace:
+                    await asyncio.sleep(pace)
+        
+        yield make_chunk({}, choice["finish_reason"])
 
     async def _handle_streaming_response(self, response):
         """Handle streaming response from DeepSeek API."""
-        buffer = ""
         async for line in response.content:
             if line:
                 line_text = line.decode("utf-8").strip()
                 if line_text.startswith("data: ") and line_text != "data: [DONE]":
                     json_str = line_text[6:]  # Remove "data: " prefix
                     try:
-                        chunk = json.loads(json_str)
+                        chunk = fastjson.loads(json_str)
                         yield chunk
-                    except json.JSONDecodeError:
+                    except fastjson.JSONDecodeError:
                         pass
 
     def extract_text_from_response(self, response: Dict[str, Any]) -> str:
@@ -428,3 +1224,30 @@ def extract_function_call(self, response: Dict[str, Any]) -> Optional[Dict[str,
             return None
         except (KeyError, IndexError):
             return None
+
+    def extract_tool_calls(self, response: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Extract the tool calls of a DeepSeek API response, in the order the model made them.
+        
+        A legacy ``function_call`` is returned as a single tool call, so
+        callers handle both response formats the same way.
+        
+        Returns:
+            Tool calls with ``id``, ``type`` and ``function`` (``name`` and ``arguments``)
+        """
+        try:
+            message = response["choices"][0]["message"]
+        except (KeyError, IndexError):
+            return []
+        if message.get("tool_calls"):
+            return [
+                {
+                    "id": call.get("id") or f"call_{uuid.uuid4().hex[:24]}",
+                    "type": call.get("type", "function"),
+                    "function": call.get("function") or {},
+                }
+                for call in message["tool_calls"]
+            ]
+        if message.get("function_call"):
+            return [{"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function", "function": message["function_call"]}]
+        return []
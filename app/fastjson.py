@@ -0,0 +1,76 @@
+"""
+JSON encoding and decoding for the hot paths of the app.
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise. Both backends write UTF-8 rather than ``\\uXXXX`` escapes, compact
+separators (or two-space indentation) and optionally sorted keys, so they
+produce the same text for request payloads and cache keys match across
+workers. The only difference is the notation of very small or large floats
+(orjson writes ``0.00001`` where the standard library writes ``1e-05``).
+"""
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # the standard library is used instead
+    orjson = None
+
+# orjson.JSONDecodeError subclasses this, so callers can catch one type
+JSONDecodeError = json.JSONDecodeError
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumpb(
+    value: Any,
+    sort_keys: bool = False,
+    indent: bool = False,
+    default: Optional[Callable[[Any], Any]] = None,
+) -> bytes:
+    """
+    Serialize a value to UTF-8 JSON bytes.
+
+    Args:
+        value: Value to serialize
+        sort_keys: Sort object keys (for canonical output)
+        indent: Indent with two spaces instead of compact output
+        default: Called for objects that are not natively serializable
+
+    Returns:
+        The encoded JSON
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(value, default=default, option=option)
+    return dumps(value, sort_keys=sort_keys, indent=indent, default=default).encode("utf-8")
+
+
+def dumps(
+    value: Any,
+    sort_keys: bool = False,
+    indent: bool = False,
+    default: Optional[Callable[[Any], Any]] = None,
+) -> str:
+    """Serialize a value to a JSON string (same arguments as ``dumpb``)."""
+    if orjson is not None:
+        return dumpb(value, sort_keys=sort_keys, indent=indent, default=default).decode("utf-8")
+    return json.dumps(
+        value,
+        sort_keys=sort_keys,
+        indent=2 if indent else None,
+        separators=(",", ": ") if indent else (",", ":"),
+        ensure_ascii=False,
+        default=default,
+    )
+
+
+def loads(data: Union[str, bytes, bytearray]) -> Any:
+    """Parse JSON from a string or UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
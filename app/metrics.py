@@ -0,0 +1,365 @@
+"""
+In-process metrics exported in the Prometheus text format.
+
+Counters, gauges and histograms live in one registry per worker process and
+are rendered on ``GET /metrics``; no metrics server or client library is
+needed. With several uvicorn workers each worker exports its own series.
+"""
+import bisect
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Seconds, from a cache-speed response to the longest agent request timeout
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add ``amount`` (non-negative) to the series for ``labels``."""
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, set when metrics are scraped or as things change."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, with their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts with a trailing +Inf bucket, sum, count)
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+        counts, totals = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(self._key(labels))
+        return int(series[1][1]) if series else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        bucket_labels = self.labelnames + ("le",)
+        for key, (counts, (total, count)) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                labels = _format_labels(bucket_labels, key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {int(count)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Named collection of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# Registry of this worker process
+REGISTRY = MetricsRegistry()
+
+# Latency
+UPSTREAM_TTFB = REGISTRY.histogram(
+    "deepseek_upstream_ttfb_seconds",
+    "Time from sending a request to DeepSeek until the response headers (or the first streamed chunk).",
+    ["stream"],
+)
+COMPLETION_LATENCY = REGISTRY.histogram(
+    "deepseek_completion_seconds",
+    "Time to a full completion, including queueing, retries and fallbacks; cache hits excluded.",
+    ["stream", "outcome"],
+)
+TOOL_LATENCY = REGISTRY.histogram(
+    "agent_tool_seconds",
+    "Time taken by each tool call, by outcome (ok, cached, timeout, error).",
+    ["tool", "outcome"],
+)
+AGENT_ITERATIONS = REGISTRY.histogram(
+    "agent_loop_iterations",
+    "DeepSeek calls made to answer one query.",
+    ["stream"],
+    buckets=ITERATION_BUCKETS,
+)
+AGENT_STOPS = REGISTRY.counter(
+    "agent_runs_total",
+    "Agent runs by why they stopped (answered, tool_errors, max_steps, deadline, token_budget, error).",
+    ["reason", "stream"],
+)
+CHAT_LATENCY = REGISTRY.histogram(
+    "chat_request_seconds",
+    "End-to-end latency of chat requests.",
+    ["endpoint"],
+)
+LIMITER_QUEUE_TIME = REGISTRY.histogram(
+    "deepseek_limiter_queue_seconds",
+    "Time calls waited for an upstream concurrency slot.",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+# Counters
+CACHE_LOOKUPS = REGISTRY.counter(
+    "deepseek_cache_lookups_total",
+    "Completion cache lookups by tier (l1, l2, similarity, stale) and result (hit, miss).",
+    ["tier", "result"],
+)
+SIMILARITY_FALSE_HITS = REGISTRY.counter(
+    "deepseek_similarity_false_hits_total",
+    "Similarity cache hits reported as wrong answers (the entries are dropped).",
+)
+TOOL_CACHE_LOOKUPS = REGISTRY.counter(
+    "agent_tool_cache_lookups_total",
+    "Tool result cache lookups by tool and result (hit, miss).",
+    ["tool", "result"],
+)
+PUBSUB_RECONNECTS = REGISTRY.counter(
+    "redis_pubsub_reconnects_total",
+    "Pub/sub listeners resubscribed after a failure, by channel.",
+    ["channel"],
+)
+UPSTREAM_ATTEMPTS = REGISTRY.counter(
+    "deepseek_upstream_attempts_total",
+    "Attempts at a DeepSeek call by outcome (ok, timeout, connection, cancelled, or the HTTP status).",
+    ["outcome"],
+)
+RETRIES = REGISTRY.counter(
+    "deepseek_retries_total",
+    "Attempts that were retries of an earlier failed attempt.",
+)
+TIMEOUTS = REGISTRY.counter(
+    "deepseek_timeouts_total",
+    "DeepSeek attempts that timed out.",
+)
+CANCELLATIONS = REGISTRY.counter(
+    "agent_cancellations_total",
+    "Requests cancelled through the API.",
+)
+CIRCUIT_TRANSITIONS = REGISTRY.counter(
+    "deepseek_circuit_transitions_total",
+    "Circuit breaker state changes by new state.",
+    ["state"],
+)
+PROMPT_TOKENS = REGISTRY.counter(
+    "deepseek_prompt_tokens_total",
+    "Prompt tokens reported in the usage of DeepSeek responses.",
+)
+COMPLETION_TOKENS = REGISTRY.counter(
+    "deepseek_completion_tokens_total",
+    "Completion tokens reported in the usage of DeepSeek responses.",
+)
+TARGET_CALLS = REGISTRY.counter(
+    "deepseek_target_calls_total",
+    "Calls to each upstream target by result (success, failure, rate_limited, other).",
+    ["target", "result"],
+)
+FAILOVERS = REGISTRY.counter(
+    "deepseek_failovers_total",
+    "Calls moved to another upstream target after a failure.",
+)
+PROMPT_CACHE_HIT_TOKENS = REGISTRY.counter(
+    "deepseek_prompt_cache_hit_tokens_total",
+    "Prompt tokens DeepSeek served from its prompt prefix cache.",
+)
+PROMPT_CACHE_MISS_TOKENS = REGISTRY.counter(
+    "deepseek_prompt_cache_miss_tokens_total",
+    "Prompt tokens DeepSeek did not find in its prompt prefix cache.",
+)
+PROMPT_TOKENS_TRIMMED = REGISTRY.counter(
+    "agent_prompt_tokens_trimmed_total",
+    "Estimated prompt tokens removed by the token budget.",
+)
+
+# Gauges refreshed on every scrape
+CIRCUIT_STATE = REGISTRY.gauge(
+    "deepseek_circuit_state",
+    "1 for the current circuit breaker state, 0 for the others.",
+    ["state"],
+)
+CONCURRENCY_LIMIT = REGISTRY.gauge(
+    "deepseek_concurrency_limit",
+    "Current adaptive concurrency limit for upstream calls.",
+)
+INFLIGHT_CALLS = REGISTRY.gauge(
+    "deepseek_inflight_calls",
+    "Upstream calls in flight.",
+)
+QUEUED_CALLS = REGISTRY.gauge(
+    "deepseek_queued_calls",
+    "Calls waiting for an upstream concurrency slot.",
+)
+ACTIVE_AGENT_REQUESTS = REGISTRY.gauge(
+    "agent_active_requests",
+    "Agent requests still processing.",
+)
+TARGET_LATENCY = REGISTRY.gauge(
+    "deepseek_target_latency_seconds",
+    "Moving average latency of each upstream target (API key and base URL).",
+    ["target"],
+)
+TARGET_AVAILABLE = REGISTRY.gauge(
+    "deepseek_target_available",
+    "1 if the upstream target is in rotation, 0 while it cools down after 429s or failures.",
+    ["target"],
+)
+
+
+def record_usage(response: Optional[dict]) -> None:
+    """Count the prompt, completion and prompt-cache tokens in the ``usage`` of a DeepSeek response or chunk."""
+    usage = (response or {}).get("usage") or {}
+    if usage.get("prompt_tokens"):
+        PROMPT_TOKENS.inc(usage["prompt_tokens"])
+    if usage.get("completion_tokens"):
+        COMPLETION_TOKENS.inc(usage["completion_tokens"])
+    if usage.get("prompt_cache_hit_tokens"):
+        PROMPT_CACHE_HIT_TOKENS.inc(usage["prompt_cache_hit_tokens"])
+    if usage.get("prompt_cache_miss_tokens"):
+        PROMPT_CACHE_MISS_TOKENS.inc(usage["prompt_cache_miss_tokens"])
+
+
+def record_router(router) -> None:
+    """Refresh the per-target gauges from an ``UpstreamRouter``."""
+    for name, target in router.snapshot()["targets"].items():
+        if target["ewma_latency"] is not None:
+            TARGET_LATENCY.set(target["ewma_latency"], target=name)
+        TARGET_AVAILABLE.set(1 if target["available"] else 0, target=name)
+
+
+def record_attempt(request_id: str, attempt: int, outcome: str, duration: float) -> None:
+    """Retry policy attempt listener."""
+    UPSTREAM_ATTEMPTS.inc(outcome=outcome)
+    if attempt > 1:
+        RETRIES.inc()
+    if outcome == "timeout":
+        TIMEOUTS.inc()
+
+
+def record_circuit_transition(old_state: str, new_state: str) -> None:
+    """Circuit breaker state listener."""
+    CIRCUIT_TRANSITIONS.inc(state=new_state)
@@ -0,0 +1,126 @@
+"""
+Compare cache value codecs on encode/decode time and stored size.
+
+Uses the responses recorded in a cassette when one is given (real DeepSeek
+traffic), otherwise mock-mode responses to a set of English and Vietnamese
+prompts.
+
+Usage:
+    python -m benchmarks.codec_benchmark [--cassette traffic.jsonl.gz] [--rounds 200]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import statistics
+import time
+from typing import Any, Dict, List
+
+from app.cache.redis import ValueCodec, msgpack, zstandard
+from app.deepseek.wrapper import DeepSeekWrapper
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant powered by DeepSeek. You help users generate "
+    "on-brand content and answer questions. Always answer in the language of the question."
+)
+
+PROMPTS = [
+    "Hello!",
+    "Write a product description for our new running shoes.",
+    "Viết một bài đăng Facebook giới thiệu bộ sưu tập mùa thu của thương hiệu.",
+    "Tóm tắt các hướng dẫn thương hiệu về giọng điệu và màu sắc.",
+    "Give me ten blog post ideas about sustainable fashion, with a short outline for each. " * 4,
+]
+
+
+def load_cassette_responses(path: str) -> List[Dict[str, Any]]:
+    responses = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            interaction = json.loads(line)
+            if interaction.get("response") is not None:
+                responses.append(interaction["response"])
+    return responses
+
+
+async def mock_responses() -> List[Dict[str, Any]]:
+    wrapper = DeepSeekWrapper(api_key="", mock_mode=True)
+    responses = []
+    for prompt in PROMPTS:
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+        responses.append(await wrapper._generate_mock_response(messages))
+    return responses
+
+
+def bench(codec: ValueCodec, values: List[Any], rounds: int) -> Dict[str, float]:
+    encoded = [codec.encode(value) for value in values]
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for value in values:
+            codec.encode(value)
+    encode_us = (time.perf_counter() - started) / (rounds * len(values)) * 1e6
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in encoded:
+            codec.decode(data)
+    decode_us = (time.perf_counter() - started) / (rounds * len(values)) * 1e6
+
+    sizes = [len(data) for data in encoded]
+    return {
+        "encode_us": encode_us,
+        "decode_us": decode_us,
+        "mean_bytes": statistics.mean(sizes),
+        "total_bytes": sum(sizes),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cassette", help="Cassette of recorded DeepSeek traffic (.jsonl.gz)")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--threshold", type=int, default=512, help="Compression threshold in bytes")
+    args = parser.parse_args()
+
+    if args.cassette:
+        values = load_cassette_responses(args.cassette)
+        source = args.cassette
+    else:
+        values = asyncio.run(mock_responses())
+        source = "mock responses"
+    if not values:
+        raise SystemExit("No responses to benchmark")
+
+    # Plain JSON text, as written before the codec layer
+    legacy_sizes = [len(json.dumps(value).encode("utf-8")) for value in values]
+
+    codecs = {
+        "json": ValueCodec("json", "none"),
+        "json+zlib": ValueCodec("json", "zlib", args.threshold),
+    }
+    if msgpack is not None:
+        codecs["msgpack"] = ValueCodec("msgpack", "none")
+        codecs["msgpack+zlib"] = ValueCodec("msgpack", "zlib", args.threshold)
+        if zstandard is not None:
+            codecs["msgpack+zstd"] = ValueCodec("msgpack", "zstd", args.threshold)
+
+    print(f"{len(values)} values from {source}, {args.rounds} rounds")
+    print(f"legacy json: {statistics.mean(legacy_sizes):.0f} bytes mean, {sum(legacy_sizes)} total")
+    print(f"{'codec':<14}{'encode us':>11}{'decode us':>11}{'mean bytes':>12}{'vs legacy':>11}")
+    for name, codec in codecs.items():
+        result = bench(codec, values, args.rounds)
+        ratio = result["total_bytes"] / sum(legacy_sizes)
+        print(
+            f"{name:<14}{result['encode_us']:>11.1f}{result['decode_us']:>11.1f}"
+            f"{result['mean_bytes']:>12.0f}{ratio:>10.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Measure the JSON CPU time of one chat request with the standard library and
+with the app's JSON facade (orjson when installed).
+
+One request does the JSON work of a content-database tool call: serializing
+the payload for the cache key, decoding the completion, logging the tool
+arguments, dumping the tool result, serializing the follow-up payload and
+rendering the API response.
+
+Usage:
+    python -m benchmarks.json_benchmark [--rounds 2000]
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from app import fastjson
+from app.agent.tools.content_database_tool import ContentDatabaseTool
+from app.deepseek.wrapper import DeepSeekWrapper
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant powered by DeepSeek. You help users generate "
+    "on-brand content and answer questions. Always answer in the language of the question."
+)
+QUERY = "Viết một bài đăng giới thiệu sản phẩm công nghệ mới theo phong cách thương hiệu."
+
+
+def stdlib_request(workload: Dict[str, Any]) -> None:
+    json.dumps(workload["payload"], sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    json.loads(workload["completion"])
+    json.dumps(workload["tool_args"])
+    json.dumps(workload["tool_result"], indent=2)
+    json.dumps(workload["followup"], sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    json.dumps(workload["api_response"], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def facade_request(workload: Dict[str, Any]) -> None:
+    fastjson.dumpb(workload["payload"], sort_keys=True)
+    fastjson.loads(workload["completion"])
+    fastjson.dumps(workload["tool_args"])
+    fastjson.dumps(workload["tool_result"], indent=True)
+    fastjson.dumpb(workload["followup"], sort_keys=True)
+    fastjson.dumpb(workload["api_response"])
+
+
+async def build_workload() -> Dict[str, Any]:
+    wrapper = DeepSeekWrapper(api_key="", mock_mode=True)
+    tool = ContentDatabaseTool()
+    functions = [
+        {
+            "name": "content_database",
+            "description": "Search and retrieve branded content examples to inform your responses.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string", "description": "search, get_by_id, get_random or get_stats"},
+                    "query": {"type": "string", "description": "Search query"},
+                    "count": {"type": "integer", "description": "Number of random items to return"},
+                },
+            },
+        }
+    ]
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": QUERY},
+    ]
+    payload = {"model": "deepseek-chat", "messages": messages, "temperature": 0.7, "max_tokens": 2000, "functions": functions}
+    completion = await wrapper._generate_mock_response(messages, functions)
+    tool_args = {"action": "search", "query": "công nghệ"}
+    tool_result = tool.run("search", query="công nghệ")
+    if not tool_result.get("results"):
+        tool_result = tool.run("get_random", count=3)
+    followup = dict(payload, messages=messages + [
+        {"role": "assistant", "content": None, "function_call": {"name": "content_database", "arguments": json.dumps(tool_args)}},
+        {"role": "function", "name": "content_database", "content": fastjson.dumps(tool_result, indent=True)},
+    ])
+    api_response = {
+        "response": wrapper.extract_text_from_response(completion) * 4,
+        "session_id": "3f2b6c1e-8d2a-4c1b-9e57-0a1d2c3b4e5f",
+        "tool_calls": [{"tool": "content_database", "args": tool_args, "result": tool_result}],
+        "thoughts": None,
+        "request_id": "9a8b7c6d-5e4f-4a3b-2c1d-0e9f8a7b6c5d",
+    }
+    return {
+        "payload": payload,
+        "completion": json.dumps(completion),
+        "tool_args": tool_args,
+        "tool_result": tool_result,
+        "followup": followup,
+        "api_response": api_response,
+    }
+
+
+def bench(request: Callable[[Dict[str, Any]], None], workload: Dict[str, Any], rounds: int) -> float:
+    """Return the mean microseconds per request."""
+    request(workload)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        request(workload)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    workload = asyncio.run(build_workload())
+    sizes: List[Tuple[str, int]] = [
+        (name, len(json.dumps(value, ensure_ascii=False)) if not isinstance(value, str) else len(value))
+        for name, value in workload.items()
+    ]
+    print("workload: " + ", ".join(f"{name} {size} chars" for name, size in sizes))
+
+    stdlib_us = bench(stdlib_request, workload, args.rounds)
+    facade_us = bench(facade_request, workload, args.rounds)
+    print(f"stdlib json:        {stdlib_us:8.1f} us/request")
+    print(f"fastjson ({fastjson.BACKEND:>6}):  {facade_us:8.1f} us/request")
+    print(f"saved:              {stdlib_us - facade_us:8.1f} us/request ({1 - facade_us / stdlib_us:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Measure the per-request setup cost of the chat endpoints: building a Redis
+client, wrapper and agent for every request (as the API used to) versus
+taking a request context from the application container.
+
+Without ``--redis-url`` Redis is left out of both paths, so the per-request
+numbers are a lower bound: with Redis the old path also opened a connection,
+sent a PING and closed it again on every request.
+
+Usage:
+    python -m benchmarks.request_setup_benchmark [--rounds 2000] [--redis-url redis://localhost:6379/0]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from app.agent.agent import DeepSeekAgent
+from app.agent.token_budget import TokenBudget
+from app.agent.tools import AVAILABLE_TOOLS
+from app.api.container import AppContainer, create_redis_client, deepseek_api_keys, is_mock_key
+from app.deepseek.wrapper import DeepSeekWrapper
+
+# Same logger name as the old dependency, so its mock-mode warning costs the same
+logger = logging.getLogger('api')
+
+
+async def per_request_setup(container: AppContainer, use_redis: bool) -> None:
+    """What every request did before the container: connect, read the config, build, and tear down."""
+    redis_client = None
+    if use_redis:
+        redis_client = create_redis_client()
+        await redis_client.redis.ping()
+    try:
+        api_key = deepseek_api_keys()[0]
+        mock_mode = is_mock_key(api_key)
+        if mock_mode:
+            logger.warning("No valid DEEPSEEK_API_KEY found. Using mock mode.")
+        wrapper = DeepSeekWrapper(
+            api_key=api_key,
+            api_base=os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1"),
+            model=os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+            redis_client=redis_client,
+            cache_ttl=int(os.getenv("CACHE_TTL", "3600")),
+            memory_cache_max_bytes=int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+            l1_cache_ttl=int(os.getenv("L1_CACHE_TTL", "300")),
+            cache_write_behind=os.getenv("CACHE_WRITE_BEHIND", "false").lower() == "true",
+            coalesce_across_workers=os.getenv("COALESCE_ACROSS_WORKERS", "false").lower() == "true",
+            mock_mode=mock_mode,
+            session=container.http_session,
+            similarity_cache=container.similarity_cache,
+            retry_policy=container.retry_policy,
+            concurrency_limiter=container.concurrency_limiter,
+            circuit_breaker=container.circuit_breaker,
+            fallback_chain=[f.strip() for f in os.getenv("DEEPSEEK_FALLBACKS", "stale_cache,rule_based").split(",") if f.strip()],
+            stale_cache_ttl=int(os.getenv("STALE_CACHE_TTL", "86400")),
+            cassette=container.cassette,
+            router=container.upstream_router,
+        )
+        DeepSeekAgent(
+            deepseek_wrapper=wrapper,
+            tools=list(AVAILABLE_TOOLS.values()),
+            system_prompt=os.getenv("AGENT_SYSTEM_PROMPT"),
+            memory_window_size=int(os.getenv("MEMORY_WINDOW_SIZE", "5")),
+            token_budget=TokenBudget(
+                max_prompt_tokens=int(os.getenv("MAX_PROMPT_TOKENS", "6000")),
+                max_tool_result_tokens=int(os.getenv("MAX_TOOL_RESULT_TOKENS", "1500")),
+                max_history_message_tokens=int(os.getenv("MAX_HISTORY_MESSAGE_TOKENS", "1000")),
+            ),
+            request_registry=container.request_registry,
+            session_store=container.session_store,
+        )
+    finally:
+        if redis_client is not None:
+            await redis_client.close()
+
+
+async def container_setup(container: AppContainer, use_redis: bool) -> None:
+    container.request_context()
+
+
+async def bench(setup: Callable[[AppContainer, bool], Awaitable[None]], container: AppContainer, use_redis: bool, rounds: int) -> float:
+    """Return the mean microseconds per request."""
+    for _ in range(min(rounds, 20)):
+        await setup(container, use_redis)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await setup(container, use_redis)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+async def run(rounds: int, redis_url: str) -> None:
+    os.environ["USE_REDIS"] = "true" if redis_url else "false"
+    if redis_url:
+        os.environ["REDIS_URL"] = redis_url
+    os.environ.setdefault("DEEPSEEK_API_KEY", "")
+
+    container = AppContainer()
+    started = time.perf_counter()
+    await container.start()
+    startup_ms = (time.perf_counter() - started) * 1e3
+    try:
+        use_redis = container.redis is not None
+        before_us = await bench(per_request_setup, container, use_redis, rounds)
+        after_us = await bench(container_setup, container, use_redis, rounds)
+    finally:
+        await container.close()
+
+    print(f"redis: {'yes' if use_redis else 'no'}, {rounds} rounds")
+    print(f"container startup (once per worker): {startup_ms:8.1f} ms")
+    print(f"per-request build:                   {before_us:8.1f} us/request")
+    print(f"container request context:           {after_us:8.1f} us/request")
+    print(f"saved:                               {before_us - after_us:8.1f} us/request")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--redis-url", default="", help="Include a real Redis connection in both paths")
+    args = parser.parse_args()
+    asyncio.run(run(args.rounds, args.redis_url))
+
+
+if __name__ == "__main__":
+    main()